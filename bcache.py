@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import time
+
+from cmn import *
+from mapimg import clone_file
+import tracing
+
+# Bump whenever the builder output for identical inputs changes.
+CACHE_FORMAT_VERSION = 1
+
+_STATS_NAME = "stats.json"
+
+# Hashes of artifact files, keyed by (path, mtime, size).
+_file_hashes = {}
+
+def hash_file(path: str):
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+    if(key not in _file_hashes):
+        digest = hashlib.sha256()
+        with open(path, "rb") as fp:
+            while(True):
+                data = fp.read(0x100000)
+                if(len(data) == 0):
+                    break
+                digest.update(data)
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+# Content-addressed cache of build outputs.
+# Each entry is a directory named by the hash of everything that went into the build, holding one file per output.
+# Entries are evicted least recently used first once the cache grows past max_size bytes.
+class BuildCache:
+    def __init__(self, cache_dir: str, max_size: int = None, allow_hardlink: bool = False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.allow_hardlink = allow_hardlink
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+
+    # Compute the cache key for a build.
+    # artifact_paths are hashed by content, flags may be anything with a stable repr.
+    def key(self, input_key: str, artifact_paths: list, flags):
+        digest = hashlib.sha256()
+        digest.update("v{}\n{}\n".format(CACHE_FORMAT_VERSION, input_key).encode())
+        for path in artifact_paths:
+            digest.update("{}\n".format(hash_file(path)).encode())
+        digest.update(repr(flags).encode())
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str):
+        return os.path.join(self.cache_dir, "objects", key[:2], key)
+
+    # Materialize a cached build's outputs. outputs maps output names to destination paths.
+    # Returns False if the build isn't cached.
+    def fetch(self, key: str, outputs: dict):
+        entry = self._entry_path(key)
+        if(not all(os.path.exists(os.path.join(entry, name)) for name in outputs)):
+            self.misses += 1
+            tracing.event("build_cache_miss", "cache", key=key)
+            return False
+        with tracing.span("build_cache_fetch", "cache", key=key):
+            for name, path in outputs.items():
+                clone_file(os.path.join(entry, name), path, self.allow_hardlink)
+            os.utime(entry) # Mark as recently used.
+        self.hits += 1
+        return True
+
+    # Store a finished build's outputs. outputs maps output names to the built files.
+    def store(self, key: str, outputs: dict):
+        entry = self._entry_path(key)
+        tmp_entry = "{}.{}.tmp".format(entry, os.getpid())
+        os.makedirs(tmp_entry, exist_ok=True)
+        with tracing.span("build_cache_store", "cache", key=key):
+            for name, path in outputs.items():
+                clone_file(path, os.path.join(tmp_entry, name))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Somebody else stored the same build first.
+            for name in os.listdir(tmp_entry):
+                os.unlink(os.path.join(tmp_entry, name))
+            os.rmdir(tmp_entry)
+
+    # List (last_used, size, path) for every entry.
+    def entries(self):
+        found = []
+        objects = os.path.join(self.cache_dir, "objects")
+        for prefix in os.listdir(objects):
+            for name in os.listdir(os.path.join(objects, prefix)):
+                entry = os.path.join(objects, prefix, name)
+                if(name.endswith(".tmp")):
+                    continue
+                size = 0
+                for output in os.listdir(entry):
+                    size += os.stat(os.path.join(entry, output)).st_blocks * 512
+                found.append((os.stat(entry).st_mtime, size, entry))
+        return found
+
+    # Drop least recently used entries until the cache fits in max_size.
+    # Returns the number of entries removed.
+    def evict(self):
+        if(self.max_size == None):
+            return 0
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, entry in entries:
+            if(total <= self.max_size):
+                break
+            for output in os.listdir(entry):
+                os.unlink(os.path.join(entry, output))
+            os.rmdir(entry)
+            total -= size
+            removed += 1
+        return removed
+
+    # Fold this session's hit/miss counts into the persistent totals.
+    def save_stats(self):
+        stats = self.load_stats()
+        stats["hits"] += self.hits
+        stats["misses"] += self.misses
+        stats["updated"] = time.time()
+        self.hits = 0
+        self.misses = 0
+        tmp_path = os.path.join(self.cache_dir, "{}.{}.tmp".format(_STATS_NAME, os.getpid()))
+        with open(tmp_path, "w") as fp:
+            json.dump(stats, fp)
+        os.replace(tmp_path, os.path.join(self.cache_dir, _STATS_NAME))
+
+    def load_stats(self):
+        try:
+            with open(os.path.join(self.cache_dir, _STATS_NAME), "r") as fp:
+                stats = json.load(fp)
+        except (OSError, ValueError):
+            stats = {}
+        stats.setdefault("hits", 0)
+        stats.setdefault("misses", 0)
+        return stats
+
+    def report(self):
+        stats = self.load_stats()
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        lookups = stats["hits"] + stats["misses"]
+        lines = [
+            "Cache directory: {}".format(self.cache_dir),
+            "Entries:         {}".format(len(entries)),
+            "Size:            {:.1f} MiB".format(total / 0x100000),
+            "Size limit:      {}".format("none" if self.max_size == None else "{:.1f} MiB".format(self.max_size / 0x100000)),
+            "Hits:            {}".format(stats["hits"]),
+            "Misses:          {}".format(stats["misses"]),
+            "Hit rate:        {:.1f}%".format(100 * stats["hits"] / lookups if lookups != 0 else 0),
+        ]
+        return "\n".join(lines)
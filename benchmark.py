@@ -0,0 +1,355 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import bin2img as bn
+import cpmedia as cpm
+import dialms
+import imgfmt
+import wrtbl as wt
+from cmn import *
+
+# Sizes (in words) of the generated BIN tapes.
+BIN_TAPE_SIZES = [0o400, 0o2000, 0o10000]
+
+# Number of entries in each generated unit table spec file, each larger one is packed along with the smallest to fill a table.
+# Every file uses its own range of unit numbers so the packed tables are valid.
+SPEC_SIZES = [2, 8, 16]
+
+# Start and end padding (in blocks) of the generated LINCtape images.
+LINCTAPE_PADDING = [(0, 0), (2, 3), (8, 8)]
+
+# End-to-end build variants: (media, replace_first, second_system, enable_patches).
+BUILD_VARIANTS = [
+    ('linc', None, False, False),
+    ('rk05', None, False, False),
+    ('rk05', 'rk05', True, False),
+    ('sdsk', None, True, True),
+]
+
+# dialms commands whose startup time is measured, by running them with --help.
+STARTUP_COMMANDS = ["build", "copy", "table", "handler", "patch"]
+
+# Default slowdown (as a fraction of the baseline) flagged as a regression.
+DEFAULT_THRESHOLD = 0.10
+
+# Encode words (address -> value) as a BIN tape with 0o100 frames of leader and trailer.
+def make_bin_tape(words: dict):
+    image = bn.CoreImage.from_runs([(addr, struct.pack("<H", value)) for addr, value in words.items()])
+    return bn.encode_bin(image, 0o100, 0o100)
+
+# A LINCtape image with the given padding around a DIAL-MS sized image of random blocks of 12 bit words.
+def make_linctape(rand: random.Random, start_pad: int, end_pad: int):
+    data = bytearray(rand.getrandbits(8) if byte % 2 == 0 else rand.getrandbits(4) for byte in range(BYTES_PER_BLOCK * 8)) * (TAPE_SIZE_BLOCKS // 8)
+    return bytes(start_pad * BYTES_PER_BLOCK) + data + bytes(end_pad * BYTES_PER_BLOCK) + struct.pack("<Hhh", WORDS_PER_BLOCK, -start_pad, -end_pad)
+
+def make_fixtures(fixture_dir: str, seed: int):
+    rand = random.Random(seed)
+    fixtures = {"bin": {}, "spec": {}, "linc": {}}
+    for size in BIN_TAPE_SIZES:
+        # Runs of words at random origins, like a typical program.
+        words = {}
+        while(len(words) < size):
+            origin = rand.randrange(0, 0o10000)
+            for addr in range(origin, min(origin + rand.randrange(0o20, 0o400), 0o10000)):
+                words[addr] = rand.getrandbits(12)
+        path = os.path.join(fixture_dir, "tape-{}.bin".format(size))
+        with open(path, "wb") as fp:
+            fp.write(make_bin_tape(words))
+        fixtures["bin"][size] = path
+    for size in SPEC_SIZES:
+        path = os.path.join(fixture_dir, "units-{}.csv".format(size))
+        with open(path, "w") as fp:
+            for unit in range(size):
+                fp.write("{:o},{:o},{:o}\n".format(0o100 * size + unit, rand.choice([0o7430, 0o7630]), rand.getrandbits(9)))
+        fixtures["spec"][size] = path
+    for start_pad, end_pad in LINCTAPE_PADDING:
+        path = os.path.join(fixture_dir, "tape-{}-{}.linc".format(start_pad, end_pad))
+        with open(path, "wb") as fp:
+            fp.write(make_linctape(rand, start_pad, end_pad))
+        fixtures["linc"]["{}-{}".format(start_pad, end_pad)] = path
+    return fixtures
+
+def _output_bytes(paths: list):
+    written = 0
+    allocated = 0
+    for path in paths:
+        stat = os.stat(path)
+        written += stat.st_size
+        allocated += stat.st_blocks * 512
+    return written, allocated
+
+# Benchmark stages. Each returns (seconds, bytes written, bytes allocated) for a single run.
+def stage_bin_decode(fixtures: dict, out_dir: str, size: int):
+    with open(fixtures["bin"][size], "rb") as fp:
+        tape = fp.read()
+    start = time.perf_counter()
+    bn.decode_bin(tape)
+    return time.perf_counter() - start, 0, 0
+
+def _spec_paths(fixtures: dict, size: int):
+    if(size == SPEC_SIZES[0]):
+        return [fixtures["spec"][size]]
+    return [fixtures["spec"][size], fixtures["spec"][SPEC_SIZES[0]]]
+
+def stage_unit_table(fixtures: dict, out_dir: str, size: int):
+    table = memoryview(bytearray(wt.UNIT_TABLE_SIZE))
+    paths = _spec_paths(fixtures, size)
+    start = time.perf_counter()
+    wt.parse_spec_file_list_by_path(table, paths)
+    return time.perf_counter() - start, 0, 0
+
+# Applying an already compiled table, as every build after the first does.
+def stage_unit_table_compiled(fixtures: dict, out_dir: str, size: int):
+    table = memoryview(bytearray(wt.UNIT_TABLE_SIZE))
+    paths = _spec_paths(fixtures, size)
+    start = time.perf_counter()
+    wt.apply_unit_table(table, wt.compile_unit_table(paths))
+    return time.perf_counter() - start, 0, 0
+
+def stage_copy(fixtures: dict, out_dir: str, padding: str, media: str):
+    out_path = os.path.join(out_dir, "copy.{}".format(media))
+    start = time.perf_counter()
+    with open(fixtures["linc"][padding], "rb") as fp:
+        cpm.copy_dial_media(out_path, fp, "linc", media, False)
+    elapsed = time.perf_counter() - start
+    return (elapsed,) + _output_bytes([out_path])
+
+def stage_stream(fixtures: dict, out_dir: str, padding: str, media: str):
+    out_path = os.path.join(out_dir, "stream.{}".format(media))
+    start = time.perf_counter()
+    cpm.convert_dial_media(out_path, fixtures["linc"][padding], "linc", media, False)
+    elapsed = time.perf_counter() - start
+    return (elapsed,) + _output_bytes([out_path])
+
+# Store an image in another format and read it back, both as a single streaming pass.
+def stage_format(fixtures: dict, out_dir: str, fmt: str, media: str):
+    stored_path = os.path.join(out_dir, "stored.{}".format(media))
+    out_path = os.path.join(out_dir, "format.{}".format(media))
+    start = time.perf_counter()
+    cpm.convert_dial_media(stored_path, fixtures["linc"]["0-0"], "linc", media, True, out_format=fmt)
+    cpm.convert_dial_media(out_path, stored_path, media, media, True, in_format=fmt)
+    elapsed = time.perf_counter() - start
+    return (elapsed,) + _output_bytes([stored_path, out_path])
+
+def stage_build(fixtures: dict, out_dir: str, media: str, replace_first: str, second_system: bool, enable_patches: bool):
+    import builder as bld
+    variant = bld.BuildVariant(os.path.join(out_dir, "build"), media, replace_first, second_system, enable_patches)
+    start = time.perf_counter()
+    base = bld.read_base_image(fixtures["linc"]["0-0"], [])
+    bld.build_variant(base, variant)
+    elapsed = time.perf_counter() - start
+    return (elapsed,) + _output_bytes(list(bld.variant_outputs(variant).values()))
+
+def _run_command(command: str, *options):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.run([sys.executable, *options, os.path.join(repo_dir, "dialms.py"), command, "--help"], cwd=repo_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+
+# Time from starting the interpreter to a command having parsed its arguments.
+def stage_startup(fixtures: dict, out_dir: str, command: str):
+    start = time.perf_counter()
+    _run_command(command)
+    return time.perf_counter() - start, 0, 0
+
+# Time from starting the interpreter to a command's script having parsed its arguments, in this tree and a baseline tree.
+# Runs alternate between the two so both see the same machine load. Returns the baseline's time as a fourth value.
+def stage_startup_vs_baseline(fixtures: dict, out_dir: str, command: str, baseline_dir: str):
+    script = dialms.COMMANDS[command][0] + ".py"
+    if(not os.path.exists(os.path.join(baseline_dir, script))):
+        raise FileNotFoundError("The baseline has no {}".format(script))
+    times = []
+    for repo_dir in (os.path.dirname(os.path.abspath(__file__)), baseline_dir):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, script, "--help"], cwd=repo_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - start)
+        if(proc.returncode != 0):
+            lines = proc.stderr.decode(errors="replace").strip().splitlines()
+            raise OSError("{} --help failed in {}: {}".format(script, repo_dir, lines[-1] if lines else proc.returncode))
+    return times[0], 0, 0, times[1]
+
+# Time spent importing modules when starting a command, as reported by -X importtime.
+def stage_imports(fixtures: dict, out_dir: str, command: str):
+    report = _run_command(command, "-X", "importtime").stderr.decode()
+    total_us = 0
+    for line in report.splitlines():
+        fields = line.split("|")
+        # Only count top level imports, their cumulative times include everything they import.
+        if(len(fields) == 3 and fields[1].strip().isdigit() and not fields[2].startswith("  ")):
+            total_us += int(fields[1])
+    return total_us / 1e6, 0, 0
+
+def stages(fixtures: dict, baseline_dir: str = None):
+    found = []
+    for size in BIN_TAPE_SIZES:
+        found.append(("bin_decode[{}w]".format(size), stage_bin_decode, (size,)))
+    for size in SPEC_SIZES:
+        found.append(("unit_table[{}]".format(size), stage_unit_table, (size,)))
+        found.append(("unit_table_compiled[{}]".format(size), stage_unit_table_compiled, (size,)))
+    for padding in fixtures["linc"]:
+        for media in cpm.MEDIA_ATTRIBUTES:
+            found.append(("copy[linc+{}->{}]".format(padding, media), stage_copy, (padding, media)))
+            found.append(("stream[linc+{}->{}]".format(padding, media), stage_stream, (padding, media)))
+    for fmt in imgfmt.IMAGE_FORMATS:
+        if(fmt != "raw16"):
+            found.append(("format[{}]".format(fmt), stage_format, (fmt, "rk05")))
+    for media, replace_first, second_system, enable_patches in BUILD_VARIANTS:
+        name = "build[{}{}{}{}]".format(media, "-r" + replace_first if replace_first != None else "", "-s" if second_system else "", "-p" if enable_patches else "")
+        found.append((name, stage_build, (media, replace_first, second_system, enable_patches)))
+    for command in STARTUP_COMMANDS:
+        found.append(("startup[{}]".format(command), stage_startup, (command,)))
+        found.append(("imports[{}]".format(command), stage_imports, (command,)))
+        if(baseline_dir != None):
+            found.append(("startup_vs_baseline[{}]".format(command), stage_startup_vs_baseline, (command, baseline_dir)))
+    return found
+
+# Run a stage repeatedly in a fresh process so its peak RSS isn't hidden by earlier stages.
+def _run_stage(func, fixtures: dict, args: tuple, repeat: int):
+    out_dir = tempfile.mkdtemp(prefix="dial-bench-")
+    try:
+        # One untimed run to warm caches, like a long running build would be.
+        func(fixtures, out_dir, *args)
+        runs = [func(fixtures, out_dir, *args) for _ in range(repeat)]
+    except (OSError, ValueError, subprocess.CalledProcessError) as excpt:
+        return {"error": str(excpt)}
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    times = [run[0] for run in runs]
+    result = {
+        "median": statistics.median(times),
+        "best": min(times),
+        "written": runs[-1][1],
+        "allocated": runs[-1][2],
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if(len(runs[-1]) > 3):
+        result["baseline_median"] = statistics.median(run[3] for run in runs)
+    return result
+
+def run_benchmarks(fixtures: dict, repeat: int, selected: str = None, baseline_dir: str = None):
+    results = {}
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for name, func, args in stages(fixtures, baseline_dir):
+            if(selected != None and selected not in name):
+                continue
+            results[name] = pool.apply(_run_stage, (func, fixtures, args, repeat))
+            print(format_result(name, results[name]), flush=True)
+    return results
+
+def format_result(name: str, result: dict):
+    if("error" in result):
+        return "{:40} skipped: {}".format(name, result["error"])
+    line = "{:40} {:10.3f} ms  (best {:.3f} ms)  rss {:7} KiB".format(name, result["median"] * 1000, result["best"] * 1000, result["peak_rss_kib"])
+    if(result["written"] != 0):
+        line += "  wrote {:.2f} MB ({:.2f} MB allocated)".format(result["written"] / 1e6, result["allocated"] / 1e6)
+    if("baseline_median" in result):
+        line += "  baseline {:.3f} ms ({:+.1f}%)".format(result["baseline_median"] * 1000, (result["median"] / result["baseline_median"] - 1.0) * 100)
+    return line
+
+# Compare results against a baseline, returning the names and slowdowns of regressed stages.
+def find_regressions(results: dict, baseline: dict, threshold: float):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if(base == None or "error" in base or "error" in result):
+            continue
+        slowdown = result["median"] / base["median"] - 1.0
+        if(slowdown > threshold):
+            regressions.append((name, slowdown))
+    return regressions
+
+# Stages that were timed against a baseline tree in the same run and came out slower than it.
+def find_baseline_regressions(results: dict, threshold: float):
+    regressions = []
+    for name, result in results.items():
+        if("baseline_median" in result):
+            slowdown = result["median"] / result["baseline_median"] - 1.0
+            if(slowdown > threshold):
+                regressions.append((name, slowdown))
+    return regressions
+
+# Check out a revision of this repository into a temporary worktree, to time startup against.
+def add_baseline_worktree(rev: str):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    baseline_dir = tempfile.mkdtemp(prefix="dial-bench-baseline-")
+    try:
+        subprocess.run(["git", "worktree", "add", "--detach", baseline_dir, rev], cwd=repo_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    except (OSError, subprocess.CalledProcessError) as excpt:
+        shutil.rmtree(baseline_dir, ignore_errors=True)
+        stderr = getattr(excpt, "stderr", None)
+        raise ConfigError("Failed to check out baseline revision '{}': {}".format(rev, stderr.decode().strip() if stderr else excpt))
+    return baseline_dir
+
+def remove_baseline_worktree(baseline_dir: str):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run(["git", "worktree", "remove", "--force", baseline_dir], cwd=repo_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    shutil.rmtree(baseline_dir, ignore_errors=True)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='DIAL-MS Image Builder Benchmarks', description='Benchmark BIN decoding, unit table packing, media copies and end-to-end builds on synthetic fixtures.')
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Timed runs per stage (default 5).")
+    parser.add_argument("-k", "--select", help="Only run stages whose name contains this string.")
+    parser.add_argument("--seed", type=int, default=0o1234, help="Random seed for the generated fixtures.")
+    parser.add_argument("--save", help="Save the results as a JSON baseline.")
+    parser.add_argument("--compare", help="Compare the results against a JSON baseline, exiting with an error if any stage regressed.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD * 100, help="Slowdown in percent flagged as a regression (default {:.0f}).".format(DEFAULT_THRESHOLD * 100))
+    parser.add_argument("--startup-baseline", metavar="REV", help="Also time each command's startup against a git revision of this repository, in the same run, exiting with an error if any command starts slower.")
+    parsed = parser.parse_args(argv)
+
+    baseline = None
+    if(parsed.compare != None):
+        try:
+            with open(parsed.compare, "r") as fp:
+                baseline = json.load(fp)["results"]
+        except (OSError, ValueError, KeyError) as excpt:
+            raise ArtifactError("Failed to read baseline '{}': {}".format(parsed.compare, excpt))
+
+    baseline_dir = add_baseline_worktree(parsed.startup_baseline) if parsed.startup_baseline != None else None
+    fixture_dir = tempfile.mkdtemp(prefix="dial-bench-fixtures-")
+    try:
+        fixtures = make_fixtures(fixture_dir, parsed.seed)
+        results = run_benchmarks(fixtures, max(1, parsed.repeat), parsed.select, baseline_dir)
+    finally:
+        shutil.rmtree(fixture_dir, ignore_errors=True)
+        if(baseline_dir != None):
+            remove_baseline_worktree(baseline_dir)
+
+    if(parsed.save != None):
+        try:
+            with open(parsed.save, "w") as fp:
+                json.dump({"python": sys.version, "repeat": parsed.repeat, "seed": parsed.seed, "results": results}, fp, indent=2)
+        except OSError as excpt:
+            raise ArtifactError("Failed to write baseline '{}': {}".format(parsed.save, excpt))
+
+    regressed = False
+    if(parsed.startup_baseline != None):
+        regressions = find_baseline_regressions(results, parsed.threshold / 100)
+        for name, slowdown in regressions:
+            print("REGRESSION {}: {:+.1f}% against {}".format(name, slowdown * 100, parsed.startup_baseline))
+        if(len(regressions) == 0):
+            print("No startup regressions against {}.".format(parsed.startup_baseline))
+        regressed = len(regressions) != 0
+    if(baseline != None):
+        regressions = find_regressions(results, baseline, parsed.threshold / 100)
+        for name, slowdown in regressions:
+            print("REGRESSION {}: {:+.1f}%".format(name, slowdown * 100))
+        if(len(regressions) == 0):
+            print("No regressions against {}.".format(parsed.compare))
+        regressed = regressed or len(regressions) != 0
+    if(regressed):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
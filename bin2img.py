@@ -1,51 +1,292 @@
 import sys
 import struct
+import os
+import re
+import bisect
+from array import array
 
-def bin_to_core_image(bin_file):
+import tracing
+
+FIELD_SIZE = 0o10000
+FIELD_COUNT = 8
+CORE_IMAGE_SIZE = FIELD_SIZE * 2
+
+# Decoded core images, keyed by (path, mtime, size).
+_core_image_cache = {}
+
+# Frames with only bit 7 set are leader/trailer, both bits 7 and 8 set are data field settings.
+_TRAILER_RE = re.compile(b"[\x80-\xBF]")
+_ORIGIN_RE = re.compile(b"[\x40-\x7F]")
+_FIELD_RE = re.compile(b"([\xC0-\xFF])")
+
+# Serialized core images (used by the disk caches) start with this, followed by the segment count,
+# each segment's extended address and length in words, and then every segment's words.
+_CORE_MAGIC = b"DIALCORE"
+_CORE_HEADER = struct.Struct("<8sI")
+_CORE_SEGMENT = struct.Struct("<II")
+
+# A core image covering all eight 4K fields, holding only the words that were loaded.
+# Addresses are extended addresses (field << 12 | address). Loaded words are kept as sorted, non-overlapping segments of
+# array('H'), whose raw bytes are the little endian words (as on the media), so ranges can be sliced out without copying.
+# Unloaded words read as zero.
+class CoreImage:
+    def __init__(self, segments: list = ()):
+        self.segments = list(segments) # [(address, array('H'))], sorted by address.
+        self._starts = [address for address, words in self.segments]
+
+    # Build an image from runs of little endian words, (address, data) in load order; later runs overwrite earlier ones.
+    @classmethod
+    def from_runs(cls, runs: list):
+        # Merge overlapping and adjacent runs into extents first, so each segment is allocated once.
+        extents = []
+        for address, data in sorted(runs, key=lambda run: run[0]):
+            end = address + len(data) // 2
+            if(len(extents) != 0 and address <= extents[-1][1]):
+                extents[-1][1] = max(extents[-1][1], end)
+            elif(end > address):
+                extents.append([address, end])
+        image = cls([(start, array("H", bytes((end - start) * 2))) for start, end in extents])
+        for address, data in runs:
+            if(len(data) != 0):
+                segment_start, words = image.segments[image._segment_index(address)]
+                offset = (address - segment_start) * 2
+                image._bytes(words)[offset:offset + len(data)] = data
+        return image
+
+    # Build an image from a 4K word field image, keeping only the given addresses.
+    @classmethod
+    def from_field(cls, core: bytes, loaded, field: int = 0):
+        core = memoryview(core)
+        runs = []
+        start = None
+        for address in sorted(loaded) + [None]:
+            if(start != None and address != end):
+                runs.append((field << 12 | start, core[start * 2:end * 2]))
+                start = None
+            if(address == None):
+                break
+            if(start == None):
+                start = address
+            end = address + 1
+        return cls.from_runs(runs)
+
+    @staticmethod
+    def _bytes(words: array):
+        return memoryview(words).cast("B")
+
+    # Index of the segment holding an address, or -1.
+    def _segment_index(self, address: int):
+        idx = bisect.bisect_right(self._starts, address) - 1
+        if(idx >= 0 and address < self._starts[idx] + len(self.segments[idx][1])):
+            return idx
+        return -1
+
+    # Words start up to end as little endian bytes. Ranges within a single segment are views of it rather than copies.
+    def words(self, start: int, end: int):
+        assert(0 <= start <= end <= FIELD_SIZE * FIELD_COUNT)
+        idx = self._segment_index(start)
+        if(idx >= 0 and end <= self._starts[idx] + len(self.segments[idx][1])):
+            offset = start - self._starts[idx]
+            return self._bytes(self.segments[idx][1])[offset * 2:(end - start + offset) * 2]
+        data = bytearray((end - start) * 2)
+        for address, words in self.segments:
+            lo = max(address, start)
+            hi = min(address + len(words), end)
+            if(lo < hi):
+                data[(lo - start) * 2:(hi - start) * 2] = self._bytes(words)[(lo - address) * 2:(hi - address) * 2]
+        return data
+
+    def word(self, address: int):
+        return struct.unpack("<H", self.words(address, address + 1))[0]
+
+    # A whole 4K word field, as the core images of old.
+    def field(self, field: int = 0):
+        return self.words(field << 12, (field + 1) << 12)
+
+    def loaded_words(self):
+        return sum(len(words) for address, words in self.segments)
+
+    def serialize(self):
+        header = [_CORE_HEADER.pack(_CORE_MAGIC, len(self.segments))]
+        header += [_CORE_SEGMENT.pack(address, len(words)) for address, words in self.segments]
+        return b"".join(header + [self._bytes(words) for address, words in self.segments])
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        magic, count = _CORE_HEADER.unpack_from(data)
+        if(magic != _CORE_MAGIC):
+            raise ValueError("Not a serialized core image")
+        offset = _CORE_HEADER.size + count * _CORE_SEGMENT.size
+        segments = []
+        for idx in range(count):
+            address, length = _CORE_SEGMENT.unpack_from(data, _CORE_HEADER.size + idx * _CORE_SEGMENT.size)
+            words = array("H")
+            words.frombytes(data[offset:offset + length * 2])
+            if(len(words) != length):
+                raise ValueError("Serialized core image is truncated")
+            segments.append((address, words))
+            offset += length * 2
+        return cls(segments)
+
+# Translation tables used to assemble words from pairs of frames.
+_DATA_BITS_TABLE = bytes(b & 0x3F for b in range(0x100))
+_LOW_BITS_TABLE = bytes((b & 0x03) << 6 for b in range(0x100))
+_HIGH_BITS_TABLE = bytes((b & 0x3F) >> 2 for b in range(0x100))
+
+def decode_bin(data: bytes):
     # Skip over the leader.
-    b = 0x80
-    while(b == 0x80):
-        b = int(bin_file.read(1)[0])
+    body = bytes(data).lstrip(b"\x80")
+
+    # Drop everything between pairs of rubouts.
+    if(b"\xFF" in body):
+        body = b"".join(body.split(b"\xFF")[0::2])
+
+    # Frames with both bits 7 and 8 set change the field the words after them are loaded into.
+    field_changes = []
+    if(_FIELD_RE.search(body) != None):
+        pieces = _FIELD_RE.split(body)
+        body = b"".join(pieces[0::2])
+        position = 0
+        for piece, frame in zip(pieces[0::2], pieces[1::2]):
+            position += len(piece)
+            field_changes.append((position // 2, (frame[0] >> 3) & 0o7))
+
+    # If we encounter a leader (exclusively bit 7 set), we're done.
+    trailer = _TRAILER_RE.search(body)
+    if(trailer == None):
+        raise ValueError("BIN data is missing its trailer")
+    body = body[:trailer.start()]
+    if(len(body) < 2 or len(body) % 2 != 0):
+        raise ValueError("BIN data contains an incomplete word")
+
+    # The last word is the checksum, a sum of every preceeding frame (field settings aren't included).
+    checksum = ((body[-2] & 0x3F) << 6) | (body[-1] & 0x3F)
+    body = body[:-2]
+    if(sum(body) & 0o7777 != checksum):
+        raise ValueError("BIN checksum mismatch (expected {:04o}, calculated {:04o})".format(checksum, sum(body) & 0o7777))
+
+    # Pair up frames into little endian words in bulk, all frames only carry six data bits.
+    # The low byte is made up of the bottom two bits of the first frame and all six of the second.
+    hi = body[0::2]
+    count = len(hi)
+    lo_byte = int.from_bytes(hi.translate(_LOW_BITS_TABLE), "little") | int.from_bytes(body[1::2].translate(_DATA_BITS_TABLE), "little")
+    words = bytearray(count * 2)
+    words[0::2] = lo_byte.to_bytes(count, "little")
+    words[1::2] = hi.translate(_HIGH_BITS_TABLE)
+
+    # Collect each run of words following an origin (or field setting), splitting runs where the address wraps around.
+    # Origins are tagged with a field of -1 so both can be handled in tape order.
+    runs = []
+    field = 0
+    address = 0
+    start = 0
+    events = [(m.start(), -1) for m in _ORIGIN_RE.finditer(hi)] + [(position, new_field) for position, new_field in field_changes if position < count]
+    for position, new_field in sorted(events) + [(count, -1)]:
+        run = memoryview(words)[start * 2:position * 2]
+        while(len(run) > 0):
+            length = min(len(run), (FIELD_SIZE - address) * 2)
+            runs.append((field << 12 | address, run[:length]))
+            run = run[length:]
+            address = (address + length // 2) % FIELD_SIZE #address wrap around
+        if(new_field >= 0):
+            field = new_field
+            start = max(start, position)
+        elif(position < count):
+            address = struct.unpack_from("<H", words, position * 2)[0]
+            start = position + 1
+
+    return CoreImage.from_runs(runs)
 
-    bin_file.seek(-1, 1)
+# Encode a core image as a BIN tape, with leader and trailer frames of the given lengths (the loader needs at least one of each).
+# Each segment gets an origin, and a field setting when its field differs from the last; the checksum covers every other frame.
+def encode_bin(image: CoreImage, leader: int = 1, trailer: int = 1):
+    assert(leader >= 1 and trailer >= 1)
+    frames = bytearray(b"\x80" * leader)
+    checksum = 0
+    field = 0
+    for address, words in image.segments:
+        data = image.words(address, address + len(words))
+        values = struct.unpack("<{}H".format(len(words)), data)
+        start = 0
+        while(start < len(values)):
+            # Segments can carry on into the next field, which needs a field setting and a new origin.
+            extended = address + start
+            if(extended >> 12 != field):
+                field = extended >> 12
+                frames.append(0xC0 | field << 3)
+            count = min(len(values) - start, FIELD_SIZE - (extended & 0o7777))
+            run = bytearray([0x40 | (extended >> 6) & 0o77, extended & 0o77])
+            for value in values[start:start + count]:
+                run += bytes([(value >> 6) & 0o77, value & 0o77])
+            checksum += sum(run)
+            frames += run
+            start += count
+    checksum &= 0o7777
+    frames += bytes([(checksum >> 6) & 0o77, checksum & 0o77])
+    frames += b"\x80" * trailer
+    return bytes(frames)
 
-    data = bytearray(0o10000 * 2)
-    skip = False
+# Decode a RIM tape, returning (address, word) pairs. Frames with bit 7 set are leader/trailer, bit 6 marks an address.
+def decode_rim(data: bytes):
+    frames = bytes(data).translate(None, bytes(range(0x80, 0x100)))
+    if(len(frames) % 2 != 0):
+        raise ValueError("RIM data contains an incomplete word")
+    words = []
     address = 0
-    while(True):
-        b = int(bin_file.read(1)[0])
-
-        # Are all bits set? If yes, activate or deactivate skip mode.
-        if(b == 0xFF):
-            skip = not skip
-            continue
-
-        # Do nothing if in skip mode, we're skipping everything.
-        if(skip):
-            continue
-
-        # If both bits 7 and 8 are set, this means the data field should be updated
-        # But we're not going to worry about that.
-        if(b & 0xC0 == 0xC0):
-            continue
-
-        # If we encounter a leader (exclusively bit 7 set), we're done and should exit.
-        if(b & 0x80):
-            break
-
-        # If we encounter a byte with bit 6 set, update the current address.
-        b2 = int(bin_file.read(1)[0])
-        full = ((b & 0x3F) << 6) | (b2 & 0x3F)
-        if(b & 0x40):
-            address = full
+    for idx in range(0, len(frames), 2):
+        word = (frames[idx] & 0o77) << 6 | frames[idx + 1] & 0o77
+        if(frames[idx] & 0x40):
+            address = word
         else:
-            # Otherwise? Just a regular word.
-            struct.pack_into("<H", data, address * 2, full)
-            address += 1
-            if(address >= 0o10000): #address wrap around
-                address = 0
+            words.append((address, word))
+            address = (address + 1) & 0o7777
+    return words
+
+def bin_to_core_image(bin_file):
+    return decode_bin(bin_file.read())
+
+def _disk_cache_path(cache_dir: str, key: tuple):
+    import hashlib # Only needed for the disk cache.
+    digest = hashlib.sha256(repr(key).encode()).hexdigest()
+    return os.path.join(cache_dir, "{}.core".format(digest))
+
+# Load and decode a BIN file, reusing earlier decodes of the same unmodified file.
+# Decoded images are also stored in cache_dir if provided.
+def load_core_image(path: str, cache_dir: str = None):
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+    if(key in _core_image_cache):
+        tracing.event("core_image_hit", "cache", path=path)
+        return _core_image_cache[key]
+
+    image = None
+    if(cache_dir != None):
+        try:
+            with open(_disk_cache_path(cache_dir, key), "rb") as fp:
+                image = CoreImage.deserialize(fp.read())
+        except (OSError, ValueError, struct.error):
+            pass
+        if(image != None):
+            tracing.event("core_image_disk_hit", "cache", path=path)
+
+    if(image == None):
+        with tracing.span("decode_bin", path=path) as sp:
+            with open(path, "rb") as fp:
+                tape = fp.read()
+            image = decode_bin(tape)
+            sp.set(bytes_read=len(tape), decoded_size=image.loaded_words() * 2)
+        if(cache_dir != None):
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = _disk_cache_path(cache_dir, key) + ".tmp"
+                with open(tmp_path, "wb") as fp:
+                    fp.write(image.serialize())
+                os.replace(tmp_path, _disk_cache_path(cache_dir, key))
+            except OSError:
+                pass # Disk cache is only an optimization.
 
-    return data
+    _core_image_cache[key] = image
+    return image
 
 #if __name__ == "__main__":
 #    exit(main(sys.argv))
@@ -0,0 +1,318 @@
+import argparse
+import collections
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+import cpmedia as cpm
+import tracing
+from cmn import *
+
+# Content addressed block store for archiving many images that mostly hold the same blocks, like the variants of a build.
+# Images are split into blocks, each distinct block is stored once and all-zero blocks aren't stored at all.
+#
+# A store is a directory holding:
+#   blocks.pack:  every distinct block, appended in the order they were first seen; a block's id is its position.
+#   blocks.idx:   the SHA-256 digest of each block in blocks.pack, in the same order.
+#   images/NAME.json: each image's manifest; its size and SHA-256, runs of block ids ([first id, count], an id of -1
+#                 being zeros), and any bytes after the last whole block (e.g. a LINCtape's format information).
+# Blocks of a new image mostly get consecutive ids, so a manifest is usually only a handful of runs.
+# Block ids are only ever added, removing an image just removes its manifest.
+PACK_NAME = "blocks.pack"
+INDEX_NAME = "blocks.idx"
+IMAGES_DIR = "images"
+LOCK_NAME = "lock"
+DIGEST_SIZE = 32
+ZERO_ID = -1
+
+# Blocks kept in memory for repeated reads, and blocks read or written at a time.
+CACHE_BLOCKS = 0o4000
+CHUNK_BLOCKS = 0o200
+
+_ZERO_BLOCK = bytes(BYTES_PER_BLOCK)
+
+class StoreStats:
+    def __init__(self):
+        self.images = 0
+        self.image_bytes = 0
+        self.blocks = 0
+        self.stored_bytes = 0
+
+    def ratio(self):
+        return self.image_bytes / max(self.stored_bytes, 1)
+
+class BlockStore:
+    def __init__(self, store_dir: str, cache_blocks: int = CACHE_BLOCKS, create: bool = False):
+        self.store_dir = store_dir
+        self.cache_blocks = cache_blocks
+        self.cache = collections.OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        if(not os.path.isdir(os.path.join(store_dir, IMAGES_DIR))):
+            if(not create):
+                raise ArtifactError("No block store at '{}'".format(store_dir))
+            try:
+                os.makedirs(os.path.join(store_dir, IMAGES_DIR), exist_ok=True)
+            except OSError as excpt:
+                raise ArtifactError("Failed to create block store '{}': {}".format(store_dir, excpt))
+        try:
+            self._pack = open(os.path.join(store_dir, PACK_NAME), "a+b")
+            self._index = open(os.path.join(store_dir, INDEX_NAME), "a+b")
+        except OSError as excpt:
+            raise ArtifactError("Failed to open block store '{}': {}".format(store_dir, excpt))
+        self.digests = None
+
+    def close(self):
+        self._pack.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Take the store's lock; anything adding blocks must hold it.
+    def lock(self):
+        fp = open(os.path.join(self.store_dir, LOCK_NAME), "a")
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        return fp
+
+    def block_count(self):
+        return os.fstat(self._pack.fileno()).st_size // BYTES_PER_BLOCK
+
+    # Load the digest -> id index. Blocks written without their digest (by an interrupted add) are dropped.
+    def load_index(self):
+        with tracing.span("load_block_index"):
+            self._index.seek(0)
+            data = self._index.read()
+            count = min(len(data) // DIGEST_SIZE, self.block_count())
+            self._pack.truncate(count * BYTES_PER_BLOCK)
+            self._index.truncate(count * DIGEST_SIZE)
+            self.digests = {data[idx * DIGEST_SIZE:(idx + 1) * DIGEST_SIZE]: idx for idx in range(count)}
+
+    # Add the blocks of data, returning their runs of ids. data may end with a partial block, which isn't added.
+    def add_blocks(self, data: memoryview):
+        if(self.digests == None):
+            self.load_index()
+        runs = []
+        new_blocks = []
+        new_digests = []
+        next_id = len(self.digests)
+        for offset in range(0, len(data) - len(data) % BYTES_PER_BLOCK, BYTES_PER_BLOCK):
+            block = data[offset:offset + BYTES_PER_BLOCK]
+            if(block == _ZERO_BLOCK):
+                block_id = ZERO_ID
+            else:
+                digest = hashlib.sha256(block).digest()
+                block_id = self.digests.get(digest)
+                if(block_id == None):
+                    block_id = self.digests[digest] = next_id
+                    next_id += 1
+                    new_blocks.append(block)
+                    new_digests.append(digest)
+            # Zero runs only take zero blocks; their id plus their length means nothing.
+            if(len(runs) != 0 and (runs[-1][0] == ZERO_ID if block_id == ZERO_ID else runs[-1][0] != ZERO_ID and runs[-1][0] + runs[-1][1] == block_id)):
+                runs[-1][1] += 1
+            else:
+                runs.append([block_id, 1])
+
+        # Blocks go in before their digests, so the index never names a block that isn't there.
+        self._pack.write(b"".join(new_blocks))
+        self._pack.flush()
+        self._index.write(b"".join(new_digests))
+        self._index.flush()
+        return runs, len(new_blocks)
+
+    # Read count blocks from first_id on, through the cache. Runs of blocks that aren't cached are read at once.
+    def read_blocks(self, first_id: int, count: int):
+        if(first_id == ZERO_ID):
+            return bytes(count * BYTES_PER_BLOCK)
+        chunks = []
+        block_id = first_id
+        end_id = first_id + count
+        while(block_id < end_id):
+            block = self.cache.get(block_id)
+            if(block != None):
+                self.cache.move_to_end(block_id)
+                self.cache_hits += 1
+                chunks.append(block)
+                block_id += 1
+                continue
+            miss_end = block_id + 1
+            while(miss_end < end_id and miss_end not in self.cache):
+                miss_end += 1
+            data = os.pread(self._pack.fileno(), (miss_end - block_id) * BYTES_PER_BLOCK, block_id * BYTES_PER_BLOCK)
+            if(len(data) != (miss_end - block_id) * BYTES_PER_BLOCK):
+                raise FormatError("Blocks {}-{} are missing from the block store".format(block_id, miss_end - 1))
+            for idx in range(miss_end - block_id):
+                self._cache_block(block_id + idx, data[idx * BYTES_PER_BLOCK:(idx + 1) * BYTES_PER_BLOCK])
+            self.cache_misses += miss_end - block_id
+            chunks.append(data)
+            block_id = miss_end
+        return b"".join(chunks)
+
+    def _cache_block(self, block_id: int, block: bytes):
+        self.cache[block_id] = block
+        if(len(self.cache) > self.cache_blocks):
+            self.cache.popitem(last=False)
+
+    def _manifest_path(self, name: str):
+        if(name != os.path.basename(name) or name in ("", ".", "..")):
+            raise ConfigError("Invalid image name '{}'".format(name))
+        return os.path.join(self.store_dir, IMAGES_DIR, name + ".json")
+
+    def load_manifest(self, name: str):
+        path = self._manifest_path(name)
+        try:
+            with open(path, "r") as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            raise ConfigError("No image named '{}' in the block store".format(name))
+        except (OSError, ValueError) as excpt:
+            raise ArtifactError("Failed to read the manifest of '{}': {}".format(name, excpt))
+
+    def save_manifest(self, manifest: dict):
+        path = self._manifest_path(manifest["name"])
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as fp:
+            json.dump(manifest, fp, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def names(self):
+        return sorted(name[:-len(".json")] for name in os.listdir(os.path.join(self.store_dir, IMAGES_DIR)) if name.endswith(".json"))
+
+    # Add an image, returning its manifest and the number of blocks that weren't already stored.
+    # The image is read back from the store and checked against its hash before its manifest is saved.
+    def add_image(self, name: str, data):
+        data = memoryview(data)
+        with tracing.span("store_image", image=name, bytes=len(data)) as sp:
+            runs, added = self.add_blocks(data)
+            manifest = {
+                "name": name,
+                "size": len(data),
+                "sha256": hashlib.sha256(data).hexdigest(),
+                "runs": runs,
+                "tail": bytes(data[len(data) - len(data) % BYTES_PER_BLOCK:]).hex(),
+                "added": time.time(),
+            }
+            digest = hashlib.sha256()
+            for chunk in self.iter_manifest(manifest):
+                digest.update(chunk)
+            if(digest.hexdigest() != manifest["sha256"]):
+                raise FormatError("Image '{}' doesn't read back from the block store as it was added".format(name))
+            self.save_manifest(manifest)
+            sp.set(runs=len(runs), new_blocks=added)
+        return manifest, added
+
+    # Yield an image's contents a chunk of up to chunk_blocks blocks at a time.
+    def iter_image(self, name: str, chunk_blocks: int = CHUNK_BLOCKS):
+        return self.iter_manifest(self.load_manifest(name), chunk_blocks)
+
+    def iter_manifest(self, manifest: dict, chunk_blocks: int = CHUNK_BLOCKS):
+        for first_id, count in manifest["runs"]:
+            for offset in range(0, count, chunk_blocks):
+                yield self.read_blocks(first_id if first_id == ZERO_ID else first_id + offset, min(chunk_blocks, count - offset))
+        yield bytes.fromhex(manifest["tail"])
+
+    # Write an image out to a path ("-" for stdout, compressed by extension), checking it against its hash.
+    def extract_image(self, name: str, out_path: str, chunk_blocks: int = CHUNK_BLOCKS):
+        manifest = self.load_manifest(name)
+        digest = hashlib.sha256()
+        stream, raw = cpm.open_image_stream(out_path, "wb")
+        try:
+            for chunk in self.iter_manifest(manifest, chunk_blocks):
+                digest.update(chunk)
+                stream.write(chunk)
+        except OSError as excpt:
+            raise ArtifactError("Failed to write '{}': {}".format(out_path, excpt))
+        finally:
+            cpm.close_image_stream(stream, raw)
+        if(digest.hexdigest() != manifest["sha256"]):
+            raise FormatError("Image '{}' doesn't match its hash, the block store is damaged".format(name))
+        return manifest["size"]
+
+    def remove_image(self, name: str):
+        try:
+            os.unlink(self._manifest_path(name))
+        except FileNotFoundError:
+            raise ConfigError("No image named '{}' in the block store".format(name))
+
+    def stats(self):
+        stats = StoreStats()
+        stats.blocks = self.block_count()
+        stats.stored_bytes = os.fstat(self._pack.fileno()).st_size + os.fstat(self._index.fileno()).st_size
+        for name in self.names():
+            stats.images += 1
+            stats.image_bytes += self.load_manifest(name)["size"]
+            stats.stored_bytes += os.path.getsize(self._manifest_path(name))
+        return stats
+
+def read_input(path: str):
+    stream, raw = cpm.open_image_stream(path, "rb")
+    try:
+        return stream.read()
+    except OSError as excpt:
+        raise ArtifactError("Failed to read image '{}': {}".format(path, excpt))
+    finally:
+        cpm.close_image_stream(stream, raw)
+
+# Name an image is stored under by default; its file name without any compression extension.
+def image_name(path: str):
+    name = os.path.basename(path)
+    stem, ext = os.path.splitext(name)
+    return stem if ext in cpm.COMPRESSION_EXTENSIONS else name
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='DIAL-MS Block Store', description='Archive images in a block deduplicating store, and get them back out.')
+    parser.add_argument("store", help="Block store directory.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add_parser = commands.add_parser("add", help="Add (or replace) images, stored under their file names.")
+    add_parser.add_argument("images", nargs="+", help="Image paths, globs, or directories (searched recursively for images).")
+    add_parser.add_argument("--name", help="Store a single image under this name instead.")
+    get_parser = commands.add_parser("get", help="Write an image back out.")
+    get_parser.add_argument("name", help="Image name.")
+    get_parser.add_argument("-o", "--output-path", required=True, help="Output path, or - for stdout. Compressed if it ends in .gz, .xz or .zst.")
+    commands.add_parser("ls", help="List the stored images.")
+    rm_parser = commands.add_parser("rm", help="Remove images from the store (their blocks are kept).")
+    rm_parser.add_argument("names", nargs="+", help="Image names.")
+    commands.add_parser("stats", help="Report how much space the store saves.")
+    parser.add_argument("--cache-blocks", type=int, default=CACHE_BLOCKS, help="Blocks kept in memory for repeated reads (default {}).".format(CACHE_BLOCKS))
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+
+    with BlockStore(parsed.store, parsed.cache_blocks, create=parsed.command == "add") as store:
+        if(parsed.command == "add"):
+            import imginfo
+            paths = imginfo.find_images(parsed.images)
+            if(parsed.name != None and len(paths) != 1):
+                parser.error("--name requires exactly one image")
+            with store.lock():
+                for path in paths:
+                    manifest, added = store.add_image(parsed.name or image_name(path), read_input(path))
+                    print("{}: {} blocks in {} runs, {} new".format(manifest["name"], manifest["size"] // BYTES_PER_BLOCK, len(manifest["runs"]), added))
+        elif(parsed.command == "get"):
+            store.extract_image(parsed.name, parsed.output_path)
+        elif(parsed.command == "ls"):
+            for name in store.names():
+                manifest = store.load_manifest(name)
+                print("{:40} {:10} {}".format(name, manifest["size"], manifest["sha256"][:16]))
+        elif(parsed.command == "rm"):
+            for name in parsed.names:
+                store.remove_image(name)
+        else:
+            stats = store.stats()
+            print("Images:       {}".format(stats.images))
+            print("Image bytes:  {:.1f} KiB".format(stats.image_bytes / 0x400))
+            print("Blocks:       {}".format(stats.blocks))
+            print("Stored bytes: {:.1f} KiB".format(stats.stored_bytes / 0x400))
+            print("Ratio:        {:.1f}x".format(stats.ratio()))
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
@@ -1,5 +1,9 @@
 import argparse
+import itertools
+import os
+import time
 import cpmedia as cpm
+import tracing
 import wrhndlr as wh
 import wrpatch as wp
 import wrtbl as wt
@@ -21,11 +25,11 @@ PATCHED_HANDLER_PATHS = {
     'sdsk': "handlers/sdsk-handler.bin" # Serial disk handler always has the reboot-strap patch applied.
 }
 
-# Secondary unit specifications.
+# Primary unit specifications.
 UNIT_TABLE_SPECS_PRI = {
     'linc': "unit-specs/linctape-units.pri-std.csv",
     'rk08': "unit-specs/rk08-units.pri-std.csv",
-    'rk08': "unit-specs/rk01-units.pri-std.csv",
+    'rk01': "unit-specs/rk08-units.pri-std.csv",
     'rk05': "unit-specs/rk08-units.pri-std.csv",
     'sdsk': "unit-specs/rk08-units.pri-std.csv"
 }
@@ -55,58 +59,51 @@ SYSTEM_SND_SPEC = {
     'sdsk': "unit-specs/sys-units.sec-std.csv",
 }
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(prog='dial-image-builder', description='Build new DIAL-MS images from a base DIAL-MS LINCtape image.')
-    parser.add_argument("-o", "--output-path", required=True, help="Output path excluding file extension, used for both the output LINCtape and output $MEDIA images.")
-    parser.add_argument("-i", "--input-path", required=True, help="Input LINCtape image path.")
-    parser.add_argument("-m", "--media", required=True, choices=VALID_MEDIA_TYPES, help="Media type.")
-    parser.add_argument("-d", "--preserve-index", action="store_const", const=True, help="Preserve the DIAL file index; if not set (default), the index and entire file area are zeroed in both output images.")
-    parser.add_argument("--replace-first", choices=VALID_MEDIA_TYPES, help="Replace the default LINCtape handler with a different handler.")
-    parser.add_argument("-s", "--second-system", action="store_const", const=True, help="Configure system units to use the secondary device handler.")
-    parser.add_argument("-p", "--enable-patches", action="store_const", const=True, help="Apply patches to allow rebooting DIAL-MS without the use of any LINCtape instructions.")
-    parsed = parser.parse_args(sys.argv[1:])
-
-    # Determine output paths.
-    out_lt_path = "{}.linc".format(parsed.output_path)
-    out_alt_path = "{}.{}".format(parsed.output_path, parsed.media)
-    preserve_index = parsed.preserve_index != None
-    patch_enb = parsed.enable_patches != None
-    media_type = parsed.media
-
-    # Create a copy of our input for writing.
-    # NOTE: The copy tool strips any padding from the input LINCtape and we rely on that (we assume there's no padding).
-    with open_file(parsed.input_path, "rb") as fp:
-        try:
-            cpm.copy_dial_media(out_lt_path, fp, "linc", "linc", preserve_index)
-        except OSError as excpt:
-            sys.exit("Failed to copy input image ''{}' to '{}': {}".format(parsed.input_path, out_lt_path, excpt))
-        except ValueError as excpt:
-            sys.exit("Input image '{}' is improperly formatted: {}".format(parsed.input_path, excpt))
-    lt_image = open_file(out_lt_path, "rb+")
+# Byte ranges of the I/O routine blocks written from each kind of input, so a changed input only rewrites its own region.
+ROUTINE_REGIONS = {
+    "patches": [(start * BYTES_PER_WORD, end * BYTES_PER_WORD) for start, end in wp.PATCH_RANGES],
+    "unit_table": [(wt.UNIT_TABLE_OFFSET, wt.UNIT_TABLE_END)],
+    "primary_handler": [(BYTES_PER_BLOCK + 0o230 * BYTES_PER_WORD, BYTES_PER_BLOCK + 0o370 * BYTES_PER_WORD)],
+    "secondary_handler": [(BYTES_PER_BLOCK + 0o30 * BYTES_PER_WORD, BYTES_PER_BLOCK + 0o170 * BYTES_PER_WORD)],
+}
 
-    # Read in both I/O routine blocks, starting with fresh master copies.
-    try:
-        control_block = read_tape_block(lt_image, IO_CONTROLLER_BLOCK)
-        handler_block = read_tape_block(lt_image, IO_MASTERS_BLOCK)
-        routine_blocks = memoryview(control_block + handler_block)
-    except OSError as excpt:
-        sys.exit("Failed to read control block from ''{}': {}".format(out_lt_path, excpt))
-    if(len(control_block) != BYTES_PER_BLOCK):
-        sys.exit("Only read partial control block from input!")
+class BuildOptions:
+    def __init__(self, core_cache_dir: str = None, golden_dir: str = None, sparse: bool = False, cache_dir: str = None, cache_size: int = None, cache_hardlink: bool = False):
+        self.core_cache_dir = core_cache_dir # Optional on-disk cache for decoded BIN images.
+        self.golden_dir = golden_dir         # Optional cache of unmodified base images to reflink outputs from.
+        self.sparse = sparse                 # Leave all-zero blocks as holes in output images.
+        self.cache_dir = cache_dir           # Optional content-addressed cache of finished builds.
+        self.cache_size = cache_size         # Size limit of the build cache in bytes.
+        self.cache_hardlink = cache_hardlink # Allow hardlinking outputs to the build cache.
+
+    def open_cache(self):
+        if(self.cache_dir == None):
+            return None
+        import bcache as bc # Only needed with --cache.
+        return bc.BuildCache(self.cache_dir, self.cache_size, self.cache_hardlink)
+
+_options = BuildOptions()
 
-    # Are patches enabled? Apply them if yes.
-    if(patch_enb):
-        wp.apply_patches(routine_blocks)
+class BuildVariant:
+    def __init__(self, output_path: str, media: str, replace_first: str = None, second_system: bool = False, enable_patches: bool = False, preserve_index: bool = False):
+        self.output_path = output_path
+        self.media = media
+        self.replace_first = replace_first
+        self.second_system = second_system
+        self.enable_patches = enable_patches
+        self.preserve_index = preserve_index
 
+# Determine unit specs and handler paths for a given configuration.
+# Returns (specfile_list, primary_handler_path, secondary_handler_path).
+def resolve_variant(media_type: str, replace_first: str, second_system: bool, patch_enb: bool):
     # Determine what type we have in the primary slot.
     primary_type = "linc" # default to LINCtape
-    if(parsed.replace_first != None):
-        primary_type = parsed.replace_first
+    if(replace_first != None):
+        primary_type = replace_first
 
     # Check that primary type is valid.
-    assert(primary_type != None)    # Cannot be none
     if(not media_type_valid(primary_type)):
-        sys.exit("Invalid primary media type: {}".format(primary_type))
+        raise ConfigError("Invalid primary media type: {}".format(primary_type))
 
     # Determine what type we have in the secondary slot.
     secondary_type = media_type # media type by default
@@ -114,42 +111,434 @@ if __name__ == "__main__":
         secondary_type = None # No sense in having two LINCtapes...
 
     if(secondary_type != None and not media_type_valid(secondary_type)):
-        sys.exit("Invalid secondary media type: {}".format(secondary_type))
+        raise ConfigError("Invalid secondary media type: {}".format(secondary_type))
 
-    # Get specs for system, primary, and secondary.
-    sys_spec = SYSTEM_SND_SPEC[primary_type] if parsed.second_system != None else SYSTEM_PRI_SPEC[secondary_type]
-    primary_spec = UNIT_TABLE_SPECS_PRI[primary_type]
-    secondary_spec = UNIT_TALBE_SPECS_SEC[secondary_type]
+    if(secondary_type == None and second_system):
+        raise ConfigError("No secondary device available to use as the system device")
 
-    # Build + write new table.
-    specfile_list = [primary_spec, sys_spec, secondary_spec]
-    wt.parse_spec_file_list_by_path(routine_blocks[wt.UNIT_TABLE_OFFSET:wt.UNIT_TABLE_END], specfile_list)
+    # Get specs for system, primary, and secondary.
+    if(primary_type not in UNIT_TABLE_SPECS_PRI):
+        raise ConfigError("No primary unit specification for media type: {}".format(primary_type))
+    sys_spec = SYSTEM_SND_SPEC[primary_type] if second_system else SYSTEM_PRI_SPEC[secondary_type or primary_type]
+    specfile_list = [UNIT_TABLE_SPECS_PRI[primary_type], sys_spec]
 
     # Determine where the new handlers are. Patched handlers are for use with the --enable-patches option.
-    if(patch_enb):
-        primary_handler_path = PATCHED_HANDLER_PATHS[primary_type]
-        secondary_handler_path = PATCHED_HANDLER_PATHS[secondary_type]
-    else:
-        primary_handler_path = HANDLER_PATHS[primary_type]
-        secondary_handler_path = HANDLER_PATHS[secondary_type]
+    handler_paths = PATCHED_HANDLER_PATHS if patch_enb else HANDLER_PATHS
+    secondary_handler_path = None
+    if(secondary_type != None):
+        specfile_list.append(UNIT_TALBE_SPECS_SEC[secondary_type])
+        secondary_handler_path = handler_paths[secondary_type]
+    return specfile_list, handler_paths[primary_type], secondary_handler_path
+
+# Build the I/O routine blocks for a variant from the master copies in a (trimmed) LINCtape image.
+def build_routine_blocks(image: memoryview, variant: BuildVariant):
+    specfile_list, primary_handler_path, secondary_handler_path = resolve_variant(variant.media, variant.replace_first, variant.second_system, variant.enable_patches)
 
-    # Insert the new handlers into second block.
-    wh.write_handlers(routine_blocks[BYTES_PER_BLOCK:BYTES_PER_BLOCK*2], primary_handler_path, secondary_handler_path)
+    # Start with fresh master copies.
+    routine_blocks = memoryview(bytearray(BYTES_PER_BLOCK * 2))
+    routine_blocks[0:BYTES_PER_BLOCK] = image[IO_CONTROLLER_BLOCK*BYTES_PER_BLOCK:(IO_CONTROLLER_BLOCK+1)*BYTES_PER_BLOCK]
+    routine_blocks[BYTES_PER_BLOCK:] = image[IO_MASTERS_BLOCK*BYTES_PER_BLOCK:(IO_MASTERS_BLOCK+1)*BYTES_PER_BLOCK]
 
-    # Write the routine blocks back.
+    if(variant.enable_patches):
+        with tracing.span("patches"):
+            wp.apply_patches(routine_blocks, wp.load_patch_image(_options.core_cache_dir))
+    with tracing.span("unit_table"):
+        wt.apply_unit_table(routine_blocks[wt.UNIT_TABLE_OFFSET:wt.UNIT_TABLE_END], wt.compile_unit_table(specfile_list, _options.core_cache_dir))
+
+    with tracing.span("handlers"):
+        handler_block = routine_blocks[BYTES_PER_BLOCK:BYTES_PER_BLOCK*2]
+        wh.write_handler_image(handler_block, wh.load_handler_image(primary_handler_path, _options.core_cache_dir), 0o230)
+        if(secondary_handler_path != None):
+            wh.write_handler_image(handler_block, wh.load_handler_image(secondary_handler_path, _options.core_cache_dir), 0o30)
+    return routine_blocks
+
+# Read and parse the input image.
+# It's only mapped if none of the outputs could overwrite it.
+def read_base_image(input_path: str, output_paths: list):
+    in_place = any(os.path.exists(path) and os.path.samefile(path, input_path) for path in output_paths)
+    with tracing.span("read_base_image", path=input_path) as sp, open_file(input_path, "rb") as fp:
+        base = cpm.read_dial_media(fp, "linc", in_place)
+        sp.set(bytes=len(base))
+        return base
+
+# Identifies the base image for golden image lookups.
+def base_image_key(base: memoryview):
+    import hashlib # Only needed for golden images and the build cache.
+    return hashlib.sha256(base).hexdigest()
+
+# Create an output image holding the base image with overlays (see cpmedia.create_dial_media) in place, reflinking it from a golden copy if enabled.
+def create_output(path: str, base: memoryview, media: str, preserve_index: bool, base_key: str = None, overlays: dict = None):
+    if(_options.golden_dir != None):
+        if(base_key == None):
+            base_key = base_image_key(base)
+        return cpm.create_dial_media_from_golden(path, base, media, preserve_index, _options.golden_dir, base_key, _options.sparse, overlays)
+    return cpm.create_dial_media(path, base, media, preserve_index, _options.sparse, overlays)
+
+# Output files of a variant, keyed by extension.
+def variant_outputs(variant: BuildVariant):
+    outputs = {"linc": "{}.linc".format(variant.output_path)}
+    if(variant.media != "linc"):
+        outputs[variant.media] = "{}.{}".format(variant.output_path, variant.media)
+    return outputs
+
+# Build cache key for a variant, covering the input, every handler, spec and patch file it uses, and its flags.
+def variant_cache_key(cache: "bc.BuildCache", base_key: str, variant: BuildVariant):
+    import pal8
+    specfile_list, primary_handler_path, secondary_handler_path = resolve_variant(variant.media, variant.replace_first, variant.second_system, variant.enable_patches)
+    artifacts = specfile_list + [primary_handler_path]
+    if(secondary_handler_path != None):
+        artifacts.append(secondary_handler_path)
+    if(variant.enable_patches):
+        artifacts.append(wp.PATCHED_IMAGE_PATH)
+    flags = (variant.media, variant.replace_first, variant.second_system, variant.enable_patches, variant.preserve_index)
+    return cache.key(base_key, [pal8.resolve_image_path(path) if path.endswith(".bin") else path for path in artifacts], flags)
+
+# Build a variant from an already parsed input image and write both of its outputs.
+# The I/O routine blocks are built in memory and each output is written once, nothing is read back.
+# Returns True if the outputs came from the build cache.
+def build_variant(base: memoryview, variant: BuildVariant, base_key: str = None, cache: "bc.BuildCache" = None):
+    outputs = variant_outputs(variant)
+    with tracing.span("build_variant", output=variant.output_path, media=variant.media) as sp:
+        if(base_key == None and (cache != None or _options.golden_dir != None)):
+            base_key = base_image_key(base)
+        if(cache != None):
+            cache_key = variant_cache_key(cache, base_key, variant)
+            if(cache.fetch(cache_key, outputs)):
+                sp.set(cache_hit=True)
+                return True
+
+        routine_blocks = build_routine_blocks(base, variant)
+        for media, path in outputs.items():
+            with create_output(path, base, media, variant.preserve_index, base_key, {IO_ROUTINES_BLOCK: routine_blocks}):
+                pass
+
+        if(cache != None):
+            cache.store(cache_key, outputs)
+        return False
+
+# Files a variant is built from (besides the input image), mapped to the ROUTINE_REGIONS each one ends up in.
+# BIN files are listed as whichever of the BIN file or its source is actually used.
+def variant_dependencies(variant: BuildVariant):
+    import pal8
+    specfile_list, primary_handler_path, secondary_handler_path = resolve_variant(variant.media, variant.replace_first, variant.second_system, variant.enable_patches)
+    inputs = [(path, "unit_table") for path in specfile_list]
+    inputs.append((primary_handler_path, "primary_handler"))
+    if(secondary_handler_path != None):
+        inputs.append((secondary_handler_path, "secondary_handler"))
+    if(variant.enable_patches):
+        inputs.append((wp.PATCHED_IMAGE_PATH, "patches"))
+
+    dependencies = {}
+    for path, region in inputs:
+        if(path.endswith(".bin")):
+            try:
+                path = pal8.resolve_image_path(path)
+            except FileNotFoundError:
+                pass # Watched as is, the build fails until it appears.
+        dependencies.setdefault(path, set()).add(region)
+    return dependencies
+
+# Rebuild a variant's I/O routine blocks and write only the given regions of them into its existing outputs.
+# Returns False, without writing anything, if an output is missing or too short and the variant needs a full build instead.
+def patch_variant(base: memoryview, variant: BuildVariant, regions: set):
+    outputs = variant_outputs(variant)
+    if(not all(os.path.isfile(path) for path in outputs.values())):
+        return False
+    routine_blocks = build_routine_blocks(base, variant)
+
+    from mapimg import MappedImage # Only needed by --watch.
+    with tracing.span("patch_variant", output=variant.output_path, regions=",".join(sorted(regions))) as sp:
+        images = []
+        try:
+            for media, path in outputs.items():
+                image = MappedImage.open(path, True)
+                start = IO_ROUTINES_BLOCK * BYTES_PER_BLOCK
+                if(media == "linc" and len(image) >= 6):
+                    start += cpm.linc_data_range(image.view)[0]
+                images.append((image, start))
+                if(len(image) < start + len(routine_blocks)):
+                    return False
+
+            written = 0
+            for image, start in images:
+                for region in regions:
+                    for region_start, region_end in ROUTINE_REGIONS[region]:
+                        image.view[start + region_start:start + region_end] = routine_blocks[region_start:region_end]
+                        written += region_end - region_start
+            sp.set(bytes_written=written)
+        finally:
+            for image, start in images:
+                image.close()
+    return True
+
+# Parse a base LINCtape image given as a buffer or a binary file-like object.
+def load_base_image(base):
+    if(isinstance(base, (bytes, bytearray, memoryview))):
+        return cpm.parse_dial_media(base, "linc")
     try:
-        written = write_tape_block(lt_image, routine_blocks, IO_ROUTINES_BLOCK)
+        return cpm.parse_dial_media(base.read(), "linc")
     except OSError as excpt:
-        sys.exit("Failed to write handler block to {}: {}".format(out_lt_path, excpt))
-    if(written != BYTES_PER_BLOCK * 2):
-        sys.exit("Failed to write entire handler block to {}.".format(out_lt_path))
+        raise ArtifactError("Failed to read input image: {}".format(excpt))
+
+# Build the images for a configuration entirely in memory.
+# base is a LINCtape image as a buffer or binary file-like object.
+# Returns the images keyed by media type ("linc" and the requested media type), unless sinks is provided;
+# sinks maps media types to binary file-like objects the images are written to instead, images without a sink aren't produced.
+# Raises ConfigError, FormatError, or ArtifactError (all DialErrors) on failure.
+def build_image(base, media: str, replace_first: str = None, second_system: bool = False, enable_patches: bool = False, preserve_index: bool = False, sinks: dict = None):
+    if(not media_type_valid(media)):
+        raise ConfigError("Invalid media type: {}".format(media))
+    variant = BuildVariant("", media, replace_first, second_system, enable_patches, preserve_index)
+    base = load_base_image(base)
+    routine_blocks = build_routine_blocks(base, variant)
+
+    images = {}
+    for image_media in variant_outputs(variant):
+        chunks = cpm.iter_dial_media(base, image_media, preserve_index, {IO_ROUTINES_BLOCK: routine_blocks})
+        if(sinks == None):
+            images[image_media] = b"".join(chunks)
+        elif(image_media in sinks):
+            try:
+                for chunk in chunks:
+                    sinks[image_media].write(chunk)
+            except OSError as excpt:
+                raise ArtifactError("Failed to write {} image: {}".format(image_media, excpt))
+    return images
 
-    # ...and finally, create a copy of our targetted media type.
+# Per-worker input image for process pool builds.
+_worker_base = None
+_worker_base_key = None
+_worker_cache = None
+
+def _init_worker(base: bytes, options: BuildOptions):
+    global _worker_base, _worker_base_key, _worker_cache, _options
+    _worker_base = base
+    _options = options
+    _worker_cache = options.open_cache()
+    _worker_base_key = None
+    if(options.golden_dir != None or options.cache_dir != None):
+        _worker_base_key = base_image_key(base)
+
+# Returns (error, cache_hit).
+def _build_worker(variant: BuildVariant):
     try:
-        cpm.copy_dial_media(out_alt_path, lt_image, "linc", media_type, preserve_index)
-    except OSError as excpt:
-        sys.exit("Failed to copy LINCtape image '{}' to {} image '{}': {}".format(parsed.out_lt_path, secondary_type, out_alt_path, excpt))
+        return None, build_variant(_worker_base, variant, _worker_base_key, _worker_cache)
+    except (OSError, ValueError, KeyError) as excpt:
+        return str(excpt), False
+
+# Build every variant from a single parsed input, optionally across a process pool.
+# Returns a list of (variant, error) pairs for failed builds.
+def build_batch(base: memoryview, variants: list, jobs: int = 1):
+    if(jobs <= 1):
+        _init_worker(base, _options)
+        results = [_build_worker(variant) for variant in variants]
+    else:
+        from concurrent.futures import ProcessPoolExecutor # Slow to import, only loaded for parallel builds.
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(bytes(base), _options)) as pool:
+            results = list(pool.map(_build_worker, variants))
+
+    cache = _options.open_cache()
+    if(cache != None):
+        cache.hits = sum(1 for error, hit in results if hit)
+        cache.misses = sum(1 for error, hit in results if error == None and not hit)
+        cache.save_stats()
+        cache.evict()
+    return [(variant, error) for variant, (error, hit) in zip(variants, results) if error != None]
+
+# Rebuild variants whenever one of the files they're built from changes, until interrupted.
+# Variants affected by a changed handler, unit specification or patch image only have those regions of their existing outputs rewritten;
+# a changed input image (or a variant without outputs) is built in full.
+def watch_builds(base: memoryview, input_path: str, variants: list, jobs: int = 1, poll_interval: float = 0.5):
+    import fswatch # Only needed for --watch.
+    dependencies = {}
+    for variant in variants:
+        try:
+            dependencies[variant.output_path] = variant_dependencies(variant)
+        except DialError:
+            dependencies[variant.output_path] = {} # Invalid configurations never build, whatever changes.
+    paths = {input_path}.union(*dependencies.values())
+    output_paths = [path for variant in variants for path in variant_outputs(variant).values()]
+
+    with fswatch.FileWatcher(paths, poll_interval) as watcher:
+        print("Watching {} files for changes ({}), press Ctrl-C to stop.".format(len(paths), watcher.backend))
+        while(True):
+            try:
+                changed = watcher.wait()
+            except KeyboardInterrupt:
+                return
+            start = time.perf_counter()
+            with tracing.span("watch_rebuild", changed=len(changed)) as sp:
+                if(input_path in changed):
+                    try:
+                        base = read_base_image(input_path, output_paths)
+                    except (OSError, ValueError) as excpt:
+                        print("Failed to read input image '{}': {}".format(input_path, excpt), file=sys.stderr)
+                        continue
+                    affected = [(variant, None) for variant in variants]
+                else:
+                    affected = []
+                    for variant in variants:
+                        regions = set().union(*(regions for path, regions in dependencies[variant.output_path].items() if path in changed))
+                        if(len(regions) != 0):
+                            affected.append((variant, regions))
+
+                failed = []
+                full = [variant for variant, regions in affected if regions == None]
+                for variant, regions in affected:
+                    if(regions == None):
+                        continue
+                    try:
+                        if(not patch_variant(base, variant, regions)):
+                            full.append(variant)
+                    except (OSError, ValueError, KeyError) as excpt:
+                        failed.append((variant, str(excpt)))
+                if(len(full) != 0):
+                    failed += build_batch(base, full, jobs)
+                sp.set(variants=len(affected), full_builds=len(full), failed=len(failed))
+
+            for variant, error in failed:
+                print("Failed to build '{}': {}".format(variant.output_path, error), file=sys.stderr)
+            print("{} changed: updated {} of {} variants ({} rebuilt in full) in {:.0f} ms.".format(
+                ", ".join(sorted(changed)), len(affected) - len(failed), len(variants), len(full), (time.perf_counter() - start) * 1000))
+
+# Parse a batch manifest: one variant per row as OUTPUT_PATH,MEDIA[,REPLACE_FIRST[,FLAGS]].
+# FLAGS is any combination of the single letter options d, s and p.
+def parse_manifest(fp):
+    import csv
+    variants = []
+    for row in csv.reader(fp):
+        if(len(row) == 0 or row[0].startswith("#")):
+            continue
+        if(len(row) < 2):
+            raise FormatError("Manifest row {} contains fewer than 2 values".format(len(variants)))
+        replace_first = row[2] if len(row) > 2 and row[2] != "" else None
+        flags = row[3] if len(row) > 3 else ""
+        if(not media_type_valid(row[1])):
+            raise FormatError("Invalid media type: {}".format(row[1]))
+        if(any(flag not in "dsp" for flag in flags)):
+            raise FormatError("Invalid flags for '{}': {}".format(row[0], flags))
+        variants.append(BuildVariant(row[0], row[1], replace_first, "s" in flags, "p" in flags, "d" in flags))
+    return variants
+
+# Expand every combination of media type, primary handler, patches and system device.
+# Combinations that can't be built (e.g. a LINCtape as the system device with no secondary device) are left out.
+def expand_matrix(output_prefix: str, media_types: list, replace_types: list, preserve_index: bool):
+    variants = []
+    for media, replace_first, patch_enb, second_system in itertools.product(media_types, [None] + replace_types, [False, True], [False, True]):
+        try:
+            resolve_variant(media, replace_first, second_system, patch_enb)
+        except ConfigError:
+            continue
+        name = "{}-{}".format(output_prefix, media)
+        if(replace_first != None):
+            name += "-r{}".format(replace_first)
+        if(patch_enb):
+            name += "-p"
+        if(second_system):
+            name += "-s"
+        variants.append(BuildVariant(name, media, replace_first, second_system, patch_enb, preserve_index))
+    return variants
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='dial-image-builder', description='Build new DIAL-MS images from a base DIAL-MS LINCtape image.')
+    parser.add_argument("-o", "--output-path", help="Output path excluding file extension, used for both the output LINCtape and output $MEDIA images. Used as the output prefix with --matrix.")
+    parser.add_argument("-i", "--input-path", help="Input LINCtape image path.")
+    parser.add_argument("-m", "--media", nargs="+", choices=VALID_MEDIA_TYPES, help="Media type. Several may be given with --matrix.")
+    parser.add_argument("-d", "--preserve-index", action="store_const", const=True, help="Preserve the DIAL file index; if not set (default), the index and entire file area are zeroed in both output images.")
+    parser.add_argument("--replace-first", nargs="+", choices=VALID_MEDIA_TYPES, help="Replace the default LINCtape handler with a different handler. Several may be given with --matrix.")
+    parser.add_argument("-s", "--second-system", action="store_const", const=True, help="Configure system units to use the secondary device handler.")
+    parser.add_argument("-p", "--enable-patches", action="store_const", const=True, help="Apply patches to allow rebooting DIAL-MS without the use of any LINCtape instructions.")
+    parser.add_argument("-b", "--batch", help="Build every variant listed in a CSV manifest (OUTPUT_PATH,MEDIA[,REPLACE_FIRST[,FLAGS]]) from a single read of the input.")
+    parser.add_argument("--matrix", action="store_const", const=True, help="Build every combination of the given media types, primary handlers (plus the default), patches and system device.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes to use for --batch and --matrix builds.")
+    parser.add_argument("--core-cache", help="Directory used to cache decoded handler and patch BIN images between runs.")
+    parser.add_argument("--golden-cache", help="Directory used to cache unmodified base images, outputs are reflinked from these when the filesystem supports it.")
+    parser.add_argument("--sparse", action="store_const", const=True, help="Leave all-zero blocks as holes in the output images instead of writing them.")
+    parser.add_argument("--cache", help="Build cache directory; builds with identical inputs are copied from the cache instead of rebuilt.")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Build cache size limit in MiB (default 1024).")
+    parser.add_argument("--cache-hardlink", action="store_const", const=True, help="Allow hardlinking outputs to the build cache. Outputs must then never be modified in place.")
+    parser.add_argument("--cache-stats", action="store_const", const=True, help="Report build cache statistics.")
+    parser.add_argument("--watch", action="store_const", const=True, help="After building, keep watching the input image, handlers, unit specifications and patch image, updating the outputs that depend on whatever changes.")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="Seconds between checks for changes with --watch where inotify isn't available (default 0.5).")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+    global _options
+    _options = BuildOptions(parsed.core_cache, parsed.golden_cache, parsed.sparse != None, parsed.cache, parsed.cache_size * 0x100000, parsed.cache_hardlink != None)
+
+    if(parsed.cache_stats != None and parsed.cache == None):
+        parser.error("--cache-stats requires --cache")
+    if(parsed.watch != None and parsed.cache_hardlink != None):
+        parser.error("--watch updates outputs in place, so it can't be used with --cache-hardlink")
+    if(parsed.input_path == None):
+        if(parsed.cache_stats != None):
+            print(_options.open_cache().report())
+            sys.exit(0)
+        parser.error("the following arguments are required: -i/--input-path")
+
+    # Batch and matrix builds share a single parsed input image.
+    if(parsed.batch != None or parsed.matrix != None):
+        if(parsed.batch != None and parsed.matrix != None):
+            parser.error("--batch and --matrix are mutually exclusive")
+        if(parsed.batch != None):
+            try:
+                with open_file(parsed.batch, "r") as fp:
+                    variants = parse_manifest(fp)
+            except ValueError as excpt:
+                sys.exit("Batch manifest '{}' is improperly formatted: {}".format(parsed.batch, excpt))
+        else:
+            if(parsed.output_path == None or parsed.media == None):
+                parser.error("--matrix requires --output-path and --media")
+            variants = expand_matrix(parsed.output_path, parsed.media, parsed.replace_first or [], parsed.preserve_index != None)
+
+        output_paths = ["{}.{}".format(variant.output_path, ext) for variant in variants for ext in ("linc", variant.media)]
+        try:
+            base = read_base_image(parsed.input_path, output_paths)
+        except ValueError as excpt:
+            sys.exit("Input image '{}' is improperly formatted: {}".format(parsed.input_path, excpt))
+
+        with tracing.span("build_batch", variants=len(variants), jobs=parsed.jobs):
+            failed = build_batch(base, variants, parsed.jobs)
+        for variant, error in failed:
+            print("Failed to build '{}': {}".format(variant.output_path, error), file=sys.stderr)
+        print("Built {} of {} variants.".format(len(variants) - len(failed), len(variants)))
+        if(parsed.cache_stats != None):
+            print(_options.open_cache().report())
+        if(parsed.watch != None):
+            watch_builds(base, parsed.input_path, variants, parsed.jobs, parsed.poll_interval)
+        sys.exit(1 if len(failed) != 0 else 0)
+
+    if(parsed.output_path == None or parsed.media == None):
+        parser.error("the following arguments are required: -o/--output-path, -m/--media")
+    if(len(parsed.media) != 1 or len(parsed.replace_first or []) > 1):
+        parser.error("multiple media types require --matrix")
+
+    # Parse the input once, then write each output in a single pass straight from it with the new I/O routine blocks in place.
+    variant = BuildVariant(parsed.output_path, parsed.media[0], parsed.replace_first[0] if parsed.replace_first != None else None, parsed.second_system != None, parsed.enable_patches != None, parsed.preserve_index != None)
+    outputs = variant_outputs(variant)
+    try:
+        base = read_base_image(parsed.input_path, list(outputs.values()))
     except ValueError as excpt:
-        sys.exit("LINCtape image '{}' is improperly formatted: {}".format(parsed.out_lt_path, excpt))
+        sys.exit("Input image '{}' is improperly formatted: {}".format(parsed.input_path, excpt))
+
+    cache = _options.open_cache()
+    try:
+        build_variant(base, variant, cache=cache)
+    except DialError:
+        raise
+    except OSError as excpt:
+        sys.exit("Failed to write output images '{}': {}".format("', '".join(outputs.values()), excpt))
+
+    if(cache != None):
+        cache.save_stats()
+        cache.evict()
+        if(parsed.cache_stats != None):
+            print(cache.report())
+    if(parsed.watch != None):
+        watch_builds(base, parsed.input_path, [variant], poll_interval=parsed.poll_interval)
 
-    lt_image.close()
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
@@ -0,0 +1,191 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import cpmedia as cpm
+import imgfmt
+import tracing
+from cmn import *
+
+# Extensions stripped from input names before the output media type's is added.
+_IMAGE_EXTENSIONS = set(["." + media for media in VALID_MEDIA_TYPES] + [".dsk", ".img", ".tap"])
+
+class ConversionJob:
+    def __init__(self, input_path: str, output_path: str):
+        self.input_path = input_path
+        self.output_path = output_path
+
+class ConversionResult:
+    def __init__(self, input_path: str, output_path: str):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.error = None
+        self.in_size = 0
+        self.out_size = 0
+        self.seconds = 0.0
+
+# Output name for an input image, relative to the output directory.
+def output_name(rel_path: str, out_media_type: str, compression: str):
+    stem = rel_path
+    while(True):
+        base, ext = os.path.splitext(stem)
+        if(ext not in _IMAGE_EXTENSIONS and ext not in cpm.COMPRESSION_EXTENSIONS):
+            break
+        stem = base
+    name = "{}.{}".format(stem, out_media_type)
+    if(compression != None):
+        name += compression
+    return name
+
+# Expand directories (recursively) and globs into conversion jobs.
+# Outputs keep their path relative to the directory they were found in.
+def find_images(inputs: list, output_dir: str, out_media_type: str, pattern: str, compression: str):
+    jobs = []
+    seen = set()
+    for entry in inputs:
+        if(os.path.isdir(entry)):
+            found = [(path, os.path.relpath(path, entry)) for path in glob.glob(os.path.join(glob.escape(entry), "**", pattern), recursive=True)]
+        else:
+            found = [(path, os.path.basename(path)) for path in glob.glob(entry, recursive=True)]
+            if(len(found) == 0):
+                raise ArtifactError("No images match '{}'".format(entry))
+        for path, rel_path in sorted(found):
+            if(not os.path.isfile(path) or os.path.realpath(path) in seen):
+                continue
+            seen.add(os.path.realpath(path))
+            jobs.append(ConversionJob(path, os.path.join(output_dir, output_name(rel_path, out_media_type, compression))))
+    return jobs
+
+def convert_one(job: ConversionJob, in_media_type: str, out_media_type: str, copy_index: bool, sparse: bool, in_format: str = "raw16", out_format: str = "raw16"):
+    result = ConversionResult(job.input_path, job.output_path)
+    start = time.perf_counter()
+    try:
+        result.in_size = os.path.getsize(job.input_path)
+        os.makedirs(os.path.dirname(job.output_path) or ".", exist_ok=True)
+        # convert_dial_media only puts the output in place once it's complete.
+        with tracing.span("convert_one", path=job.input_path, bytes_read=result.in_size) as sp:
+            result.out_size = cpm.convert_dial_media(job.output_path, job.input_path, in_media_type, out_media_type, copy_index, sparse, in_format, out_format)
+            sp.set(bytes_written=result.out_size)
+    except (OSError, ValueError) as excpt:
+        result.error = str(excpt)
+    result.seconds = time.perf_counter() - start
+    return result
+
+# The progress journal records every finished conversion as a line of JSON.
+# Conversions are skipped when resuming if they succeeded before, their input hasn't changed since, and their output still exists.
+def _input_stamp(path: str):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def load_journal(path: str):
+    done = {}
+    try:
+        with open(path, "r") as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # Partially written last line of an interrupted run.
+                if(entry.get("error") == None):
+                    done[entry["input"]] = entry
+                else:
+                    done.pop(entry["input"], None)
+    except FileNotFoundError:
+        pass
+    except OSError as excpt:
+        raise ArtifactError("Failed to read journal '{}': {}".format(path, excpt))
+    return done
+
+def already_done(job: ConversionJob, journal: dict):
+    entry = journal.get(os.path.abspath(job.input_path))
+    try:
+        return entry != None and entry["output"] == os.path.abspath(job.output_path) and entry["stamp"] == _input_stamp(job.input_path) and os.path.exists(job.output_path)
+    except OSError:
+        return False
+
+def journal_entry(result: ConversionResult):
+    entry = {"input": os.path.abspath(result.input_path), "output": os.path.abspath(result.output_path), "error": result.error}
+    if(result.error == None):
+        entry["stamp"] = _input_stamp(result.input_path)
+    return json.dumps(entry)
+
+# Convert every job across a pool of threads (or processes), reporting each result as it finishes.
+# Returns the results of every conversion that was run.
+def convert_all(jobs: list, in_media_type: str, out_media_type: str, copy_index: bool, sparse: bool, workers: int, processes: bool, journal_fp, quiet: bool, in_format: str = "raw16", out_format: str = "raw16"):
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed # Slow to import, only loaded once there's work.
+    results = []
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor(max_workers=workers) as pool:
+        futures = [pool.submit(convert_one, job, in_media_type, out_media_type, copy_index, sparse, in_format, out_format) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if(journal_fp != None):
+                journal_fp.write(journal_entry(result) + "\n")
+                journal_fp.flush()
+            if(result.error != None):
+                print("FAIL {}: {}".format(result.input_path, result.error), file=sys.stderr)
+            elif(not quiet):
+                print("ok   {} -> {} ({:.1f} ms)".format(result.input_path, result.output_path, result.seconds * 1000))
+    return results
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='DIAL-MS Bulk Media Copier', description='Copy every DIAL-MS image in directories or globs from one image type to another.')
+    parser.add_argument("inputs", nargs="+", help="Input image directories (searched recursively) or globs.")
+    parser.add_argument("-o", "--output-dir", required=True, help="Output directory, images keep their path relative to the input directory they were found in.")
+    parser.add_argument("-m", "--input-media", required=True, help="Input media type.", choices=VALID_MEDIA_TYPES)
+    parser.add_argument("-n", "--output-media", required=True, help="Output media type.", choices=VALID_MEDIA_TYPES)
+    parser.add_argument("-d", "--preserve-index", action="store_const", const=True, help="Preserve the DIAL file index; if not set (default), the index and entire file area are zeroed in the output images.")
+    parser.add_argument("--sparse", action="store_const", const=True, help="Leave all-zero blocks as holes in the output images instead of writing them.")
+    parser.add_argument("--input-format", default="raw16", choices=list(imgfmt.IMAGE_FORMATS), help="Format the input images are stored in (default raw16).")
+    parser.add_argument("--output-format", default="raw16", choices=list(imgfmt.IMAGE_FORMATS), help="Format to store the output images in (default raw16).")
+    parser.add_argument("--pattern", default="*", help="Only convert files in input directories matching this glob (default *).")
+    parser.add_argument("--compress", choices=sorted(cpm.COMPRESSION_EXTENSIONS), help="Compress output images, adding the given extension to their names.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of images converted at once (default is the number of CPUs).")
+    parser.add_argument("--processes", action="store_const", const=True, help="Convert in worker processes rather than threads; useful when converting compressed images.")
+    parser.add_argument("--journal", help="Progress journal path (default OUTPUT_DIR/.bulkcp-journal).")
+    parser.add_argument("--restart", action="store_const", const=True, help="Ignore the progress journal and convert every image again.")
+    parser.add_argument("-q", "--quiet", action="store_const", const=True, help="Only report failures and the summary.")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+
+    jobs = find_images(parsed.inputs, parsed.output_dir, parsed.output_media, parsed.pattern, parsed.compress)
+
+    # Skip anything converted by an earlier run.
+    journal_path = parsed.journal or os.path.join(parsed.output_dir, ".bulkcp-journal")
+    journal = {} if parsed.restart != None else load_journal(journal_path)
+    pending = [job for job in jobs if not already_done(job, journal)]
+    skipped = len(jobs) - len(pending)
+
+    try:
+        os.makedirs(os.path.dirname(journal_path) or ".", exist_ok=True)
+        journal_fp = open(journal_path, "w" if parsed.restart != None else "a")
+    except OSError as excpt:
+        raise ArtifactError("Failed to open journal '{}': {}".format(journal_path, excpt))
+
+    start = time.perf_counter()
+    with journal_fp:
+        results = convert_all(pending, parsed.input_media, parsed.output_media, parsed.preserve_index != None, parsed.sparse != None, max(1, parsed.jobs), parsed.processes != None, journal_fp, parsed.quiet != None, parsed.input_format, parsed.output_format)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    # Summary.
+    failed = [result for result in results if result.error != None]
+    converted = len(results) - len(failed)
+    in_bytes = sum(result.in_size for result in results if result.error == None)
+    out_bytes = sum(result.out_size for result in results if result.error == None)
+    print("Converted {} of {} images ({} already done, {} failed) in {:.2f} s".format(converted, len(jobs), skipped, len(failed), elapsed))
+    print("{:.1f} files/s, {:.1f} MB/s read, {:.1f} MB/s written".format(converted / elapsed, in_bytes / elapsed / 1e6, out_bytes / elapsed / 1e6))
+    if(len(failed) != 0):
+        print("Failed:", file=sys.stderr)
+        for result in failed:
+            print("  {}: {}".format(result.input_path, result.error), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
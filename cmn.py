@@ -1,5 +1,4 @@
 import sys
-from dataclasses import dataclass
 
 BYTES_PER_WORD = 2
 WORDS_PER_BLOCK = 0o400
@@ -29,6 +28,23 @@ VALID_MEDIA_TYPES = [
     'sdsk',
 ]
 
+# Errors raised by the DIAL-MS image tools.
+# The command line tools report these and exit, everything else lets them propagate to the caller.
+class DialError(Exception):
+    pass
+
+# A file couldn't be opened, read, or written.
+class ArtifactError(DialError, OSError):
+    pass
+
+# An image, handler, unit specification, or manifest is improperly formatted.
+class FormatError(DialError, ValueError):
+    pass
+
+# The requested build configuration isn't possible.
+class ConfigError(DialError, ValueError):
+    pass
+
 def media_type_valid(media_type: str) -> bool:
     for mtype in VALID_MEDIA_TYPES:
         if(media_type == mtype):
@@ -46,7 +62,7 @@ def open_file(path: str, mode: str):
     try:
         return open(path, mode)
     except OSError as excpt:
-        sys.exit("Failed to open file '{}': {}".format(path, excpt))
+        raise ArtifactError("Failed to open file '{}': {}".format(path, excpt))
 
 def copy_open_file(out_path: str, in_path: str, mode: str):
     # Read input file.
@@ -54,27 +70,27 @@ def copy_open_file(out_path: str, in_path: str, mode: str):
         with open(in_path, "rb") as fp:
             data = fp.read()
     except OSError as excpt:
-        sys.exit("Failed to read input file '{}': {}".format(in_path, excpt))
+        raise ArtifactError("Failed to read input file '{}': {}".format(in_path, excpt))
 
     # Create the copy.
     try:
         with open(out_path, "wb") as fp:
             fp.write(data)
     except OSError as excpt:
-        sys.exit("Faild to write output file '{}': {}".format(out_path, excpt))
+        raise ArtifactError("Faild to write output file '{}': {}".format(out_path, excpt))
 
     # Open it as the user wishes.
     try:
         return open(out_path, mode)
     except OSError as excpt:
-        sys.exit("Failed to open output file '{}' after copy: {}".format(out_path, excpt))
+        raise ArtifactError("Failed to open output file '{}' after copy: {}".format(out_path, excpt))
 
 def read_file_oneshot(path: str, mode: str):
     with open_file(path, mode) as fp:
         try:
             return fp.read()
         except OSError as excpt:
-            sys.exit("Failed to read file '{}': {}".format(path, excpt))
+            raise ArtifactError("Failed to read file '{}': {}".format(path, excpt))
 
 def read_handler_image_oneshot(path: str):
     with open_file(path, "rb") as fp:
@@ -82,10 +98,10 @@ def read_handler_image_oneshot(path: str):
             fp.seek(0o230 * BYTES_PER_WORD, 0)
             read = fp.read(0o150 * BYTES_PER_WORD)
             if(len(read) != 0o150 * BYTES_PER_WORD):
-                sys.exit("Failed to read entire handler from '{}'".format(path))
+                raise FormatError("Failed to read entire handler from '{}'".format(path))
             return read
-        except Exception as excpt:
-            sys.exit("Failed to read handler image from '{}': {}".format(path, excpt))
+        except OSError as excpt:
+            raise ArtifactError("Failed to read handler image from '{}': {}".format(path, excpt))
 
 def read_tape_block(tape_image, start: int, num: int = 1):
     data = bytearray(num * BYTES_PER_BLOCK)
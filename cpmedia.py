@@ -1,15 +1,21 @@
 import argparse
-import sys
-import struct
+import io
+import mmap
 import os
+import struct
+import sys
 
 from cmn import *
 
-@dataclass
+# Every tool imports cpmedia, so mapimg, imgfmt and tracing are only imported by the functions that use them.
+
+_ZERO_BLOCK = bytes(BYTES_PER_BLOCK)
+
 class MediaAttributes:
-    block_count: int
-    block_size: int
-    sides: int
+    def __init__(self, block_count: int, block_size: int, sides: int):
+        self.block_count = block_count
+        self.block_size = block_size
+        self.sides = sides
 
 MEDIA_ATTRIBUTES = {
     'linc': MediaAttributes(512, 256, 1), #Usually
@@ -19,107 +25,577 @@ MEDIA_ATTRIBUTES = {
     'sdsk': MediaAttributes(3248, 256, 2),  # Uses rk05 DSK format
 }
 
-def _erase_data_range(image: bytearray, start: int, end: int):
-    zero_block = bytearray(BYTES_PER_BLOCK)
-    for i in range(start * BYTES_PER_BLOCK, end * BYTES_PER_BLOCK, BYTES_PER_BLOCK):
-        image[i:i+BYTES_PER_BLOCK] = zero_block
+# Size in bytes of each media type, worked out once rather than on every copy.
+MEDIA_SIZES = {media: attribs.block_count * attribs.block_size * attribs.sides * BYTES_PER_WORD for media, attribs in MEDIA_ATTRIBUTES.items()}
 
-def copy_dial_media(out_path: str, in_image, in_media_type: str, out_media_type: str, copy_index: bool):
-    assert(out_path != None and out_path != "")
-    assert(in_image != None)
-    assert(media_type_valid(in_media_type))
-    assert(media_type_valid(out_media_type))
+# Blocks that are zeroed when the DIAL index and file areas aren't preserved.
+ERASED_RANGES = [
+    (0, 0o300),
+    (0o346, 0o350), #not including 350
+    (0o370, None),  # Through the end of the image.
+]
+
+def _erase_data_range(image, start: int, end: int):
+    from mapimg import MappedImage
+    if(isinstance(image, MappedImage)):
+        image.erase(start, end)
+    else:
+        end = min(end, len(image) // BYTES_PER_BLOCK)
+        if(start < end):
+            image[start * BYTES_PER_BLOCK:end * BYTES_PER_BLOCK] = bytes((end - start) * BYTES_PER_BLOCK)
+
+# Ranges of blocks (start, end) that are carried over from a source image of block_count blocks.
+def _kept_ranges(block_count: int, copy_index: bool):
+    if(copy_index):
+        return [(0, block_count)]
+
+    kept = []
+    start = 0
+    for erase_start, erase_end in ERASED_RANGES:
+        if(erase_start > start):
+            kept.append((start, min(erase_start, block_count)))
+        start = block_count if erase_end == None else erase_end
+    if(start < block_count):
+        kept.append((start, block_count))
+    return [(start, end) for start, end in kept if start < end]
+
+# Split a range of blocks into runs that contain non-zero data.
+def _nonzero_extents(data: memoryview, start: int, end: int):
+    extents = []
+    run_start = None
+    for blk in range(start, end):
+        if(data[blk * BYTES_PER_BLOCK:(blk + 1) * BYTES_PER_BLOCK] == _ZERO_BLOCK):
+            if(run_start != None):
+                extents.append((run_start, blk))
+                run_start = None
+        elif(run_start == None):
+            run_start = blk
+    if(run_start != None):
+        extents.append((run_start, end))
+    return extents
+
+# Remove the blocks covered by overlays (block number -> whole blocks of data) from a list of extents.
+def _cut_overlays(extents: list, overlays: dict):
+    for ov_start, ov_data in overlays.items():
+        ov_end = ov_start + len(ov_data) // BYTES_PER_BLOCK
+        cut = []
+        for start, end in extents:
+            if(start < ov_start):
+                cut.append((start, min(end, ov_start)))
+            if(end > ov_end):
+                cut.append((max(start, ov_end), end))
+        extents = cut
+    return extents
+
+def _map_input(in_image, copy: bool):
+    # Map the input when it's a real file, otherwise fall back to reading it into memory.
+    if(not copy):
+        try:
+            return memoryview(mmap.mmap(in_image.fileno(), 0, access=mmap.ACCESS_READ))
+        except (AttributeError, OSError, ValueError):
+            pass
 
     # Determine how large the input is and create input buffer.
     in_image.seek(0, os.SEEK_END)
-    img_size = in_image.tell()
-    if(img_size > 0x1000000):
-        # Cap at 16MiB.
-        img_size = 0x1000000
-    data = bytearray(img_size)
+    data = bytearray(in_image.tell())
+    in_image.seek(0, os.SEEK_SET)
+    in_image.readinto(data)
+    return memoryview(data)
 
-    # Read up to 16MiB of input.
-    try:
-        in_image.seek(0, os.SEEK_SET)
-        in_image.readinto(data)
-    except OSError as excpt:
-        sys.exit("Failed to read input image: {}".format(excpt))
+# Find the range of bytes (start, end) holding blocks in a LINCtape image of the given size.
+def _linc_data_range(size: int, footer: bytes):
+    # We need to deal with start & end padding.
+    # These plus block length are apparently described by the last six words.
+    blk_len, start_pad, end_pad = struct.unpack("<Hhh", footer)
 
-    # Format specific parsing.
-    if in_media_type == 'linc':
-        # We need to deal with start & end padding.
-        # These plus block length are apparently described by the last six words.
-        blk_len, start_pad, end_pad = struct.unpack_from("<HHH", data, len(data) - 6)
+    # Block length must be 256 and total image size sans the last six words should be a multiple of 256.
+    if(blk_len != 0o400):
+        raise FormatError("Input LINCtape doesn't contain 256 word blocks! {}".format(blk_len))
+    if(size % blk_len != 6):
+        raise FormatError("Input LINCtape image contains incomplete blocks!")
+
+    # Padding is stored as signed words, but negated for some reason
+    start_pad *= -1
+    end_pad *= -1
 
-        # Block length must be 256 and total image size sans the last six words should be a multiple of 256.
-        if(blk_len != 0o400):
-            sys.exit("Input LINCtape doesn't contain 256 word blocks! {}".format(blk_len))
-        if(len(data) % blk_len != 6):
-            sys.exit("Input LINCtape image contains incomplete blocks!")
+    # Trim off padding + six end words
+    start, end, _ = slice(start_pad * BYTES_PER_BLOCK, (size - 6) - end_pad * BYTES_PER_BLOCK).indices(size)
+    return start, max(start, end)
 
-        # But negated for some reason
-        start_pad *= -1
-        end_pad *= -1
+# Find the range of bytes (start, end) holding blocks in a whole LINCtape image held in a buffer.
+def linc_data_range(data):
+    if(len(data) < 6):
+        raise FormatError("Input LINCtape is missing its format information")
+    return _linc_data_range(len(data), data[len(data) - 6:])
 
-        # Trim off padding + six end words
-        data = memoryview(data)[start_pad * BYTES_PER_BLOCK:(len(data) - 6) - end_pad * BYTES_PER_BLOCK]
+# Parse an image held in a buffer, returning a view of its blocks.
+# Images stored in a format other than raw16 are decoded into a new buffer.
+def parse_dial_media(data, in_media_type: str, in_format: str = "raw16"):
+    import imgfmt
+    assert(media_type_valid(in_media_type))
+    fmt = imgfmt.get_format(in_format)
+    data = memoryview(data)
+    if(not fmt.raw()):
+        data = memoryview(imgfmt.decode_blocks(fmt, data[:min(len(data), fmt.stored_size(0x1000000))]))
+    if(len(data) > 0x1000000):
+        # Cap at 16MiB.
+        data = data[:0x1000000]
+
+    # Format specific parsing.
+    if in_media_type == 'linc' and fmt.footer:
+        start, end = linc_data_range(data)
+        data = data[start:end]
 
     # Must have blocks up to start of beginning of work area.
     block_count = int(len(data) / BYTES_PER_BLOCK)
     if(block_count < 0o370):
-        raise ValueError("Input image missing parts of system area")
+        raise FormatError("Input image missing parts of system area")
 
-    # Calculate total media size.
-    attribs = MEDIA_ATTRIBUTES[out_media_type]
-    media_size = attribs.block_count * attribs.block_size * attribs.sides * BYTES_PER_WORD
+    return data
 
-    # Are we preserving the index?
-    if(not copy_index):
-        # No, kill him.
-        _erase_data_range(data, 0, 0o300)
+# Parse an image, returning a view of its blocks.
+# The input is mapped rather than read unless copy is set.
+def read_dial_media(in_image, in_media_type: str, copy: bool = False, in_format: str = "raw16"):
+    import tracing
+    assert(in_image != None)
+    assert(media_type_valid(in_media_type))
 
-        # Again.
-        _erase_data_range(data, 0o370, block_count)
+    # Map (or read) the input.
+    with tracing.span("read_dial_media", media=in_media_type, copied=copy) as sp:
+        try:
+            data = _map_input(in_image, copy)
+        except OSError as excpt:
+            raise ArtifactError("Failed to read input image: {}".format(excpt))
+        sp.set(bytes=len(data))
+        return parse_dial_media(data, in_media_type, in_format)
 
-        # AGAIN!
-        _erase_data_range(data, 0o346, 0o350) #not including 350
+def erase_dial_index(data):
+    block_count = int(len(data) / BYTES_PER_BLOCK)
+    for start, end in ERASED_RANGES:
+        _erase_data_range(data, start, block_count if end == None else end)
 
-    # Open output file and send it.
-    with open_file(out_path, "wb") as fp:
-            # Write source image data data.
-            try:
-                fp.write(data)
-            except OSError as excpt:
-                sys.exit("Failed to media data to {}: {}".format(excpt))
+# Create a new mapped image in the given format holding the contents of data.
+# Erased blocks are never written and are left as holes in the new file.
+# If sparse is set, all-zero blocks from data are left as holes as well.
+# overlays maps a block number to whole blocks of data written in place of data's blocks from there on, so each block is only written once.
+def create_dial_media(out_path: str, data: memoryview, out_media_type: str, copy_index: bool = True, sparse: bool = False, overlays: dict = None):
+    import tracing
+    from mapimg import MappedImage
+    assert(out_path != None and out_path != "")
+    assert(media_type_valid(out_media_type))
+
+    # Calculate total media size, expanding the new image to its correct size if needed.
+    media_size = MEDIA_SIZES[out_media_type]
+    image_size = max(len(data), media_size)
+
+    # Add block size & padding information for LINCtapes
+    fmt_info = b""
+    if(out_media_type == 'linc'):
+        fmt_info = struct.pack("<HHH", WORDS_PER_BLOCK, 0, 0) # No padding
+
+    try:
+        image = MappedImage.create(out_path, image_size + len(fmt_info))
+    except OSError as excpt:
+        raise ArtifactError("Failed to open file '{}': {}".format(out_path, excpt))
+
+    # Copy over the source image data.
+    with tracing.span("create_dial_media", path=out_path, media=out_media_type) as sp:
+        extents = _kept_ranges(len(data) // BYTES_PER_BLOCK, copy_index)
+        if(sparse):
+            extents = [extent for start, end in extents for extent in _nonzero_extents(data, start, end)]
+        extents = _cut_overlays(extents, overlays or {})
+        for start, end in extents:
+            image.view[start * BYTES_PER_BLOCK:end * BYTES_PER_BLOCK] = data[start * BYTES_PER_BLOCK:end * BYTES_PER_BLOCK]
+        for ov_start, ov_data in (overlays or {}).items():
+            image.view[ov_start * BYTES_PER_BLOCK:ov_start * BYTES_PER_BLOCK + len(ov_data)] = ov_data
+        image.view[image_size:] = fmt_info
+        sp.set(extents=len(extents), bytes_written=sum(end - start for start, end in extents) * BYTES_PER_BLOCK + sum(len(ov_data) for ov_data in (overlays or {}).values()) + len(fmt_info))
+    return image
+
+# Size in bytes of an image in the given format holding data_len bytes of blocks.
+def dial_media_size(data_len: int, out_media_type: str):
+    media_size = MEDIA_SIZES[out_media_type]
+    return max(data_len, media_size) + (6 if out_media_type == 'linc' else 0)
+
+# Produce the same image as create_dial_media as a sequence of chunks, without building it in memory.
+# overlays maps a block number to whole blocks of data that replace the source image's blocks from there on.
+# Chunks are views of data, the overlays, or a shared zero buffer, and are only valid until the next one is requested.
+def iter_dial_media(data: memoryview, out_media_type: str, copy_index: bool = True, overlays: dict = None, chunk_blocks: int = 0o200):
+    assert(media_type_valid(out_media_type))
+    image_size = dial_media_size(len(data), out_media_type) - (6 if out_media_type == 'linc' else 0)
+    block_count = image_size // BYTES_PER_BLOCK
+    zeros = memoryview(bytes(chunk_blocks * BYTES_PER_BLOCK))
+
+    # Runs of blocks as (start, end, source, source block of start); source None means zeros.
+    segments = []
+    pos = 0
+    for start, end in _kept_ranges(len(data) // BYTES_PER_BLOCK, copy_index):
+        if(start > pos):
+            segments.append((pos, start, None, 0))
+        segments.append((start, end, data, start))
+        pos = end
+    if(pos < block_count):
+        segments.append((pos, block_count, None, 0))
+
+    # Cut each overlay into the runs it covers.
+    for ov_start, ov_data in sorted((overlays or {}).items()):
+        ov_end = ov_start + len(ov_data) // BYTES_PER_BLOCK
+        split = []
+        for start, end, src, src_start in segments:
+            if(end <= ov_start or start >= ov_end):
+                split.append((start, end, src, src_start))
+                continue
+            if(start < ov_start):
+                split.append((start, ov_start, src, src_start))
+            if(end > ov_end):
+                split.append((ov_end, end, src, src_start + ov_end - start))
+        split.append((ov_start, ov_end, memoryview(ov_data), 0))
+        segments = sorted(split, key=lambda segment: segment[0])
+
+    for start, end, src, src_start in segments:
+        for chunk_start in range(start, end, chunk_blocks):
+            num = min(chunk_blocks, end - chunk_start)
+            if(src == None):
+                yield zeros[:num * BYTES_PER_BLOCK]
+            else:
+                offset = (src_start + chunk_start - start) * BYTES_PER_BLOCK
+                yield src[offset:offset + num * BYTES_PER_BLOCK]
+
+    # Leftover partial block, then block size & padding information for LINCtapes.
+    if(image_size > block_count * BYTES_PER_BLOCK):
+        yield zeros[:image_size - block_count * BYTES_PER_BLOCK]
+    if(out_media_type == 'linc'):
+        yield struct.pack("<HHH", WORDS_PER_BLOCK, 0, 0) # No padding
+
+def write_dial_media(out_path: str, data: memoryview, out_media_type: str, copy_index: bool = True, sparse: bool = False):
+    with create_dial_media(out_path, data, out_media_type, copy_index, sparse):
+        pass
+
+# Create a new mapped image like create_dial_media, but as a copy-on-write clone of a cached "golden" image.
+# Golden images are unmodified conversions of data and are identified by data_key, the caller's hash of data.
+# Falls back to create_dial_media if the filesystem doesn't support reflinks.
+def create_dial_media_from_golden(out_path: str, data: memoryview, out_media_type: str, copy_index: bool, golden_dir: str, data_key: str, sparse: bool = False, overlays: dict = None):
+    import tracing
+    from mapimg import MappedImage, reflink
+    golden_path = os.path.join(golden_dir, "{}-{}.{}".format(data_key, "full" if copy_index else "erased", out_media_type))
+    if(not os.path.exists(golden_path)):
+        try:
+            os.makedirs(golden_dir, exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(golden_path, os.getpid())
+            write_dial_media(tmp_path, data, out_media_type, copy_index, True)
+            os.replace(tmp_path, golden_path)
+        except OSError:
+            return create_dial_media(out_path, data, out_media_type, copy_index, sparse, overlays)
+
+    if(os.path.exists(out_path)):
+        os.unlink(out_path)
+    if(reflink(golden_path, out_path)):
+        tracing.event("golden_reflink", "cache", path=out_path)
+        try:
+            image = MappedImage.open(out_path, True)
+        except OSError as excpt:
+            raise ArtifactError("Failed to open file '{}': {}".format(out_path, excpt))
+        for ov_start, ov_data in (overlays or {}).items():
+            image.block(ov_start, len(ov_data) // BYTES_PER_BLOCK)[:] = ov_data
+        return image
+    return create_dial_media(out_path, data, out_media_type, copy_index, sparse, overlays)
+
+# Copy an image from one format to another.
+# If keep_open is set, the new image is returned as a MappedImage for further editing.
+def copy_dial_media(out_path: str, in_image, in_media_type: str, out_media_type: str, copy_index: bool, keep_open: bool = False, sparse: bool = False):
+    assert(out_path != None and out_path != "")
+    assert(in_image != None)
+    assert(media_type_valid(in_media_type))
+    assert(media_type_valid(out_media_type))
+
+    # Read in and parse the source image.
+    # It can't be mapped if it's also the output, since creating the output truncates it.
+    try:
+        in_place = os.path.samestat(os.fstat(in_image.fileno()), os.stat(out_path))
+    except (AttributeError, OSError, ValueError):
+        in_place = False
+    data = read_dial_media(in_image, in_media_type, in_place)
+
+    # Write it out in the new format, leaving out the index and file areas unless they're being preserved.
+    image = create_dial_media(out_path, data, out_media_type, copy_index, sparse)
+    if(not keep_open):
+        image.close()
+        return None
+    return image
+
+# Compressed image formats, identified by their magic numbers and (for outputs) file extensions.
+_COMPRESSION_MAGIC = {
+    'gzip': b"\x1f\x8b",
+    'xz': b"\xfd7zXZ\x00",
+    'zstd': b"\x28\xb5\x2f\xfd",
+}
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.xz': 'xz',
+    '.zst': 'zstd',
+}
+
+# Non-seekable LINCtape inputs are spooled to a temporary file (kept in memory up to this size) to find their footer.
+SPOOL_MEMORY = 0x1000000
+
+# Compression and spooling modules are only imported once they're needed, as most copies use neither.
+def _spool(stream, chunk_size: int = BYTES_PER_BLOCK * 0o200):
+    import shutil
+    import tempfile
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+    shutil.copyfileobj(stream, spool, chunk_size)
+    spool.seek(0, os.SEEK_SET)
+    return spool
+
+# Decompression errors that aren't OSErrors, from whichever decompressors have been loaded.
+def _decompress_errors():
+    lzma = sys.modules.get("lzma")
+    return (lzma.LZMAError,) if lzma != None else ()
+
+def _zstandard():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        raise ArtifactError("zstd compressed images require the zstandard module")
+
+# Open an image for streaming, "-" being stdin (for reading) or stdout (for writing).
+# Inputs are decompressed if they're gzip, xz or zstd compressed; outputs are compressed according to their extension.
+def open_image_stream(path: str, mode: str):
+    assert(mode == "rb" or mode == "wb")
+    try:
+        if(mode == "rb"):
+            raw = sys.stdin.buffer if path == "-" else open(path, "rb")
+            if(not hasattr(raw, "peek")):
+                raw = io.BufferedReader(raw)
+            magic = raw.peek(6)[:6]
+            compression = None
+            for name, prefix in _COMPRESSION_MAGIC.items():
+                if(magic.startswith(prefix)):
+                    compression = name
+        else:
+            raw = sys.stdout.buffer if path == "-" else open(path, "wb")
+            compression = COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1])
+    except OSError as excpt:
+        raise ArtifactError("Failed to open file '{}': {}".format(path, excpt))
+
+    if(compression == 'gzip'):
+        import gzip
+        return gzip.GzipFile(fileobj=raw, mode=mode), raw
+    if(compression == 'xz'):
+        import lzma
+        return lzma.LZMAFile(raw, mode), raw
+    if(compression == 'zstd'):
+        if(mode == "rb"):
+            return _zstandard().ZstdDecompressor().stream_reader(raw, closefd=False), raw
+        return _zstandard().ZstdCompressor().stream_writer(raw, closefd=False), raw
+    return raw, raw
+
+# Read until buff is full or the stream ends, returning the number of bytes read.
+def _read_full(stream, buff: memoryview):
+    total = 0
+    while(total < len(buff)):
+        count = stream.readinto(buff[total:])
+        if(not count):
+            break
+        total += count
+    return total
+
+# Whether a stream is a plain file that can be cheaply seeked.
+def _plain_seekable(stream):
+    plain = (io.BufferedReader, io.BufferedWriter, io.BufferedRandom, io.FileIO, io.BytesIO)
+    tempfile = sys.modules.get("tempfile") # Spools only exist once it's been imported.
+    if(tempfile != None):
+        plain += (tempfile.SpooledTemporaryFile,)
+    return isinstance(stream, plain) and stream.seekable()
+
+# Read an image block by block, yielding (block number, data) for each chunk of up to chunk_blocks blocks.
+# The LINCtape footer and padding are dealt with like read_dial_media, but there's no limit on the image size.
+# Data is a view of a buffer that's reused for the next chunk, and the final chunk may end with a partial block.
+# Inputs missing part of the system area (blocks 0-0367) raise FormatError before the first chunk.
+# Images stored in a format other than raw16 are decoded as they're read, and must only contain whole blocks.
+def iter_dial_blocks(stream, in_media_type: str, chunk_blocks: int = 0o200, in_format: str = "raw16"):
+    import imgfmt
+    assert(media_type_valid(in_media_type))
+    fmt = imgfmt.get_format(in_format)
+    remaining = None
+    try:
+        if(in_media_type == 'linc' and fmt.footer):
+            # The footer comes last, so inputs we can't seek around in are spooled first.
+            if(not _plain_seekable(stream)):
+                stream = _spool(stream, BYTES_PER_BLOCK * chunk_blocks)
+            size = stream.seek(0, os.SEEK_END)
+            if(size < 6):
+                raise FormatError("Input LINCtape is missing its format information")
+            stream.seek(size - 6, os.SEEK_SET)
+            start, end = _linc_data_range(size, stream.read(6))
+            stream.seek(start, os.SEEK_SET)
+            remaining = end - start
+            if(remaining // BYTES_PER_BLOCK < 0o370):
+                raise FormatError("Input image missing parts of system area")
+
+        buff = memoryview(bytearray(fmt.block_size() * chunk_blocks))
+        block = 0
+        if(remaining == None):
+            # Without a known size, the whole system area is read before any of it is handed out, so a truncated
+            # input fails before anything has been written.
+            head = memoryview(bytearray(fmt.block_size() * 0o370))
+            if(_read_full(stream, head) < len(head)):
+                raise FormatError("Input image missing parts of system area")
+            for offset in range(0, len(head), len(buff)):
+                data = imgfmt.decode_blocks(fmt, head[offset:offset + len(buff)], block)
+                yield block, data
+                block += len(data) // BYTES_PER_BLOCK
+        while(remaining == None or remaining > 0):
+            want = len(buff) if remaining == None else min(len(buff), remaining)
+            count = _read_full(stream, buff[:want])
+            if(count == 0):
+                break
+            if(remaining != None):
+                remaining -= count
+            data = imgfmt.decode_blocks(fmt, buff[:count], block)
+            yield block, data
+            block += len(data) // BYTES_PER_BLOCK
+            if(count < want):
+                break
+    except (OSError, EOFError) as excpt:
+        raise ArtifactError("Failed to read input image: {}".format(excpt))
+    except _decompress_errors() as excpt:
+        raise FormatError("Failed to decompress input image: {}".format(excpt))
+
+# Convert an image from one format to another a chunk at a time, using a constant amount of memory.
+# When the output is a plain file, erased and padding blocks are skipped over rather than written, as are all-zero blocks if sparse is set.
+# in_format and out_format are the formats (see imgfmt) the images are stored in, blocks are decoded and encoded on the way through.
+# Returns the size of the new image.
+def stream_dial_media(out_stream, in_stream, in_media_type: str, out_media_type: str, copy_index: bool, sparse: bool = False, chunk_blocks: int = 0o200, in_format: str = "raw16", out_format: str = "raw16"):
+    import imgfmt
+    import tracing
+    assert(media_type_valid(out_media_type))
+    fmt = imgfmt.get_format(out_format)
+    media_size = MEDIA_SIZES[out_media_type]
+    # Blocks with headers are never all zero, so they can't be skipped.
+    can_skip = _plain_seekable(out_stream) and fmt.header_words == 0
+    zeros = bytes(BYTES_PER_BLOCK * chunk_blocks)
+    size = 0
+    stored_size = 0
+
+    def write(data, erased: bool):
+        nonlocal size, stored_size
+        length = fmt.stored_size(len(data))
+        if(can_skip and (erased or sparse and data == zeros[:len(data)])):
+            out_stream.seek(length, os.SEEK_CUR)
+            sp.add("bytes_skipped", length)
+        else:
+            out_stream.write(imgfmt.encode_blocks(fmt, data, size // BYTES_PER_BLOCK))
+        size += len(data) if fmt.raw() else length // fmt.block_size() * BYTES_PER_BLOCK
+        stored_size += length
+
+    with tracing.span("stream_dial_media", media=out_media_type, format=out_format) as sp:
+        try:
+            for block, data in iter_dial_blocks(in_stream, in_media_type, chunk_blocks, in_format):
+                # Partial blocks are never copied, only accounted for.
+                full = len(data) - len(data) % BYTES_PER_BLOCK
+                count = full // BYTES_PER_BLOCK
+                ranges = _kept_ranges(block + count, copy_index)
+
+                pos = 0
+                for start, end in ranges:
+                    start = max(start - block, 0)
+                    end = end - block
+                    if(end <= start):
+                        continue
+                    if(start > pos):
+                        write(zeros[:(start - pos) * BYTES_PER_BLOCK], True)
+                    if(sparse and can_skip):
+                        for blk in range(start, end):
+                            write(data[blk * BYTES_PER_BLOCK:(blk + 1) * BYTES_PER_BLOCK], False)
+                    else:
+                        write(data[start * BYTES_PER_BLOCK:end * BYTES_PER_BLOCK], False)
+                    pos = end
+                if(pos < count):
+                    write(zeros[:(count - pos) * BYTES_PER_BLOCK], True)
+                if(full < len(data)):
+                    write(zeros[:len(data) - full], True)
 
             # Expand the new image to its correct size if needed.
-            if(fp.tell() < media_size):
-                try:
-                    fp.seek(media_size - 1)
-                    fp.write(bytes(1))
-                except OSError as excpt:
-                    sys.exit("Failed to expand image '{}': {}".format(out_path, excpt))
+            while(size < media_size):
+                write(zeros[:min(len(zeros), media_size - size)], True)
 
             # Add block size & padding information for LINCtapes
-            if(out_media_type == 'linc'):
-                fmt_info = struct.pack("<HHH", WORDS_PER_BLOCK, 0, 0) # No padding
-                try:
-                    fp.write(fmt_info)
-                except OSError as excpt:
-                    sys.exit("Failed to write LINCtape block and padding information to '{}': {}".format(out_path, excpt))
+            if(out_media_type == 'linc' and fmt.footer):
+                out_stream.write(struct.pack("<HHH", WORDS_PER_BLOCK, 0, 0)) # No padding
+                stored_size += 6
+            if(can_skip):
+                out_stream.truncate(stored_size)
+            out_stream.flush()
+        except DialError:
+            raise
+        except OSError as excpt:
+            raise ArtifactError("Failed to write output image: {}".format(excpt))
+        sp.set(bytes_written=stored_size)
+    return stored_size
 
+# Convert the image at in_path to a new image at out_path, either of which may be "-" for stdin/stdout.
+# Returns the size of the new image (before compression).
+def convert_dial_media(out_path: str, in_path: str, in_media_type: str, out_media_type: str, copy_index: bool, sparse: bool = False, in_format: str = "raw16", out_format: str = "raw16"):
+    # Open the input.
+    # If it's also the output, it has to be read in before the output is created (and truncated).
+    input_image, input_raw = open_image_stream(in_path, "rb")
+    try:
+        if(in_path != "-" and out_path != "-" and os.path.exists(out_path) and os.path.samefile(in_path, out_path)):
+            spool = _spool(input_image)
+            close_image_stream(input_image, input_raw)
+            input_image = input_raw = spool
 
-if __name__ == "__main__":
+        # Files are converted to a temporary name (keeping any compression extension) and only renamed into place once
+        # the whole image has been written, so bad or interrupted inputs never leave a partial image behind.
+        tmp_path = out_path
+        if(out_path != "-"):
+            tmp_path = "{}.{}.tmp".format(out_path, os.getpid())
+            ext = os.path.splitext(out_path)[1]
+            if(ext in COMPRESSION_EXTENSIONS):
+                tmp_path += ext
+        output_image, output_raw = open_image_stream(tmp_path, "wb")
+        try:
+            try:
+                size = stream_dial_media(output_image, input_image, in_media_type, out_media_type, copy_index, sparse, in_format=in_format, out_format=out_format)
+            finally:
+                close_image_stream(output_image, output_raw)
+            if(tmp_path != out_path):
+                os.replace(tmp_path, out_path)
+            return size
+        except OSError as excpt:
+            raise ArtifactError("Failed to write output image '{}': {}".format(out_path, excpt))
+        finally:
+            if(tmp_path != out_path and os.path.exists(tmp_path)):
+                os.unlink(tmp_path)
+    finally:
+        close_image_stream(input_image, input_raw)
+
+# Compressors need to be closed to finish their output, stdin and stdout are left open.
+def close_image_stream(stream, raw):
+    if(stream is not raw):
+        stream.close()
+    if(raw is sys.stdout.buffer):
+        raw.flush()
+    elif(raw is not sys.stdin.buffer):
+        raw.close()
+
+def main(argv):
+    import imgfmt
+    import tracing
     parser = argparse.ArgumentParser(prog='DIAL-MS Media Copier', description='Copy DIAL-MS data from one image type to another.')
-    parser.add_argument("-o", "--output-path", required=True, help="Output image path.")
-    parser.add_argument("-i", "--input-path", required=True, help="Input image path.")
+    parser.add_argument("-o", "--output-path", required=True, help="Output image path, or - for stdout. Compressed if it ends in .gz, .xz or .zst.")
+    parser.add_argument("-i", "--input-path", required=True, help="Input image path, or - for stdin. May be gzip, xz or zstd compressed.")
     parser.add_argument("-m", "--input-media", required=True, help="Input media type.", choices=VALID_MEDIA_TYPES)
     parser.add_argument("-n", "--output-media", required=True, help="Output media type.", choices=VALID_MEDIA_TYPES)
-    parser.add_argument("-i", "--preserve-index", action="store_const", const=True, help="Preserve the DIAL file index; if not set (default), the index and entire file area are zeroed in both output images.")
-    parsed = parser.parse_args(sys.argv[1:])
-
-    # Open the input.
-    input_image = open_file(parsed.input_path, "rb")
+    parser.add_argument("-d", "--preserve-index", action="store_const", const=True, help="Preserve the DIAL file index; if not set (default), the index and entire file area are zeroed in both output images.")
+    parser.add_argument("--sparse", action="store_const", const=True, help="Leave all-zero blocks as holes in the output image instead of writing them.")
+    parser.add_argument("--input-format", default="raw16", choices=list(imgfmt.IMAGE_FORMATS), help="Format the input image is stored in (default raw16).")
+    parser.add_argument("--output-format", default="raw16", choices=list(imgfmt.IMAGE_FORMATS), help="Format to store the output image in (default raw16).")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
 
     # Check media type.
     if(not media_type_valid(parsed.input_media)):
@@ -129,8 +605,14 @@ if __name__ == "__main__":
 
     # And copy it :)
     try:
-        copy_dial_media(parsed.output_path, input_image, parsed.input_media, parsed.output_media, parsed.preserve_index != None)
+        convert_dial_media(parsed.output_path, parsed.input_path, parsed.input_media, parsed.output_media, parsed.preserve_index != None, parsed.sparse != None, parsed.input_format, parsed.output_format)
     except OSError as excpt:
-        sys.exit("Failed to copy input {} to output {}: {}".format(parsed.input_path, parsed.output_path, ))
+        sys.exit("Failed to copy input {} to output {}: {}".format(parsed.input_path, parsed.output_path, excpt))
     except ValueError as excpt:
         sys.exit("Input image {} improperly formatted: {}".format(parsed.input_path, excpt))
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
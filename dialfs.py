@@ -0,0 +1,307 @@
+import argparse
+import csv
+import os
+import struct
+import sys
+import cpmedia as cpm
+import tracing
+from cmn import *
+from mapimg import MappedImage
+
+# Reads and writes the DIAL file index and file areas of images, so files can be added without booting DIAL.
+# The index is blocks 0346-0347, taken to be 0100 entries of 010 words each:
+#   words 0-3: the name, eight LINC code characters two to a word, padded with spaces; entries that are all zero are free.
+#   words 4-5: the source (S) file's first block and length in blocks, a length of 0 meaning there isn't one.
+#   words 6-7: the binary (B) file's first block and length.
+# Files are contiguous runs of blocks in the file areas, 0-0277 and 0370 through the end of the unit (0777).
+# This layout hasn't been checked against DIAL itself, so an index is only ever changed if it reads and writes back
+# exactly as it is (as a blank index does); anything else in it is a layout dialfs doesn't understand.
+# Entries keep their places in the index, new names take the first free entry.
+INDEX_BLOCK = 0o346
+INDEX_SIZE = 2
+ENTRY_WORDS = 0o10
+ENTRY_COUNT = INDEX_SIZE * WORDS_PER_BLOCK // ENTRY_WORDS
+INDEX_BYTES = ENTRY_COUNT * ENTRY_WORDS * BYTES_PER_WORD
+NAME_WORDS = 4
+NAME_CHARS = NAME_WORDS * 2
+
+FILE_AREAS = [
+    (0, 0o300),
+    (0o370, TAPE_SIZE_BLOCKS),
+]
+FILE_KINDS = "SB"
+
+# LINC character codes of the characters names may use; digits are 00-11 and letters 24-55.
+LINC_SPACE = 0o14
+LINC_CODES = {char: code for code, char in enumerate("0123456789")}
+LINC_CODES.update({char: 0o24 + code for code, char in enumerate("ABCDEFGHIJKLMNOPQRSTUVWXYZ")})
+LINC_CHARS = {code: char for char, code in LINC_CODES.items()}
+
+def encode_name(name: str):
+    name = name.upper()
+    if(len(name) == 0 or len(name) > NAME_CHARS or any(char not in LINC_CODES for char in name)):
+        raise ConfigError("Invalid DIAL file name '{}', names are 1-{} letters and digits".format(name, NAME_CHARS))
+    codes = [LINC_CODES[char] for char in name] + [LINC_SPACE] * (NAME_CHARS - len(name))
+    return [codes[idx] << 6 | codes[idx + 1] for idx in range(0, NAME_CHARS, 2)]
+
+# Codes names can't hold are decoded as '?', so the name won't encode back to them.
+def decode_name(words):
+    chars = []
+    for word in words:
+        for code in (word >> 6 & 0o77, word & 0o77):
+            chars.append(" " if code == LINC_SPACE else LINC_CHARS.get(code, "?"))
+    return "".join(chars).rstrip()
+
+class DialFile:
+    def __init__(self, name: str, kind: str, start: int, length: int):
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.length = length
+
+    def end(self):
+        return self.start + self.length
+
+class IndexEntry:
+    def __init__(self, name: str, files: dict):
+        self.name = name
+        self.files = files # kind -> DialFile; entries naming no files are kept.
+
+# The file index of an image, held as its entries in index order (None being free) and a name -> entry number lookup.
+class FileIndex:
+    def __init__(self, block_count: int):
+        self.block_count = min(block_count, TAPE_SIZE_BLOCKS)
+        self.entries = [None] * ENTRY_COUNT
+        self.names = {}
+
+    @classmethod
+    def parse(cls, data, block_count: int):
+        index = cls(block_count)
+        if(block_count < INDEX_BLOCK + INDEX_SIZE):
+            raise FormatError("Image is too short to hold a DIAL file index")
+        words = struct.unpack_from("<{}H".format(ENTRY_COUNT * ENTRY_WORDS), data, INDEX_BLOCK * BYTES_PER_BLOCK)
+        for number in range(ENTRY_COUNT):
+            fields = [word & 0o7777 for word in words[number * ENTRY_WORDS:(number + 1) * ENTRY_WORDS]]
+            if(not any(fields)):
+                continue
+            entry = index.entries[number] = IndexEntry(decode_name(fields[:NAME_WORDS]), {})
+            index.names.setdefault(entry.name, number)
+            for idx, kind in enumerate(FILE_KINDS):
+                start, length = fields[NAME_WORDS + idx * 2:NAME_WORDS + idx * 2 + 2]
+                if(length != 0):
+                    entry.files[kind] = DialFile(entry.name, kind, start, length)
+                    if(entry.files[kind].end() > index.block_count):
+                        raise FormatError("DIAL file {} {} ({:04o}-{:04o}) runs past the end of the image".format(entry.name, kind, start, start + length - 1))
+        return index
+
+    def encode(self):
+        words = []
+        for entry in self.entries:
+            if(entry == None):
+                words += [0] * ENTRY_WORDS
+                continue
+            words += encode_name(entry.name)
+            for kind in FILE_KINDS:
+                dial_file = entry.files.get(kind)
+                words += [0, 0] if dial_file == None else [dial_file.start, dial_file.length]
+        return struct.pack("<{}H".format(len(words)), *words)
+
+    # Raise unless data's index is exactly what this index (parsed from it) encodes to, and every name is in it once.
+    def check_round_trip(self, data):
+        offset = INDEX_BLOCK * BYTES_PER_BLOCK
+        try:
+            encoded = self.encode()
+        except ConfigError:
+            encoded = None
+        if(encoded != bytes(data[offset:offset + INDEX_BYTES]) or len(self.names) != ENTRY_COUNT - self.entries.count(None)):
+            raise FormatError("The DIAL file index isn't in the layout dialfs reads and writes, refusing to change it")
+
+    def files(self):
+        return sorted((dial_file for entry in self.entries if entry != None for dial_file in entry.files.values()), key=lambda dial_file: dial_file.start)
+
+    def get(self, name: str, kind: str):
+        number = self.names.get(name.upper())
+        return None if number == None else self.entries[number].files.get(kind)
+
+    def remove(self, name: str, kind: str = None):
+        number = self.names.get(name.upper())
+        files = None if number == None else self.entries[number].files
+        if(files == None or (kind != None and kind not in files)):
+            raise ConfigError("No DIAL file named '{}'{}".format(name, "" if kind == None else " of type " + kind))
+        if(kind == None):
+            files.clear()
+        else:
+            del files[kind]
+        if(len(files) == 0):
+            self.entries[number] = None
+            del self.names[name.upper()]
+
+    # Free runs of blocks (start, end) in the file areas.
+    def free_extents(self):
+        extents = []
+        used = self.files()
+        for area_start, area_end in FILE_AREAS:
+            start = area_start
+            area_end = min(area_end, self.block_count)
+            for dial_file in used:
+                if(dial_file.end() <= start or dial_file.start >= area_end):
+                    continue
+                if(dial_file.start > start):
+                    extents.append((start, dial_file.start))
+                start = max(start, dial_file.end())
+            if(start < area_end):
+                extents.append((start, area_end))
+        return extents
+
+    # Add (or replace) a file of length blocks, placing it in the first free run it fits in.
+    # A new name takes the first free entry, a name that's already there keeps its entry.
+    def allocate(self, name: str, kind: str, length: int):
+        encode_name(name)
+        name = name.upper()
+        if(kind not in FILE_KINDS):
+            raise ConfigError("Invalid DIAL file type '{}', expected one of: {}".format(kind, ", ".join(FILE_KINDS)))
+        number = self.names.get(name)
+        if(number == None):
+            if(None not in self.entries):
+                raise ConfigError("The DIAL file index holds at most {} names, there's no room for {}".format(ENTRY_COUNT, name))
+            number = self.entries.index(None)
+        entry = self.entries[number] or IndexEntry(name, {})
+        entry.files.pop(kind, None)
+        for start, end in self.free_extents():
+            if(end - start >= length):
+                entry.files[kind] = DialFile(name, kind, start, length)
+                self.entries[number] = entry
+                self.names[name] = number
+                return entry.files[kind]
+        raise ConfigError("No room for the {} blocks of {} {} in the DIAL file areas".format(length, name, kind))
+
+# Open an image for reading or writing its file areas, returning the mapping and a view of its DIAL blocks.
+def open_image(path: str, media: str, writable: bool):
+    if(os.path.splitext(path)[1] in cpm.COMPRESSION_EXTENSIONS):
+        raise ConfigError("Can't update the file areas of compressed image '{}'".format(path))
+    try:
+        image = MappedImage.open(path, writable)
+    except (OSError, ValueError) as excpt:
+        raise ArtifactError("Failed to map image '{}': {}".format(path, excpt))
+    view = image.view
+    if(media == 'linc'):
+        try:
+            start, end = cpm.linc_data_range(view)
+        except FormatError:
+            image.close()
+            raise
+        view = view[start:end]
+    return image, view
+
+# Parse an image's file index, raising FormatError unless it's in the layout dialfs reads and writes.
+def read_index(view):
+    index = FileIndex.parse(view, len(view) // BYTES_PER_BLOCK)
+    index.check_round_trip(view)
+    return index
+
+# Remove the files named in remove, then add every file in files (name, kind, data) to an image, placing each as it's added.
+# The files and the index are then written in one pass. Returns the index as written.
+def update_files(view, files: list, remove: list = ()):
+    index = read_index(view)
+    for name in remove:
+        index.remove(name)
+    writes = {}
+    for name, kind, data in files:
+        length = -(-len(data) // BYTES_PER_BLOCK)
+        entry = index.allocate(name, kind, length)
+        writes[(entry.name, kind)] = (entry.start, bytes(data).ljust(length * BYTES_PER_BLOCK, b"\0"))
+    writes["index"] = (INDEX_BLOCK, index.encode())
+
+    # Write in block order, so the image is written front to back.
+    for start, data in sorted(writes.values(), key=lambda write: write[0]):
+        view[start * BYTES_PER_BLOCK:start * BYTES_PER_BLOCK + len(data)] = data
+    return index
+
+def read_file(view, entry: DialFile):
+    if(entry.end() * BYTES_PER_BLOCK > len(view)):
+        raise FormatError("DIAL file {} {} runs past the end of the image".format(entry.name, entry.kind))
+    return bytes(view[entry.start * BYTES_PER_BLOCK:entry.end() * BYTES_PER_BLOCK])
+
+# Parse a file manifest: one file per row as NAME,TYPE,PATH.
+def parse_manifest(fp):
+    files = []
+    for row in csv.reader(fp):
+        if(len(row) == 0 or row[0].startswith("#")):
+            continue
+        if(len(row) != 3):
+            raise FormatError("Expected NAME,TYPE,PATH but got: {}".format(",".join(row)))
+        files.append([field.strip() for field in row])
+    return files
+
+def load_files(specs: list):
+    files = []
+    for name, kind, path in specs:
+        with open_file(path, "rb") as fp:
+            files.append((name, kind.upper(), fp.read()))
+    return files
+
+def print_index(path: str, index: FileIndex):
+    print("{}:".format(path))
+    for entry in index.files():
+        print("  {:8} {}  {:04o}-{:04o} ({} blocks)".format(entry.name, entry.kind, entry.start, entry.end() - 1, entry.length))
+    free = sum(end - start for start, end in index.free_extents())
+    print("  {} names, {} blocks free".format(len(index.names), free))
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='DIAL-MS File Injector', description='List, add, remove, and extract files in the DIAL file index and file areas of images.')
+    parser.add_argument("images", nargs="+", help="Images to update (or list).")
+    parser.add_argument("-m", "--media", choices=VALID_MEDIA_TYPES, help="Media type of the images; by default it's taken from each image's extension.")
+    parser.add_argument("-a", "--add", nargs=3, action="append", default=[], metavar=("NAME", "TYPE", "PATH"), help="Add (or replace) the file NAME of type S or B with the contents of PATH, in 16 bit words. May be given many times.")
+    parser.add_argument("-f", "--manifest", help="Add every file listed in a CSV manifest (NAME,TYPE,PATH).")
+    parser.add_argument("-r", "--remove", action="append", default=[], metavar="NAME", help="Remove both types of the file NAME. May be given many times.")
+    parser.add_argument("-x", "--extract", nargs=3, metavar=("NAME", "TYPE", "PATH"), help="Copy the file NAME of type S or B out of the (single) image to PATH.")
+    parser.add_argument("-l", "--list", action="store_const", const=True, help="List the index of each image, after any changes.")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+
+    specs = list(parsed.add)
+    if(parsed.manifest != None):
+        try:
+            with open_file(parsed.manifest, "r") as fp:
+                specs += parse_manifest(fp)
+        except ValueError as excpt:
+            raise FormatError("File manifest '{}' is improperly formatted: {}".format(parsed.manifest, excpt))
+    if(parsed.extract != None and len(parsed.images) != 1):
+        parser.error("--extract requires exactly one image")
+
+    # Every file is read once, however many images it's added to.
+    files = load_files(specs)
+    writable = len(files) != 0 or len(parsed.remove) != 0
+
+    import imginfo
+    for path in parsed.images:
+        media = parsed.media or imginfo.media_from_path(path)
+        if(media == None):
+            raise ConfigError("Can't tell the media type of '{}', use --media".format(path))
+        with tracing.span("dialfs", path=path, files=len(files)) as sp:
+            image, view = open_image(path, media, writable)
+            try:
+                if(writable):
+                    index = update_files(view, files, parsed.remove)
+                else:
+                    index = read_index(view)
+                if(parsed.extract != None):
+                    name, kind, out_path = parsed.extract
+                    entry = index.get(name, kind.upper())
+                    if(entry == None):
+                        raise ConfigError("No DIAL file named '{}' of type {}".format(name, kind.upper()))
+                    with open_file(out_path, "wb") as fp:
+                        fp.write(read_file(view, entry))
+            finally:
+                view.release()
+                image.close()
+            sp.set(names=len(index.names))
+        if(parsed.list != None or not writable and parsed.extract == None):
+            print_index(path, index)
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
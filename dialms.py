@@ -0,0 +1,49 @@
+import sys
+
+# Single entry point for every DIAL-MS tool: "python3 dialms.py COMMAND [OPTIONS...]".
+# Only the module for the command being run is imported, so commands start as fast as the tool itself would.
+# The command table is kept here as plain strings so listing commands doesn't import any of them.
+COMMANDS = {
+    "build": ("builder", "Build new DIAL-MS images from a base LINCtape image."),
+    "copy": ("cpmedia", "Copy DIAL-MS data from one image type to another."),
+    "bulkcp": ("bulkcp", "Copy every image in directories or globs from one image type to another."),
+    "info": ("imginfo", "Index images: region and block hashes, unit tables, and installed handlers."),
+    "delta": ("imgdelta", "Create block level deltas between images and apply them in place."),
+    "store": ("blkstore", "Archive images in a block deduplicating store, and get them back out."),
+    "files": ("dialfs", "List, add, remove, and extract files in the DIAL file areas of images."),
+    "table": ("wrtbl", "Write (or compile) the unit table of an image from CSV specifications."),
+    "handler": ("wrhndlr", "Write a device handler into an image."),
+    "patch": ("wrpatch", "Apply the rebootstrap patch to an image."),
+    "assemble": ("pal8", "Assemble a PAL8 source file to a core image."),
+    "tape": ("mktape", "Write core images as compact BIN, RIM, or stub loader tapes."),
+    "serve": ("dialsrv", "Serve image builds over a Unix socket or localhost HTTP."),
+    "disk": ("sdsksrv", "Serve Serial Disk images to the sdsk handler over a pty or TCP."),
+    "sim": ("pdp8sim", "Smoke boot images on a headless PDP-12 simulator."),
+    "bench": ("benchmark", "Benchmark the tools on synthetic fixtures."),
+}
+
+def usage():
+    lines = ["usage: dialms COMMAND [OPTIONS...]", "", "commands:"]
+    for name, (module, description) in COMMANDS.items():
+        lines.append("  {:10} {}".format(name, description))
+    lines.append("")
+    lines.append("Run 'dialms COMMAND --help' for a command's options.")
+    return "\n".join(lines)
+
+def main(argv):
+    if(len(argv) == 0 or argv[0] in ("-h", "--help")):
+        print(usage())
+        return
+    if(argv[0] not in COMMANDS):
+        sys.exit("Unknown command: {}\n\n{}".format(argv[0], usage()))
+
+    module = __import__(COMMANDS[argv[0]][0])
+    from cmn import DialError
+    try:
+        module.main(argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+    sys.exit(0)
@@ -0,0 +1,271 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import os
+import time
+import traceback
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import builder as bld
+import cpmedia as cpm
+import tracing
+from cmn import *
+
+# Bytes written to the client before waiting for it to catch up.
+STREAM_HIGH_WATER = 0x40000
+
+# Number of recent request latencies kept for /status.
+LATENCY_HISTORY = 1000
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+class RequestError(Exception):
+    def __init__(self, status: int, msg: str):
+        super().__init__(msg)
+        self.status = status
+
+# Builds images from a preloaded base image, keeping built I/O routine blocks around for later requests.
+# Decoded handlers, patches and unit tables are kept warm by builder's own caches.
+class BuildServer:
+    def __init__(self, base: memoryview, jobs: int, max_body: int):
+        self.base = base
+        self.max_body = max_body
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.slots = asyncio.Semaphore(jobs)
+        self.routines = {}
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self.counters = collections.Counter()
+
+    # Build every variant once so the first real requests don't pay for loading anything.
+    def preload(self):
+        types = [media for media in VALID_MEDIA_TYPES if media != 'rk01']
+        with tracing.span("preload") as sp:
+            for media, replace_first, second_system, patch_enb in itertools.product(types, [None] + types, [False, True], [False, True]):
+                try:
+                    self._routine_blocks(bld.BuildVariant("", media, replace_first, second_system, patch_enb))
+                except DialError:
+                    pass # Reported if it's ever requested.
+            sp.set(variants=len(self.routines))
+        return len(self.routines)
+
+    def reload(self):
+        self.routines.clear()
+        return self.preload()
+
+    def _routine_blocks(self, variant: bld.BuildVariant):
+        key = (variant.media, variant.replace_first, variant.second_system, variant.enable_patches)
+        if(key not in self.routines):
+            self.routines[key] = bytes(bld.build_routine_blocks(self.base, variant))
+        return self.routines[key]
+
+    # Parse a build request's query into a variant and the image it wants.
+    def _parse_build(self, query: dict):
+        def get(name: str, default: str = None):
+            return query[name][-1] if name in query else default
+
+        media = get("media")
+        if(media == None or not media_type_valid(media)):
+            raise RequestError(400, "Invalid media type: {}".format(media))
+        replace_first = get("replace-first")
+        if(replace_first != None and not media_type_valid(replace_first)):
+            raise RequestError(400, "Invalid primary media type: {}".format(replace_first))
+        flags = get("flags", "")
+        if(any(flag not in "dsp" for flag in flags)):
+            raise RequestError(400, "Invalid flags: {}".format(flags))
+        image = get("image", media)
+        if(image != "linc" and image != media):
+            raise RequestError(400, "Image must be linc or {}".format(media))
+        return bld.BuildVariant("", media, replace_first, "s" in flags, "p" in flags, "d" in flags), image
+
+    async def build(self, query: dict, body: bytes):
+        variant, image = self._parse_build(query)
+        base = self.base
+        loop = asyncio.get_running_loop()
+        async with self.slots:
+            try:
+                if(len(body) != 0):
+                    # A base image sent along with the request replaces the preloaded one.
+                    base = await loop.run_in_executor(self.pool, cpm.parse_dial_media, body, "linc")
+                    routine_blocks = await loop.run_in_executor(self.pool, bld.build_routine_blocks, base, variant)
+                else:
+                    routine_blocks = await loop.run_in_executor(self.pool, self._routine_blocks, variant)
+            except (ConfigError, FormatError) as excpt:
+                raise RequestError(400, str(excpt))
+            except ArtifactError as excpt:
+                raise RequestError(500, str(excpt))
+
+        size = cpm.dial_media_size(len(base), image)
+        chunks = cpm.iter_dial_media(base, image, variant.preserve_index, {IO_ROUTINES_BLOCK: routine_blocks})
+        return size, chunks
+
+    def status(self):
+        latencies = sorted(self.latencies)
+        def percentile(pct: float):
+            return None if len(latencies) == 0 else round(latencies[min(len(latencies) - 1, int(len(latencies) * pct))] * 1000, 3)
+        return {
+            "counters": dict(self.counters),
+            "variants": len(self.routines),
+            "latency_ms": {"p50": percentile(0.50), "p99": percentile(0.99), "max": percentile(1.0)},
+        }
+
+    async def _send(self, writer, status: int, body: bytes = b"", content_type: str = "text/plain", size: int = None, chunks = None):
+        head = "HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n".format(status, _REASONS[status], content_type, len(body) if size == None else size)
+        writer.write(head.encode() + body)
+        if(chunks != None):
+            try:
+                for chunk in chunks:
+                    writer.write(chunk)
+                    if(writer.transport.get_write_buffer_size() > STREAM_HIGH_WATER):
+                        await writer.drain()
+            except ConnectionError:
+                raise
+            except Exception:
+                # The status line has already gone out, so all that's left is to cut the response short.
+                traceback.print_exc()
+                writer.transport.abort()
+                raise ConnectionAbortedError("Response cut short")
+        await writer.drain()
+
+    async def _request(self, reader):
+        line = await reader.readline()
+        if(line == b""):
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise RequestError(400, "Invalid request line")
+
+        headers = {}
+        while(True):
+            line = await reader.readline()
+            if(line in (b"\r\n", b"\n", b"")):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            length = -1
+        if(length < 0):
+            raise RequestError(400, "Invalid Content-Length: {}".format(headers["content-length"]))
+        if(length > self.max_body):
+            raise RequestError(413, "Request body larger than {} bytes".format(self.max_body))
+        body = await reader.readexactly(length) if length > 0 else b""
+        keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+        return method, target, body, keep_alive
+
+    async def handle(self, reader, writer):
+        try:
+            while(True):
+                try:
+                    request = await self._request(reader)
+                except RequestError as excpt:
+                    await self._send(writer, excpt.status, "{}\n".format(excpt).encode())
+                    break
+                except ValueError as excpt:
+                    # Lines too long for the reader.
+                    await self._send(writer, 400, "Invalid request: {}\n".format(excpt).encode())
+                    break
+                if(request == None):
+                    break
+                method, target, body, keep_alive = request
+
+                start = time.perf_counter()
+                url = urllib.parse.urlsplit(target)
+                query = urllib.parse.parse_qs(url.query)
+                try:
+                    if(url.path == "/build"):
+                        if(method not in ("GET", "POST")):
+                            raise RequestError(405, "Use GET or POST")
+                        with tracing.span("serve_build", query=url.query, bytes_read=len(body)) as sp:
+                            size, chunks = await self.build(query, body)
+                            await self._send(writer, 200, content_type="application/octet-stream", size=size, chunks=chunks)
+                            sp.set(bytes_written=size)
+                        self.counters["builds"] += 1
+                        self.latencies.append(time.perf_counter() - start)
+                    elif(url.path == "/status"):
+                        await self._send(writer, 200, json.dumps(self.status()).encode(), "application/json")
+                    elif(url.path == "/reload"):
+                        if(method != "POST"):
+                            raise RequestError(405, "Use POST")
+                        loop = asyncio.get_running_loop()
+                        count = await loop.run_in_executor(self.pool, self.reload)
+                        await self._send(writer, 200, "Loaded {} variants\n".format(count).encode())
+                    else:
+                        raise RequestError(404, "No such endpoint: {}".format(url.path))
+                except RequestError as excpt:
+                    self.counters["errors"] += 1
+                    await self._send(writer, excpt.status, "{}\n".format(excpt).encode())
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as excpt:
+                    # Anything else is a bug; answer it, and drop the connection as its state is unknown.
+                    traceback.print_exc()
+                    self.counters["errors"] += 1
+                    await self._send(writer, 500, "Internal error: {}\n".format(excpt).encode())
+                    break
+
+                if(not keep_alive):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(server: BuildServer, socket_path: str, host: str, port: int):
+    if(socket_path != None):
+        if(os.path.exists(socket_path)):
+            os.unlink(socket_path)
+        listener = await asyncio.start_unix_server(server.handle, path=socket_path)
+        print("Serving on {}".format(socket_path))
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+        print("Serving on http://{}:{}".format(host, port))
+    async with listener:
+        await listener.serve_forever()
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='DIAL-MS Build Server', description='Serve DIAL-MS image builds over a Unix socket or localhost HTTP.')
+    parser.add_argument("-i", "--input-path", required=True, help="Base LINCtape image path.")
+    parser.add_argument("-u", "--socket", help="Unix socket path to listen on.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on when not using a Unix socket (default 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8008, help="Port to listen on when not using a Unix socket (default 8008).")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of builds that may run at once (default 4).")
+    parser.add_argument("--max-body", type=int, default=16, help="Largest base image accepted with a request, in MiB (default 16).")
+    parser.add_argument("--core-cache", help="Directory used to cache decoded handler and patch BIN images between runs.")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+    bld._options = bld.BuildOptions(parsed.core_cache)
+
+    # Read the base image into memory, so rewriting the file while serving can't change (or truncate) it under the server.
+    try:
+        with open_file(parsed.input_path, "rb") as fp:
+            base = cpm.parse_dial_media(fp.read(), "linc")
+    except OSError as excpt:
+        sys.exit("Failed to read input image '{}': {}".format(parsed.input_path, excpt))
+    except ValueError as excpt:
+        sys.exit("Input image '{}' is improperly formatted: {}".format(parsed.input_path, excpt))
+    except DialError as excpt:
+        sys.exit(str(excpt))
+
+    async def run():
+        server = BuildServer(base, parsed.jobs, parsed.max_body * 0x100000)
+        print("Preloaded {} variants.".format(server.preload()))
+        await serve(server, parsed.socket, parsed.host, parsed.port)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    except OSError as excpt:
+        sys.exit("Failed to start server: {}".format(excpt))
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
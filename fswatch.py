@@ -0,0 +1,97 @@
+import os
+import select
+import time
+
+from cmn import *
+
+# inotify events that can mean a watched file's contents changed.
+# Directories are watched rather than the files themselves, as editors often save by writing a new file and renaming it over the old one.
+_IN_MODIFY = 0x002
+_IN_ATTRIB = 0x004
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_WATCH_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+# How long to let a burst of events (e.g. an editor's write, fsync and rename) settle before looking at the files.
+SETTLE_TIME = 0.05
+
+def _stat(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None # Missing files are a state too, so deleting and restoring a file are both changes.
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+# Waits for any of a set of files to change, using inotify on Linux and polling their modification times elsewhere.
+# Changes are always confirmed by comparing each file's modification time, size and inode, so both report the same thing.
+class FileWatcher:
+    def __init__(self, paths, poll_interval: float = 0.5):
+        self.paths = sorted(set(paths))
+        self.poll_interval = poll_interval
+        self.stats = {path: _stat(path) for path in self.paths}
+        self._fd = self._start_inotify()
+        self.backend = "poll" if self._fd == None else "inotify"
+
+    def _start_inotify(self):
+        if(not sys.platform.startswith("linux")):
+            return None
+        try:
+            # ctypes is slow to import and only needed for watching, so it's only loaded here.
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if(fd < 0):
+            return None
+        for directory in sorted({os.path.dirname(os.path.abspath(path)) for path in self.paths}):
+            if(libc.inotify_add_watch(fd, os.fsencode(directory), _WATCH_MASK) < 0):
+                os.close(fd)
+                return None
+        return fd
+
+    # Discard pending events, they're only a hint that something in a watched directory changed.
+    def _drain(self):
+        try:
+            while(len(os.read(self._fd, 0x10000)) != 0):
+                pass
+        except BlockingIOError:
+            pass
+
+    # Paths whose state changed since they were last looked at.
+    def changed(self):
+        changed = set()
+        for path in self.paths:
+            stat = _stat(path)
+            if(stat != self.stats[path]):
+                self.stats[path] = stat
+                changed.add(path)
+        return changed
+
+    # Block until at least one of the paths changes, returning the set of those that did.
+    def wait(self):
+        while(True):
+            if(self._fd != None):
+                select.select([self._fd], [], [])
+                time.sleep(SETTLE_TIME)
+                self._drain()
+            else:
+                time.sleep(self.poll_interval)
+            changed = self.changed()
+            if(len(changed) != 0):
+                return changed
+
+    def close(self):
+        if(self._fd != None):
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,183 @@
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import cpmedia as cpm
+import tracing
+from cmn import *
+
+# Block level deltas between two images of the same media type, for updating a machine that already has the old image.
+#
+# A delta is a header followed by runs of changed blocks:
+#   header: magic, old image size, new image size, sha256 of the old image, sha256 of the new image, run count
+#   run:    first block, block count, then the new contents of those blocks
+# The final block of an image may be partial (e.g. a LINCtape's format information), its run only holds what's there.
+# Blocks past the end of the old image that are all zeros aren't stored, they're left for the resize to fill in.
+# Delta files are compressed if their name ends in .gz, .xz or .zst.
+DELTA_MAGIC = b"DIALDLT1"
+_HEADER = struct.Struct("<8sQQ32s32sI")
+_RUN = struct.Struct("<II")
+
+# Blocks compared at once before narrowing down to single blocks.
+COMPARE_BLOCKS = 0o100
+
+class DeltaHeader:
+    def __init__(self, old_size: int, new_size: int, old_hash: bytes, new_hash: bytes, run_count: int):
+        self.old_size = old_size
+        self.new_size = new_size
+        self.old_hash = old_hash
+        self.new_hash = new_hash
+        self.run_count = run_count
+
+def _map_image(path: str):
+    try:
+        with open(path, "rb") as fp:
+            if(os.fstat(fp.fileno()).st_size == 0):
+                return memoryview(b"")
+            return memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+    except OSError as excpt:
+        raise ArtifactError("Failed to read image '{}': {}".format(path, excpt))
+
+def _block_range(data: memoryview, block: int, count: int = 1):
+    return data[block * BYTES_PER_BLOCK:(block + count) * BYTES_PER_BLOCK]
+
+# Find the runs of blocks (start, end) in new that differ from old.
+def diff_blocks(old: memoryview, new: memoryview):
+    block_count = (len(new) + BYTES_PER_BLOCK - 1) // BYTES_PER_BLOCK
+    zeros = bytes(BYTES_PER_BLOCK)
+    runs = []
+    for chunk in range(0, block_count, COMPARE_BLOCKS):
+        count = min(COMPARE_BLOCKS, block_count - chunk)
+        # Comparing bytes is a memcmp, comparing memoryviews goes element by element.
+        old_chunk = bytes(_block_range(old, chunk, count))
+        new_chunk = bytes(_block_range(new, chunk, count))
+        if(old_chunk == new_chunk):
+            continue
+        for blk in range(chunk, chunk + count):
+            new_block = new_chunk[(blk - chunk) * BYTES_PER_BLOCK:(blk - chunk + 1) * BYTES_PER_BLOCK]
+            old_block = old_chunk[(blk - chunk) * BYTES_PER_BLOCK:(blk - chunk + 1) * BYTES_PER_BLOCK]
+            if(new_block == old_block or (len(old_block) == 0 and new_block == zeros[:len(new_block)])):
+                continue
+            if(len(runs) != 0 and runs[-1][1] == blk):
+                runs[-1] = (runs[-1][0], blk + 1)
+            else:
+                runs.append((blk, blk + 1))
+    return runs
+
+# Write a delta that turns old into new, returning the runs of changed blocks.
+def write_delta(delta_path: str, old: memoryview, new: memoryview):
+    with tracing.span("diff_blocks", old_size=len(old), new_size=len(new)) as sp:
+        runs = diff_blocks(old, new)
+        sp.set(runs=len(runs), blocks=sum(end - start for start, end in runs))
+
+    stream, raw = cpm.open_image_stream(delta_path, "wb")
+    try:
+        stream.write(_HEADER.pack(DELTA_MAGIC, len(old), len(new), hashlib.sha256(old).digest(), hashlib.sha256(new).digest(), len(runs)))
+        for start, end in runs:
+            stream.write(_RUN.pack(start, end - start))
+            stream.write(_block_range(new, start, end - start))
+    except OSError as excpt:
+        raise ArtifactError("Failed to write delta '{}': {}".format(delta_path, excpt))
+    finally:
+        cpm.close_image_stream(stream, raw)
+    return runs
+
+def make_delta(delta_path: str, old_path: str, new_path: str):
+    return write_delta(delta_path, _map_image(old_path), _map_image(new_path))
+
+def _read_exactly(stream, size: int):
+    data = stream.read(size)
+    if(len(data) != size):
+        raise FormatError("Delta is truncated")
+    return data
+
+def read_delta_header(stream):
+    magic, old_size, new_size, old_hash, new_hash, run_count = _HEADER.unpack(_read_exactly(stream, _HEADER.size))
+    if(magic != DELTA_MAGIC):
+        raise FormatError("Not a DIAL-MS image delta")
+    return DeltaHeader(old_size, new_size, old_hash, new_hash, run_count)
+
+# Yield (first block, data) for each run of changed blocks in a delta.
+def iter_delta_runs(stream, header: DeltaHeader):
+    for _ in range(header.run_count):
+        start, count = _RUN.unpack(_read_exactly(stream, _RUN.size))
+        size = min(count * BYTES_PER_BLOCK, header.new_size - start * BYTES_PER_BLOCK)
+        if(count == 0 or size <= (count - 1) * BYTES_PER_BLOCK):
+            raise FormatError("Delta run at block {:o} is outside of the new image".format(start))
+        yield start, _read_exactly(stream, size)
+
+def _file_hash(fp):
+    digest = hashlib.sha256()
+    fp.seek(0, os.SEEK_SET)
+    while(True):
+        data = fp.read(0x100000)
+        if(len(data) == 0):
+            return digest.digest()
+        digest.update(data)
+
+# Apply a delta to the image at image_path in place.
+# The image must be the delta's old image, unless verify is cleared; the result is always checked against the new image's hash.
+# Returns the number of blocks written.
+def apply_delta(image_path: str, delta_path: str, verify: bool = True):
+    stream, raw = cpm.open_image_stream(delta_path, "rb")
+    try:
+        header = read_delta_header(stream)
+        try:
+            fp = open(image_path, "rb+")
+        except OSError as excpt:
+            raise ArtifactError("Failed to open image '{}': {}".format(image_path, excpt))
+        with fp, tracing.span("apply_delta", path=image_path, runs=header.run_count) as sp:
+            try:
+                if(verify):
+                    size = os.fstat(fp.fileno()).st_size
+                    if(size != header.old_size or _file_hash(fp) != header.old_hash):
+                        raise FormatError("Image '{}' isn't the image delta '{}' was made from".format(image_path, delta_path))
+                written = 0
+                for start, data in iter_delta_runs(stream, header):
+                    fp.seek(start * BYTES_PER_BLOCK, os.SEEK_SET)
+                    fp.write(data)
+                    written += (len(data) + BYTES_PER_BLOCK - 1) // BYTES_PER_BLOCK
+                fp.truncate(header.new_size)
+                fp.flush()
+                if(_file_hash(fp) != header.new_hash):
+                    raise FormatError("Image '{}' doesn't match the delta's new image after applying it".format(image_path))
+            except OSError as excpt:
+                raise ArtifactError("Failed to update image '{}': {}".format(image_path, excpt))
+            sp.set(blocks_written=written)
+    except DialError:
+        raise
+    except OSError as excpt:
+        raise ArtifactError("Failed to read delta '{}': {}".format(delta_path, excpt))
+    finally:
+        cpm.close_image_stream(stream, raw)
+    return written
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='DIAL-MS Image Delta', description='Create block level deltas between two DIAL-MS images, and apply them to update an image in place.')
+    commands = parser.add_subparsers(dest="command", required=True)
+    diff_parser = commands.add_parser("diff", help="Create a delta that turns the old image into the new one.")
+    diff_parser.add_argument("old", help="Old image path.")
+    diff_parser.add_argument("new", help="New image path.")
+    diff_parser.add_argument("-o", "--output-path", required=True, help="Delta path. Compressed if it ends in .gz, .xz or .zst.")
+    apply_parser = commands.add_parser("apply", help="Update an image in place using a delta.")
+    apply_parser.add_argument("image", help="Image path, this must be the delta's old image.")
+    apply_parser.add_argument("delta", help="Delta path.")
+    apply_parser.add_argument("--no-verify", action="store_const", const=True, help="Don't check that the image is the delta's old image before updating it.")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+
+    if(parsed.command == "diff"):
+        runs = make_delta(parsed.output_path, parsed.old, parsed.new)
+        print("{} changed blocks in {} runs, delta is {} bytes.".format(sum(end - start for start, end in runs), len(runs), os.path.getsize(parsed.output_path)))
+    else:
+        written = apply_delta(parsed.image, parsed.delta, parsed.no_verify == None)
+        print("Updated {} blocks of {}.".format(written, parsed.image))
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
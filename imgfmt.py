@@ -0,0 +1,144 @@
+import struct
+from cmn import *
+
+# Formats images are stored in, independent of their media type.
+# Every format holds the same 256 word blocks. The tools work on "raw16" data, where each 12 bit word is
+# stored in a little endian 16 bit word, and other formats are decoded to and encoded from it a chunk of
+# blocks at a time, so converting between them is a single pass.
+# NumPy is used for packing and unpacking words when it's installed; otherwise the same work is done with
+# bulk bytes operations, which are slower but still don't handle words one at a time.
+
+class ImageFormat:
+    def __init__(self, name: str, description: str, packed: bool = False, header_words: int = 0, footer: bool = False):
+        self.name = name
+        self.description = description
+        self.packed = packed             # Pairs of 12 bit words are packed into three bytes, rather than one word per 16 bit word.
+        self.header_words = header_words # 16 bit words stored before each block, the first of which holds the block number.
+        self.footer = footer             # LINCtape images have padding and end with the block size & padding information.
+
+    # Whether blocks are stored exactly as the tools use them, so no conversion is needed.
+    def raw(self) -> bool:
+        return not self.packed and self.header_words == 0
+
+    def block_size(self) -> int:
+        return self.header_words * BYTES_PER_WORD + (WORDS_PER_BLOCK * 3 // 2 if self.packed else BYTES_PER_BLOCK)
+
+    # Stored size of length bytes of raw16 data, a partial block at the end is stored as a whole block.
+    def stored_size(self, length: int) -> int:
+        if(self.raw()):
+            return length
+        return -(-length // BYTES_PER_BLOCK) * self.block_size()
+
+IMAGE_FORMATS = {}
+
+def register_format(fmt: ImageFormat):
+    IMAGE_FORMATS[fmt.name] = fmt
+
+def get_format(name: str) -> ImageFormat:
+    fmt = IMAGE_FORMATS.get(name)
+    if(fmt == None):
+        raise ConfigError("Unknown image format '{}', expected one of: {}".format(name, ", ".join(IMAGE_FORMATS)))
+    return fmt
+
+register_format(ImageFormat("raw16", "One word per little endian 16 bit word (default).", footer=True))
+register_format(ImageFormat("packed12", "Two words packed into every three bytes, little endian.", packed=True))
+register_format(ImageFormat("blocked", "One word per 16 bit word, each block preceded by a word holding its block number.", header_words=1))
+
+_numpy_module = False
+
+def _numpy():
+    global _numpy_module
+    if(_numpy_module == False):
+        try:
+            import numpy
+            _numpy_module = numpy
+        except ImportError:
+            _numpy_module = None
+    return _numpy_module
+
+# Translation tables for moving nibbles around a whole buffer of bytes at once.
+_LOW_NIBBLE = bytes(b & 0x0F for b in range(0x100))
+_HIGH_TO_LOW = bytes(b >> 4 for b in range(0x100))
+_LOW_TO_HIGH = bytes((b & 0x0F) << 4 for b in range(0x100))
+_NARROW_BYTES = bytes(range(0x10)) # High bytes of words that fit in 12 bits.
+
+def _or_bytes(a: bytes, b: bytes):
+    return (int.from_bytes(a, "little") | int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+# Unpack 12 bit words packed in pairs into three bytes (w0 | w1 << 12, little endian) to 16 bit words.
+def unpack12(data) -> bytes:
+    if(len(data) % 3 != 0):
+        raise FormatError("Packed data contains an incomplete pair of words")
+    np = _numpy()
+    if(np != None):
+        frames = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.uint16)
+        words = np.empty((len(frames), 2), dtype="<u2")
+        words[:, 0] = frames[:, 0] | (frames[:, 1] & 0x0F) << 8
+        words[:, 1] = frames[:, 1] >> 4 | frames[:, 2] << 4
+        return words.tobytes()
+
+    data = bytes(data)
+    b0, b1, b2 = data[0::3], data[1::3], data[2::3]
+    words = bytearray(len(b0) * 4)
+    words[0::4] = b0
+    words[1::4] = b1.translate(_LOW_NIBBLE)
+    words[2::4] = _or_bytes(b1.translate(_HIGH_TO_LOW), b2.translate(_LOW_TO_HIGH))
+    words[3::4] = b2.translate(_HIGH_TO_LOW)
+    return bytes(words)
+
+# Pack 16 bit words into pairs of 12 bit words in three bytes, the reverse of unpack12.
+def pack12(data) -> bytes:
+    if(len(data) % 4 != 0):
+        raise FormatError("Data to pack contains an incomplete pair of words")
+    np = _numpy()
+    if(np != None):
+        words = np.frombuffer(data, dtype="<u2").reshape(-1, 2)
+        if(len(words) != 0 and words.max() > 0o7777):
+            raise FormatError("Can't pack words wider than 12 bits")
+        frames = np.empty((len(words), 3), dtype=np.uint8)
+        frames[:, 0] = words[:, 0] & 0xFF
+        frames[:, 1] = words[:, 0] >> 8 | (words[:, 1] & 0x0F) << 4
+        frames[:, 2] = words[:, 1] >> 4
+        return frames.tobytes()
+
+    data = bytes(data)
+    lo0, hi0, lo1, hi1 = data[0::4], data[1::4], data[2::4], data[3::4]
+    if(len(hi0.translate(None, _NARROW_BYTES)) != 0 or len(hi1.translate(None, _NARROW_BYTES)) != 0):
+        raise FormatError("Can't pack words wider than 12 bits")
+    frames = bytearray(len(lo0) * 3)
+    frames[0::3] = lo0
+    frames[1::3] = _or_bytes(hi0, lo1.translate(_LOW_TO_HIGH))
+    frames[2::3] = _or_bytes(lo1.translate(_HIGH_TO_LOW), hi1.translate(_LOW_TO_HIGH))
+    return bytes(frames)
+
+# Decode whole blocks stored in fmt, the first being block first_block, to raw16 data.
+def decode_blocks(fmt: ImageFormat, data, first_block: int = 0):
+    if(fmt.raw()):
+        return data
+    block_size = fmt.block_size()
+    if(len(data) % block_size != 0):
+        raise FormatError("Input image contains incomplete blocks!")
+    data = memoryview(data)
+    if(fmt.header_words != 0):
+        header_size = fmt.header_words * BYTES_PER_WORD
+        for blk in range(len(data) // block_size):
+            number = struct.unpack_from("<H", data, blk * block_size)[0]
+            if(number != first_block + blk):
+                raise FormatError("Block {:o} is marked as block {:o}".format(first_block + blk, number))
+        data = b"".join(data[offset + header_size:offset + block_size] for offset in range(0, len(data), block_size))
+    return unpack12(data) if fmt.packed else data
+
+# Encode raw16 data, the first block being block first_block, to fmt. A partial block at the end is padded with zeros.
+def encode_blocks(fmt: ImageFormat, data, first_block: int = 0):
+    if(fmt.raw()):
+        return data
+    if(len(data) % BYTES_PER_BLOCK != 0):
+        data = bytes(data) + bytes(BYTES_PER_BLOCK - len(data) % BYTES_PER_BLOCK)
+    if(fmt.packed):
+        data = pack12(data)
+    if(fmt.header_words != 0):
+        data = memoryview(data)
+        size = fmt.block_size() - fmt.header_words * BYTES_PER_WORD
+        padding = bytes((fmt.header_words - 1) * BYTES_PER_WORD)
+        data = b"".join(struct.pack("<H", (first_block + blk) & 0xFFFF) + padding + data[blk * size:(blk + 1) * size] for blk in range(len(data) // size))
+    return data
@@ -0,0 +1,282 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import struct
+import sys
+import cpmedia as cpm
+import tracing
+import wrhndlr as wh
+import wrpatch as wp
+import wrtbl as wt
+from cmn import *
+
+# Regions of a DIAL-MS image as (name, first block, end block); None ends at the end of the image.
+# The file index contains the I/O routine and controller blocks, they're listed separately as well.
+REGIONS = [
+    ("system", 0, 0o300),
+    ("index", 0o300, 0o346),
+    ("io_routines", IO_ROUTINES_BLOCK, IO_ROUTINES_BLOCK + IO_ROUTINES_SIZE),
+    ("controller", IO_CONTROLLER_BLOCK, IO_CONTROLLER_BLOCK + IO_CONTROLLER_SIZE),
+    ("masters", IO_MASTERS_BLOCK, IO_MASTERS_BLOCK + IO_MASTERS_SIZE),
+    ("work", 0o370, None),
+]
+
+# Handler slots in the second I/O routine block, by word offset.
+HANDLER_SLOTS = {"primary": 0o230, "secondary": 0o30}
+
+# Bumped whenever the index format changes, so older sidecar files are rebuilt.
+INDEX_VERSION = 1
+SIDECAR_EXTENSION = ".dialidx"
+
+# Handler and patch images that installed handlers are identified against.
+class KnownImages:
+    def __init__(self, handlers: dict, patch: bytes = None, key: str = ""):
+        self.handlers = handlers # Hash of the handler as installed -> handler name.
+        self.patch = patch       # Patched BOOTER routine, None if the patch image isn't available.
+        self.key = key           # Identifies this set of images, indexes made with a different set are rebuilt.
+
+def _short_hash(data) -> str:
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+def load_known_images(cache_dir: str = None):
+    import builder as bld
+    handlers = {}
+    for path in sorted(set(bld.HANDLER_PATHS.values()) | set(bld.PATCHED_HANDLER_PATHS.values())):
+        try:
+            handlers[_short_hash(wh.load_handler_image(path, cache_dir))] = os.path.splitext(os.path.basename(path))[0]
+        except DialError:
+            pass # Handlers that can't be loaded are just never identified.
+    patch = None
+    try:
+        patch = bytes(wp.load_patch_image(cache_dir).words(0o7000, 0o7300))
+    except DialError:
+        pass
+    key = hashlib.sha256(repr((sorted(handlers.items()), patch)).encode()).hexdigest()
+    return KnownImages(handlers, patch, key)
+
+# Media type of an image from its extension, ignoring any compression extension.
+def media_from_path(path: str):
+    stem, ext = os.path.splitext(path)
+    if(ext in cpm.COMPRESSION_EXTENSIONS):
+        ext = os.path.splitext(stem)[1]
+    media = ext[1:]
+    return media if media_type_valid(media) else None
+
+def read_image(path: str, media: str):
+    if(os.path.splitext(path)[1] in cpm.COMPRESSION_EXTENSIONS):
+        stream, raw = cpm.open_image_stream(path, "rb")
+        try:
+            data = stream.read()
+        except OSError as excpt:
+            raise ArtifactError("Failed to read image '{}': {}".format(path, excpt))
+        finally:
+            cpm.close_image_stream(stream, raw)
+        return cpm.parse_dial_media(data, media)
+    with open_file(path, "rb") as fp:
+        return cpm.read_dial_media(fp, media)
+
+def _zero_runs(zero: list):
+    runs = []
+    for blk, is_zero in enumerate(zero):
+        if(not is_zero):
+            continue
+        if(len(runs) != 0 and runs[-1][1] == blk):
+            runs[-1][1] = blk + 1
+        else:
+            runs.append([blk, blk + 1])
+    return runs
+
+def decode_unit_table(routines: memoryview):
+    table = routines[wt.UNIT_TABLE_OFFSET:wt.UNIT_TABLE_END]
+    length = wt.table_length(table)
+    wt.validate_entries(table, length)
+    entries = []
+    for offset in range(0, length, wt.ENTRY_SIZE):
+        unit, handler, value = struct.unpack_from("<HHH", table, offset)
+        entries.append({"unit": unit, "handler": handler, "value": value})
+    return entries
+
+# Walk an image once, indexing its regions, blocks, unit table and handlers.
+def index_image(data: memoryview, media: str, known: KnownImages):
+    block_count = len(data) // BYTES_PER_BLOCK
+    zero_block = bytes(BYTES_PER_BLOCK)
+    block_hashes = []
+    zero = []
+    for blk in range(block_count):
+        block = data[blk * BYTES_PER_BLOCK:(blk + 1) * BYTES_PER_BLOCK]
+        block_hashes.append(_short_hash(block))
+        zero.append(block == zero_block)
+
+    regions = {}
+    for name, start, end in REGIONS:
+        end = block_count if end == None else min(end, block_count)
+        if(start >= end):
+            continue
+        regions[name] = {
+            "start": start,
+            "end": end,
+            "sha256": hashlib.sha256(data[start * BYTES_PER_BLOCK:end * BYTES_PER_BLOCK]).hexdigest(),
+            "zero_blocks": sum(zero[start:end]),
+        }
+
+    index = {"version": INDEX_VERSION, "media": media, "size": len(data), "blocks": block_count, "regions": regions, "zero_runs": _zero_runs(zero), "block_hashes": block_hashes}
+    if(block_count < IO_ROUTINES_BLOCK + IO_ROUTINES_SIZE):
+        return index
+
+    routines = data[IO_ROUTINES_BLOCK * BYTES_PER_BLOCK:(IO_ROUTINES_BLOCK + IO_ROUTINES_SIZE) * BYTES_PER_BLOCK]
+    try:
+        index["unit_table"] = decode_unit_table(routines)
+    except FormatError as excpt:
+        index["unit_table_error"] = str(excpt)
+
+    handler_block = routines[BYTES_PER_BLOCK:]
+    handler_size = (0o370 - 0o230) * BYTES_PER_WORD
+    index["handlers"] = {}
+    for slot, addr in HANDLER_SLOTS.items():
+        digest = _short_hash(handler_block[addr * BYTES_PER_WORD:addr * BYTES_PER_WORD + handler_size])
+        index["handlers"][slot] = known.handlers.get(digest, "unknown:" + digest)
+    index["patched"] = None if known.patch == None else routines[0:0o300*BYTES_PER_WORD] == known.patch
+    return index
+
+def sidecar_path(path: str, index_dir: str = None):
+    if(index_dir == None):
+        return path + SIDECAR_EXTENSION
+    return os.path.join(index_dir, hashlib.sha256(os.path.realpath(path).encode()).hexdigest() + SIDECAR_EXTENSION)
+
+def _stamp(path: str):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+# Index an image, reusing its sidecar file if the image hasn't changed since it was written.
+# Sidecar files are written next to images, or in index_dir if provided; use_cache False ignores and rewrites them.
+def load_index(path: str, media: str, known: KnownImages, index_dir: str = None, use_cache: bool = True):
+    try:
+        stamp = _stamp(path)
+    except OSError as excpt:
+        raise ArtifactError("Failed to read image '{}': {}".format(path, excpt))
+    cache_path = sidecar_path(path, index_dir)
+    if(use_cache):
+        try:
+            with open(cache_path, "r") as fp:
+                index = json.load(fp)
+            if(index.get("version") == INDEX_VERSION and index.get("stamp") == stamp and index.get("known") == known.key and index.get("media") == media):
+                tracing.event("index_hit", "cache", path=path)
+                return index
+        except (OSError, ValueError):
+            pass
+
+    with tracing.span("index_image", path=path, media=media) as sp:
+        data = read_image(path, media)
+        index = index_image(data, media, known)
+        sp.set(bytes_read=len(data))
+    index["stamp"] = stamp
+    index["known"] = known.key
+    try:
+        if(index_dir != None):
+            os.makedirs(index_dir, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, "w") as fp:
+            json.dump(index, fp, separators=(",", ":"))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass # Sidecar files are only an optimization.
+    return index
+
+def summary(path: str, index: dict):
+    handlers = index.get("handlers", {})
+    patched = {True: "yes", False: "no", None: "?"}[index.get("patched")]
+    units = ",".join("{:o}".format(entry["unit"]) for entry in index.get("unit_table", [])) or index.get("unit_table_error", "-")
+    routines = index["regions"].get("io_routines", {}).get("sha256", "-")[:16]
+    return "{}  {}  primary={} secondary={} patched={} units={} routines={}".format(path, index["media"], handlers.get("primary", "-"), handlers.get("secondary", "-"), patched, units, routines)
+
+# Regions and runs of blocks that differ between two indexes.
+def compare_indexes(a: dict, b: dict):
+    regions = [name for name in sorted(set(a["regions"]) | set(b["regions"])) if a["regions"].get(name, {}).get("sha256") != b["regions"].get(name, {}).get("sha256")]
+    runs = []
+    for blk in range(max(a["blocks"], b["blocks"])):
+        hash_a = a["block_hashes"][blk] if blk < a["blocks"] else None
+        hash_b = b["block_hashes"][blk] if blk < b["blocks"] else None
+        if(hash_a == hash_b):
+            continue
+        if(len(runs) != 0 and runs[-1][1] == blk):
+            runs[-1] = (runs[-1][0], blk + 1)
+        else:
+            runs.append((blk, blk + 1))
+    return regions, runs
+
+# Expand directories (recursively, keeping files with an image extension) and globs into image paths.
+def find_images(inputs: list):
+    paths = []
+    for entry in inputs:
+        if(os.path.isdir(entry)):
+            found = [path for path in glob.glob(os.path.join(glob.escape(entry), "**", "*"), recursive=True) if os.path.isfile(path) and media_from_path(path) != None]
+        else:
+            found = glob.glob(entry, recursive=True)
+            if(len(found) == 0):
+                raise ArtifactError("No images match '{}'".format(entry))
+        paths += sorted(found)
+    return paths
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='DIAL-MS Image Inspector', description='Index DIAL-MS images: region and block hashes, zero blocks, unit tables and installed handlers.')
+    parser.add_argument("inputs", nargs="+", help="Image paths, globs, or directories (searched recursively for images).")
+    parser.add_argument("-m", "--media", choices=VALID_MEDIA_TYPES, help="Media type of the images; by default it's taken from each image's extension.")
+    parser.add_argument("--json", action="store_const", const=True, help="Print each image's index as a line of JSON instead of a summary.")
+    parser.add_argument("--blocks", action="store_const", const=True, help="Include per-block hashes in --json output.")
+    parser.add_argument("--compare", action="store_const", const=True, help="Compare two images, listing the regions and blocks that differ.")
+    parser.add_argument("--index-dir", help="Keep sidecar index files in this directory instead of next to the images.")
+    parser.add_argument("--no-cache", action="store_const", const=True, help="Re-index every image, ignoring (and rewriting) sidecar index files.")
+    parser.add_argument("--core-cache", help="Directory used to cache decoded handler and patch BIN images between runs.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of images indexed at once (default is the number of CPUs).")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+
+    paths = find_images(parsed.inputs)
+    if(parsed.compare != None and len(paths) != 2):
+        parser.error("--compare requires exactly two images")
+    known = load_known_images(parsed.core_cache)
+
+    def index_one(path: str):
+        media = parsed.media or media_from_path(path)
+        if(media == None):
+            raise ConfigError("Can't tell the media type of '{}', use --media".format(path))
+        return load_index(path, media, known, parsed.index_dir, parsed.no_cache == None)
+
+    from concurrent.futures import ThreadPoolExecutor
+    failed = 0
+    indexes = {}
+    with ThreadPoolExecutor(max_workers=max(1, parsed.jobs)) as pool:
+        for path, future in [(path, pool.submit(index_one, path)) for path in paths]:
+            try:
+                index = indexes[path] = future.result()
+            except DialError as excpt:
+                print("FAIL {}: {}".format(path, excpt), file=sys.stderr)
+                failed += 1
+                continue
+            if(parsed.compare != None):
+                continue
+            if(parsed.json != None):
+                if(parsed.blocks == None):
+                    index = {key: value for key, value in index.items() if key != "block_hashes"}
+                print(json.dumps(dict(index, path=path)))
+            else:
+                print(summary(path, index))
+
+    if(parsed.compare != None and failed == 0):
+        regions, runs = compare_indexes(indexes[paths[0]], indexes[paths[1]])
+        if(len(regions) == 0 and len(runs) == 0):
+            print("Images are identical.")
+        else:
+            print("Regions that differ: {}".format(", ".join(regions) or "none"))
+            print("Blocks that differ: {}".format(", ".join("{:o}".format(start) if end == start + 1 else "{:o}-{:o}".format(start, end - 1) for start, end in runs)))
+    if(failed != 0):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
@@ -0,0 +1,163 @@
+import fcntl
+import mmap
+import os
+
+from cmn import *
+
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+_FICLONE = 0x40049409
+
+_libc = None
+
+def punch_hole(fd: int, offset: int, length: int) -> bool:
+    # Deallocate a range of a file, leaving a hole that reads back as zeros.
+    # Returns False if the platform or filesystem can't do this.
+    global _libc
+    if(not sys.platform.startswith("linux")):
+        return False
+    try:
+        if(_libc == None):
+            # ctypes is slow to import and rarely needed, so it's only loaded here.
+            import ctypes
+            import ctypes.util
+            _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+        return _libc.fallocate(fd, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, offset, length) == 0
+    except (OSError, AttributeError):
+        return False
+
+def reflink(src_path: str, dst_path: str) -> bool:
+    # Create dst_path as a copy-on-write clone of src_path, sharing all of its extents.
+    # Returns False (leaving no dst_path behind) if the platform or filesystem can't do this.
+    if(not sys.platform.startswith("linux")):
+        return False
+    try:
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+                return True
+            except OSError:
+                pass
+        os.unlink(dst_path)
+    except OSError:
+        pass
+    return False
+
+def copy_sparse(src_path: str, dst_path: str):
+    # Copy a file, leaving holes wherever the source has holes or all-zero chunks.
+    chunk = 0x10000
+    zero_chunk = bytes(chunk)
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        while(True):
+            data = src.read(chunk)
+            if(len(data) == 0):
+                break
+            if(data == zero_chunk[:len(data)]):
+                dst.seek(len(data), os.SEEK_CUR)
+            else:
+                dst.write(data)
+        dst.truncate(size)
+
+# Copy a file as cheaply as the filesystem allows.
+def clone_file(src_path: str, dst_path: str, allow_hardlink: bool = False):
+    if(os.path.lexists(dst_path)):
+        os.unlink(dst_path)
+    if(allow_hardlink):
+        try:
+            os.link(src_path, dst_path)
+            return
+        except OSError:
+            pass
+    if(not reflink(src_path, dst_path)):
+        copy_sparse(src_path, dst_path)
+
+# A block addressed disk image backed by a shared memory mapping of its file.
+# Block views are zero-copy, writes to them go straight to the file.
+class MappedImage:
+    def __init__(self, fp, size: int, writable: bool):
+        self._fp = fp
+        self._map = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.view = memoryview(self._map)
+        self.writable = writable
+
+    # Create (or truncate) a file of the given size and map it.
+    # The new file is sparse, so blocks that are never written cost no disk space.
+    @classmethod
+    def create(cls, path: str, size: int):
+        fp = open(path, "w+b")
+        try:
+            fp.truncate(size)
+            return cls(fp, size, True)
+        except BaseException:
+            fp.close()
+            raise
+
+    # Map an existing file.
+    @classmethod
+    def open(cls, path: str, writable: bool = False):
+        fp = open(path, "r+b" if writable else "rb")
+        try:
+            return cls(fp, 0, writable)
+        except BaseException:
+            fp.close()
+            raise
+
+    def __len__(self):
+        return len(self.view)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def block_count(self):
+        return len(self.view) // BYTES_PER_BLOCK
+
+    def block(self, start: int, num: int = 1):
+        if(start < 0 or start + num > self.block_count()):
+            raise IndexError("Blocks {:o}-{:o} are outside of the image".format(start, start + num - 1))
+        return self.view[start * BYTES_PER_BLOCK:(start + num) * BYTES_PER_BLOCK]
+
+    # Zero blocks start through end (not including end), punching a hole when the filesystem allows it.
+    def erase(self, start: int, end: int):
+        end = min(end, self.block_count())
+        if(start >= end):
+            return
+        offset = start * BYTES_PER_BLOCK
+        length = (end - start) * BYTES_PER_BLOCK
+        if(not punch_hole(self._fp.fileno(), offset, length)):
+            self.view[offset:offset + length] = bytes(length)
+
+    # Write changes back to the file; only those to blocks start through start + num if start is given.
+    def flush(self, start: int = None, num: int = 1):
+        if(not self.writable):
+            return
+        if(start == None):
+            self._map.flush()
+            return
+        offset = start * BYTES_PER_BLOCK // mmap.PAGESIZE * mmap.PAGESIZE
+        self._map.flush(offset, (start + num) * BYTES_PER_BLOCK - offset)
+
+    # Ask for blocks to be read in from the file ahead of being used.
+    def prefetch(self, start: int, num: int = 1):
+        try:
+            self._map.madvise(mmap.MADV_WILLNEED, start * BYTES_PER_BLOCK, num * BYTES_PER_BLOCK)
+        except (AttributeError, OSError, ValueError):
+            pass # Only an optimization, not every platform has it.
+
+    def close(self):
+        if(self._fp == None):
+            return
+        self.flush()
+        self.view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # Someone still holds a block view, the mapping will go away with it.
+            # Everything has already been flushed to the file.
+            pass
+        self._fp.close()
+        self._fp = None
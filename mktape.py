@@ -0,0 +1,323 @@
+import argparse
+import os
+import struct
+import sys
+import bin2img as bn
+import pal8
+import tracing
+from cmn import *
+
+# Writes core images (bootloaders, handlers, or anything else bin2img or pal8 can load) as tapes to send to the machine over a serial line.
+# Three formats are written:
+#   bin:  BIN with origins only where the loaded words aren't contiguous, and a single leader and trailer frame by default.
+#         Needs the BIN loader to be in core already.
+#   rim:  RIM, loadable by the RIM loader alone but at four frames a word.
+#   stub: RIM for a small loader (STUB_SOURCE), which is started by the RIM loader as soon as it's loaded and reads the
+#         rest of the tape; runs of repeated words, and 12 bit words packed two to three 8 bit frames.
+# RIM and stub tapes are for the low speed (console) RIM loader at 7756.
+FORMATS = ["bin", "rim", "stub"]
+RIM_FORMATS = ["rim", "stub"]
+
+# Frames on the wire; a start bit, eight data bits, and a stop bit.
+BITS_PER_FRAME = 10
+DEFAULT_BAUD = 9600
+
+# Stub payloads are a series of records of 12 bit words:
+#   0001-3777: that many words follow, loaded one after another.
+#   4001-7777: the next word is loaded (control word & 3777) times.
+#   4000:      the next word is the new load address.
+#   0000:      the end; the next word is the address to start at, 0 halts instead.
+# Runs of at least REPEAT_MIN identical words are sent as repeats.
+PAYLOAD_ORIGIN = 0o4000
+PAYLOAD_END = 0
+MAX_RUN = 0o3777
+REPEAT_MIN = 3
+
+# The RIM loader runs out of 7756-7777. The stub's last RIM record replaces the loader's JMP back to its start at 7775 with
+# a JMP to a trampoline at 7754 (JMP I 7755), which sends it to the stub.
+RIM_LOADER_START = 0o7756
+RIM_LOADER_JUMP = 0o7775
+TRAMPOLINE = 0o7754
+TRAMPOLINE_WORD = 0o5755      # JMP I 7755, followed by the stub's address.
+RIM_LOADER_JUMP_WORD = 0o5354 # JMP 7754
+PAGE_SIZE = 0o200
+
+STUB_SOURCE = """
+/ Payload loader for mktape stub tapes, started by the RIM loader.
+*{origin:o}
+START,  KCC
+        DCA ODD
+NEXT,   JMS GETW        / Control word.
+        SNA
+        JMP END
+        SMA
+        JMP LIT
+        AND (3777)
+        SNA
+        JMP ORG
+        CIA             / Repeat the next word.
+        DCA CNT
+        JMS GETW
+        DCA VAL
+REP,    TAD VAL
+        JMS STORE
+        ISZ CNT
+        JMP REP
+        JMP NEXT
+LIT,    CIA             / Load the next words.
+        DCA CNT
+LITL,   JMS GETW
+        JMS STORE
+        ISZ CNT
+        JMP LITL
+        JMP NEXT
+ORG,    JMS GETW
+        DCA ADDR
+        JMP NEXT
+END,    JMS GETW
+        SNA
+        HLT
+        DCA ADDR
+        JMP I ADDR
+
+STORE,  0
+        DCA I ADDR
+        ISZ ADDR
+        NOP
+        JMP I STORE
+
+/ Words are packed in pairs as three frames; the first word's eight high bits, its low four and the second's high four,
+/ then the second's eight low bits.
+GETW,   0
+        ISZ ODD
+        JMP FIRST
+        JMS GETB
+        TAD NIB
+        JMP I GETW
+FIRST,  JMS GETB
+        CLL RTL
+        RTL
+        DCA TMP
+        JMS GETB
+        DCA NIB
+        TAD NIB
+        RTR
+        RTR
+        AND (17)
+        TAD TMP
+        DCA TMP
+        TAD NIB
+        AND (17)
+        CLL RTL
+        RTL
+        RTL
+        RTL
+        DCA NIB
+        CLA CMA
+        DCA ODD
+        TAD TMP
+        JMP I GETW
+
+GETB,   0
+        KSF
+        JMP .-1
+        KRB
+        AND (377)
+        JMP I GETB
+
+ODD,    0
+CNT,    0
+VAL,    0
+ADDR,   0
+TMP,    0
+NIB,    0
+$
+"""
+
+# Assembled stubs, keyed by origin.
+_stubs = {}
+
+# Runs of (address, [words]) in a core image, masked to 12 bits.
+def image_runs(image: bn.CoreImage):
+    runs = []
+    for address, words in image.segments:
+        values = struct.unpack("<{}H".format(len(words)), image.words(address, address + len(words)))
+        runs.append((address, [value & 0o7777 for value in values]))
+    return runs
+
+def core_image_from_words(words):
+    runs = []
+    for address, word in words:
+        runs.append((address, struct.pack("<H", word)))
+    return bn.CoreImage.from_runs(runs)
+
+# Load a core image from a BIN file, PAL8 source, RIM tape, or raw core image (as written by pal8.py).
+# Raw core images don't record which words were loaded, so only their nonzero words are.
+def load_image(path: str, cache_dir: str = None):
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        if(ext == ".rim"):
+            with open_file(path, "rb") as fp:
+                return core_image_from_words(bn.decode_rim(fp.read()))
+        if(ext == ".core"):
+            with open_file(path, "rb") as fp:
+                data = fp.read()
+            words = struct.unpack("<{}H".format(len(data) // BYTES_PER_WORD), data[:len(data) // BYTES_PER_WORD * BYTES_PER_WORD])
+            return core_image_from_words((address, word) for address, word in enumerate(words) if word != 0)
+        if(ext in (".pa", ".tx")):
+            return pal8.load_source_image(path, cache_dir)
+        return pal8.load_core_image(path, cache_dir)
+    except OSError as excpt:
+        raise ArtifactError("Failed to open file '{}': {}".format(path, excpt))
+    except ValueError as excpt:
+        raise FormatError("Core image '{}' is improperly formatted: {}".format(path, excpt))
+
+def _field0_runs(image: bn.CoreImage, fmt: str):
+    runs = image_runs(image)
+    if(any(address + len(words) > bn.FIELD_SIZE for address, words in runs)):
+        raise ConfigError("{} tapes can only load field 0, use a BIN tape for images that load other fields".format(fmt.upper()))
+    return runs
+
+def encode_rim(words, leader: int = 1, trailer: int = 1):
+    frames = bytearray(b"\x80" * leader)
+    for address, word in words:
+        frames += bytes([0x40 | (address >> 6) & 0o77, address & 0o77, (word >> 6) & 0o77, word & 0o77])
+    frames += b"\x80" * trailer
+    return bytes(frames)
+
+def rim_tape(image: bn.CoreImage, leader: int = 1, trailer: int = 1):
+    runs = _field0_runs(image, "rim")
+    if(any(address + len(words) > RIM_LOADER_START for address, words in runs)):
+        raise ConfigError("RIM tapes can't load over the RIM loader ({:04o}-7777), use a stub tape".format(RIM_LOADER_START))
+    return encode_rim([(address + idx, word) for address, words in runs for idx, word in enumerate(words)], leader, trailer)
+
+# Payload records for a stub tape (see PAYLOAD_ORIGIN).
+def payload_words(image: bn.CoreImage, start: int = None):
+    payload = []
+    for address, words in _field0_runs(image, "stub"):
+        payload += [PAYLOAD_ORIGIN, address]
+        literal = []
+        idx = 0
+        while(idx < len(words)):
+            run = 1
+            while(idx + run < len(words) and run < MAX_RUN and words[idx + run] == words[idx]):
+                run += 1
+            if(run >= REPEAT_MIN):
+                if(len(literal) != 0):
+                    payload += [len(literal)] + literal
+                    literal = []
+                payload += [PAYLOAD_ORIGIN | run, words[idx]]
+                idx += run
+                continue
+            literal.append(words[idx])
+            idx += 1
+            if(len(literal) == MAX_RUN):
+                payload += [len(literal)] + literal
+                literal = []
+        if(len(literal) != 0):
+            payload += [len(literal)] + literal
+    return payload + [PAYLOAD_END, start or 0]
+
+# Pack 12 bit words two to three frames, as read by the stub's GETW.
+def pack_words(words: list):
+    frames = bytearray()
+    for idx in range(0, len(words), 2):
+        first = words[idx]
+        second = words[idx + 1] if idx + 1 < len(words) else None
+        frames.append(first >> 4)
+        frames.append((first & 0o17) << 4 | (0 if second == None else second >> 8))
+        if(second != None):
+            frames.append(second & 0xFF)
+    return bytes(frames)
+
+# The highest page the stub can be loaded into without being overwritten; one the image doesn't load and below the RIM loader's page.
+def stub_origin(image: bn.CoreImage):
+    for page in range((RIM_LOADER_START & 0o7600) - PAGE_SIZE, 0, -PAGE_SIZE):
+        if(all(address >= page + PAGE_SIZE or address + len(words) <= page for address, words in image.segments)):
+            return page
+    raise ConfigError("The image leaves no free page for the stub loader, use a BIN or RIM tape")
+
+def assemble_stub(origin: int):
+    if(origin not in _stubs):
+        with tracing.span("assemble_stub", origin=origin):
+            _stubs[origin] = pal8.assemble_core_image(STUB_SOURCE.format(origin=origin))
+    return _stubs[origin]
+
+def stub_tape(image: bn.CoreImage, start: int = None, leader: int = 1):
+    origin = stub_origin(image)
+    stub = image_runs(assemble_stub(origin))
+    records = [(address + idx, word) for address, words in stub for idx, word in enumerate(words)]
+    records += [(TRAMPOLINE, TRAMPOLINE_WORD), (TRAMPOLINE + 1, origin), (RIM_LOADER_JUMP, RIM_LOADER_JUMP_WORD)]
+
+    # No trailer; the stub stops reading after the payload and anything more would be left for the loaded program.
+    return encode_rim(records, leader, 0) + pack_words(payload_words(image, start))
+
+def make_tape(image: bn.CoreImage, fmt: str, start: int = None, leader: int = 1, trailer: int = 1):
+    with tracing.span("make_tape", format=fmt) as sp:
+        if(fmt == "bin"):
+            tape = bn.encode_bin(image, leader, trailer)
+        elif(fmt == "rim"):
+            tape = rim_tape(image, leader, trailer)
+        else:
+            tape = stub_tape(image, start, leader)
+        sp.set(bytes_written=len(tape))
+    return tape
+
+def transfer_time(frames: int, baud: int):
+    return frames * BITS_PER_FRAME / baud
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='DIAL-MS Tape Maker', description='Write core images as compact BIN, RIM, or self-starting stub loader tapes, and estimate how long they take to send.')
+    parser.add_argument("input_path", help="Core image; a BIN file, PAL8 source (.pa or .tx), RIM tape (.rim), or raw core image (.core).")
+    parser.add_argument("-o", "--output-path", help="Output tape path.")
+    parser.add_argument("-f", "--format", choices=FORMATS + ["auto"], default="bin", help="Tape format; auto picks the smaller of rim and stub, the tapes the RIM loader can load by itself (default bin).")
+    parser.add_argument("--start", type=lambda value: int(value, 8), help="Octal address stub tapes start the program at once it's loaded; they halt if not given.")
+    parser.add_argument("--leader", type=int, default=1, help="Leader frames (default 1).")
+    parser.add_argument("--trailer", type=int, default=1, help="Trailer frames for BIN and RIM tapes (default 1).")
+    parser.add_argument("--baud", type=int, default=DEFAULT_BAUD, help="Line speed to estimate transfer times at (default {}).".format(DEFAULT_BAUD))
+    parser.add_argument("--estimate", action="store_const", const=True, help="Print the size and transfer time of every format.")
+    parser.add_argument("--core-cache", help="Directory used to cache decoded BIN and assembled source images between runs.")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+
+    if(parsed.output_path == None and parsed.estimate == None):
+        parser.error("one of -o/--output-path or --estimate is required")
+    if(parsed.leader < 1 or parsed.trailer < 1):
+        parser.error("at least one leader and trailer frame is needed")
+
+    image = load_image(parsed.input_path, parsed.core_cache)
+    tapes = {}
+    for fmt in (FORMATS if parsed.estimate != None or parsed.format == "auto" else [parsed.format]):
+        try:
+            tapes[fmt] = make_tape(image, fmt, parsed.start, parsed.leader, parsed.trailer)
+        except ConfigError as excpt:
+            if(fmt == parsed.format):
+                raise
+            tapes[fmt] = excpt
+
+    if(parsed.estimate != None):
+        print("{}: {} words loaded".format(parsed.input_path, image.loaded_words()))
+        for fmt, tape in tapes.items():
+            if(isinstance(tape, ConfigError)):
+                print("  {:5} {}".format(fmt, tape))
+            else:
+                print("  {:5} {:6} frames  {:7.2f} s at {} baud".format(fmt, len(tape), transfer_time(len(tape), parsed.baud), parsed.baud))
+
+    if(parsed.output_path != None):
+        fmt = parsed.format
+        if(fmt == "auto"):
+            loadable = [fmt for fmt in RIM_FORMATS if not isinstance(tapes[fmt], ConfigError)]
+            if(len(loadable) == 0):
+                raise tapes["rim"]
+            fmt = min(loadable, key=lambda fmt: len(tapes[fmt]))
+        with open_file(parsed.output_path, "wb") as fp:
+            fp.write(tapes[fmt])
+        if(parsed.estimate == None):
+            print("{}: {} tape, {} frames, {:.2f} s at {} baud".format(parsed.output_path, fmt, len(tapes[fmt]), transfer_time(len(tapes[fmt]), parsed.baud), parsed.baud))
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
@@ -0,0 +1,342 @@
+import argparse
+import hashlib
+import os
+import re
+import struct
+import sys
+
+import bin2img as bn
+import tracing
+
+# Bump whenever the assembler's output for identical sources changes.
+ASSEMBLER_VERSION = 2
+
+# PDP-8 mode permanent symbols.
+MRI_SYMBOLS = {
+    'AND': 0o0000, 'TAD': 0o1000, 'ISZ': 0o2000, 'DCA': 0o3000, 'JMS': 0o4000, 'JMP': 0o5000,
+}
+
+PMODE_SYMBOLS = {
+    **MRI_SYMBOLS,
+    # Group 1 operate.
+    'NOP': 0o7000, 'IAC': 0o7001, 'BSW': 0o7002, 'RAL': 0o7004, 'RTL': 0o7006, 'RAR': 0o7010, 'RTR': 0o7012,
+    'CML': 0o7020, 'CMA': 0o7040, 'CIA': 0o7041, 'CLL': 0o7100, 'STL': 0o7120, 'CLA': 0o7200, 'GLK': 0o7204,
+    'STA': 0o7240,
+    # Group 2 operate.
+    'HLT': 0o7402, 'OSR': 0o7404, 'SKP': 0o7410, 'SNL': 0o7420, 'SZL': 0o7430, 'SZA': 0o7440, 'SNA': 0o7450,
+    'SMA': 0o7500, 'SPA': 0o7510, 'LAS': 0o7604,
+    # Interrupts, memory extension and console.
+    'ION': 0o6001, 'IOF': 0o6002, 'CDF': 0o6201, 'CIF': 0o6202, 'RDF': 0o6214, 'RIF': 0o6224, 'RIB': 0o6234,
+    'RMF': 0o6244, 'KSF': 0o6031, 'KCC': 0o6032, 'KRS': 0o6034, 'KRB': 0o6036, 'TSF': 0o6041, 'TCF': 0o6042,
+    'TPC': 0o6044, 'TLS': 0o6046,
+    # PDP-12 mode switch.
+    'LINC': 0o6141,
+}
+
+# LINC mode permanent symbols, only those used by DIAL-MS and its handlers are known.
+LMODE_SYMBOLS = {
+    'HLT': 0o0000, 'AXO': 0o0001, 'PDP': 0o0002, 'ESF': 0o0004, 'DJR': 0o0006, 'CLR': 0o0011, 'ATR': 0o0014, 'RTA': 0o0015,
+    'NOP': 0o0016, 'COM': 0o0017, 'TMA': 0o0023, 'SET': 0o0040, 'SAM': 0o0100, 'DIS': 0o0140, 'XSK': 0o0200,
+    'ROL': 0o0240, 'ROR': 0o0300, 'SCR': 0o0340, 'SXL': 0o0400, 'KST': 0o0415, 'SNS': 0o0440, 'AZE': 0o0450,
+    'APO': 0o0451, 'LZE': 0o0452, 'IBZ': 0o0453, 'SKP': 0o0456, 'IOB': 0o0500, 'LIF': 0o0600, 'LDF': 0o0640,
+    'RDC': 0o0700, 'RCG': 0o0701, 'RDE': 0o0702, 'MTB': 0o0703, 'WRC': 0o0704, 'WCG': 0o0705, 'WRI': 0o0706,
+    'CHK': 0o0707, 'LDA': 0o1000, 'STA': 0o1040, 'ADA': 0o1100, 'ADM': 0o1140, 'LAM': 0o1200, 'MUL': 0o1240,
+    'LDH': 0o1300, 'STH': 0o1340, 'SHD': 0o1400, 'SAE': 0o1440, 'SRO': 0o1500, 'BCL': 0o1540, 'BSE': 0o1600,
+    'BCO': 0o1640, 'DSC': 0o1740, 'ADD': 0o2000, 'STC': 0o4000, 'JMP': 0o6000, 'I': 0o0020,
+}
+
+_TOKEN_RE = re.compile(r"\s*(?:([A-Z][A-Z0-9]*)|([0-9]+)|(\.)|([-+&!])|([(\[])(.*))")
+_LABEL_RE = re.compile(r"\s*([A-Z][A-Z0-9]*),")
+_ASSIGN_RE = re.compile(r"\s*([A-Z][A-Z0-9]*)\s*=(.*)")
+
+# Assembled sources, keyed by source hash.
+_image_cache = {}
+
+class AssemblyError(ValueError):
+    def __init__(self, line_num: int, msg: str):
+        super().__init__("Line {}: {}".format(line_num, msg))
+
+# Two pass PAL8 style assembler for field 0 programs.
+# Supports labels, assignments, origins, current page and page zero literals, and PMODE/LMODE.
+class Assembler:
+    def __init__(self, text: str):
+        self.lines = text.upper().splitlines()
+        self.symbols = {}
+        self.core = bytearray(bn.CORE_IMAGE_SIZE)
+        self.loaded = set() # Addresses written by the program.
+
+    def assemble(self):
+        for final in (False, True):
+            self._pass(final)
+        return self.core
+
+    def _pass(self, final: bool):
+        self.final = final
+        self.location = 0o200
+        self.lmode = False
+        self.literals = {} # page -> {value: address}
+        for self.line_num, line in enumerate(self.lines, 1):
+            code = line.split("/", 1)[0]
+            if(code.strip() == "$"):
+                break
+            for stmt in code.split(";"):
+                self._statement(stmt)
+
+        # Check literal pools don't overlap code.
+        if(final):
+            for page, pool in self.literals.items():
+                for address in pool.values():
+                    if(address in self.loaded):
+                        raise AssemblyError(self.line_num, "Literals on page {:04o} overlap code".format(page))
+            for page, pool in self.literals.items():
+                for value, address in pool.items():
+                    self._store(address, value)
+
+    def _statement(self, stmt: str):
+        # Labels.
+        match = _LABEL_RE.match(stmt)
+        while(match != None):
+            self._define(match.group(1), self.location)
+            stmt = stmt[match.end():]
+            match = _LABEL_RE.match(stmt)
+
+        stmt = stmt.strip()
+        if(stmt == "" or stmt == "$"):
+            return
+
+        # Origin.
+        if(stmt.startswith("*")):
+            self.location = self._evaluate(stmt[1:]) & 0o7777
+            return
+
+        # Assignment.
+        match = _ASSIGN_RE.match(stmt)
+        if(match != None):
+            self._define(match.group(1), self._evaluate(match.group(2)) & 0o7777)
+            return
+
+        # Pseudo-ops.
+        words = stmt.split()
+        if(words[0] == "PMODE" or words[0] == "LMODE"):
+            self.lmode = words[0] == "LMODE"
+            return
+        if(words[0] == "EJECT"):
+            return
+        if(words[0] == "PAGE"):
+            if(len(words) > 1):
+                self.location = (self._evaluate(" ".join(words[1:])) << 7) & 0o7777
+            elif(self.location & 0o177 != 0):
+                self.location = (self.location + 0o200) & 0o7600
+            return
+        if(words[0] == "FIELD"):
+            if(self._evaluate(" ".join(words[1:])) != 0):
+                raise AssemblyError(self.line_num, "Only field 0 programs are supported")
+            return
+
+        # Anything else produces a word.
+        if(not self.lmode and words[0] in MRI_SYMBOLS and words[0] not in self.symbols):
+            value = self._memory_reference(stmt)
+        else:
+            value = self._evaluate(stmt)
+        if(self.final):
+            self._store(self.location, value & 0o7777)
+        self.location = (self.location + 1) & 0o7777
+
+    def _store(self, address: int, value: int):
+        struct.pack_into("<H", self.core, address * 2, value)
+        self.loaded.add(address)
+
+    def _define(self, name: str, value: int):
+        if(not self.final and name in self.symbols and self.symbols[name] != value):
+            raise AssemblyError(self.line_num, "Symbol {} redefined".format(name))
+        self.symbols[name] = value
+
+    def _lookup(self, name: str):
+        if(name in self.symbols):
+            return self.symbols[name]
+        table = LMODE_SYMBOLS if self.lmode else PMODE_SYMBOLS
+        if(name in table):
+            return table[name]
+        if(self.final):
+            raise AssemblyError(self.line_num, "Undefined symbol {}".format(name))
+        return 0
+
+    def _literal(self, expr: str, zero_page: bool):
+        value = self._evaluate(expr) & 0o7777
+        page = 0 if zero_page else self.location & 0o7600
+        pool = self.literals.setdefault(page, {})
+        if(value not in pool):
+            address = page + 0o177 - len(pool)
+            if(address < page):
+                raise AssemblyError(self.line_num, "Too many literals on page {:04o}".format(page))
+            pool[value] = address
+        return pool[value]
+
+    # Evaluate an expression; each field (terms separated only by spaces) is evaluated left to right, and the fields are
+    # combined with inclusive or, like PAL8. So SET I DX&1777 is SET!I!(DX&1777).
+    def _evaluate(self, expr: str):
+        fields = 0
+        value = 0
+        op = "!"
+        pos = 0
+        expr = expr.strip()
+        while(pos < len(expr)):
+            match = _TOKEN_RE.match(expr, pos)
+            if(match == None or match.end() == pos):
+                raise AssemblyError(self.line_num, "Invalid expression '{}'".format(expr))
+            symbol, number, dot, operator, bracket, rest = match.groups()
+            if(operator != None):
+                if(op != None and op != "!" and operator != "-"):
+                    raise AssemblyError(self.line_num, "Invalid expression '{}'".format(expr))
+                op = operator
+                pos = match.end()
+                continue
+
+            if(bracket != None):
+                close = ")" if bracket == "(" else "]"
+                term = self._literal(rest.split(close, 1)[0], bracket == "[")
+                pos = len(expr) if close not in rest else match.start(6) + rest.index(close) + 1
+            else:
+                if(symbol != None):
+                    term = self._lookup(symbol)
+                elif(number != None):
+                    if(re.search("[89]", number)):
+                        raise AssemblyError(self.line_num, "Invalid octal number {}".format(number))
+                    term = int(number, 8)
+                else:
+                    term = self.location
+                pos = match.end()
+
+            # A term separated only by whitespace starts a new field.
+            if(op == None):
+                fields |= value
+                value = 0
+                op = "!"
+            if(op == "+"):
+                value += term
+            elif(op == "-"):
+                value -= term
+            elif(op == "&"):
+                value &= term
+            else:
+                value |= term
+            value &= 0o7777
+            op = None
+        return fields | value
+
+    def _memory_reference(self, stmt: str):
+        words = stmt.split(None, 1)
+        value = MRI_SYMBOLS[words[0]]
+        rest = words[1] if len(words) > 1 else ""
+
+        # Indirect and page zero markers.
+        match = re.match(r"\s*([IZ])(?![A-Z0-9])", rest)
+        while(match != None):
+            if(match.group(1) == "I"):
+                value |= 0o400
+            rest = rest[match.end():]
+            match = re.match(r"\s*([IZ])(?![A-Z0-9])", rest)
+
+        address = self._evaluate(rest)
+        if(address & 0o7600 == 0):
+            return value | address
+        if(address & 0o7600 == self.location & 0o7600):
+            return value | 0o200 | (address & 0o177)
+        if(self.final):
+            raise AssemblyError(self.line_num, "Off page reference to {:04o}".format(address))
+        return value
+
+def assemble(text: str):
+    return Assembler(text).assemble()
+
+# Assemble to a core image holding only the words the program loads.
+def assemble_core_image(text: str):
+    assembler = Assembler(text)
+    return bn.CoreImage.from_field(assembler.assemble(), assembler.loaded)
+
+def _source_key(source: bytes):
+    return hashlib.sha256("v{}\n".format(ASSEMBLER_VERSION).encode() + source).hexdigest()
+
+# Assemble a source file, reusing earlier results for identical sources.
+# Results are also stored in cache_dir if provided.
+def load_source_image(path: str, cache_dir: str = None):
+    with open(path, "rb") as fp:
+        source = fp.read()
+    key = _source_key(source)
+    if(key in _image_cache):
+        tracing.event("assembled_image_hit", "cache", path=path)
+        return _image_cache[key]
+
+    image = None
+    cache_path = os.path.join(cache_dir, "{}.core".format(key)) if cache_dir != None else None
+    if(cache_path != None):
+        try:
+            with open(cache_path, "rb") as fp:
+                image = bn.CoreImage.deserialize(fp.read())
+        except (OSError, ValueError, struct.error):
+            pass
+
+    if(image == None):
+        with tracing.span("assemble", path=path, bytes_read=len(source)):
+            image = assemble_core_image(source.decode("ascii", errors="replace"))
+        if(cache_path != None):
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(cache_path + ".tmp", "wb") as fp:
+                    fp.write(image.serialize())
+                os.replace(cache_path + ".tmp", cache_path)
+            except OSError:
+                pass # Disk cache is only an optimization.
+
+    _image_cache[key] = image
+    return image
+
+# Source files a BIN file may be assembled from.
+def source_paths(bin_path: str):
+    stem = os.path.splitext(bin_path)[0]
+    return [stem + ".pa", stem + ".tx"]
+
+# Find the file a BIN file's image comes from; either the BIN file itself or, if it doesn't exist, its source.
+def resolve_image_path(bin_path: str):
+    if(os.path.exists(bin_path)):
+        return bin_path
+    for path in source_paths(bin_path):
+        if(os.path.exists(path)):
+            return path
+    raise FileNotFoundError("No such file or source: '{}'".format(bin_path))
+
+# Load the core image for a BIN file, assembling it from its source if the BIN file doesn't exist.
+def load_core_image(bin_path: str, cache_dir: str = None):
+    path = resolve_image_path(bin_path)
+    if(path == bin_path):
+        return bn.load_core_image(bin_path, cache_dir)
+    return load_source_image(path, cache_dir)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='DIAL-MS PAL8 Assembler', description='Assemble a PAL8 source file to a core image.')
+    parser.add_argument("-o", "--output-path", required=True, help="Output core image path.")
+    parser.add_argument("-i", "--input-path", required=True, help="Input source path.")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+
+    try:
+        with open(parsed.input_path, "r", errors="replace") as fp:
+            source = fp.read()
+        with tracing.span("assemble", path=parsed.input_path, bytes_read=len(source)) as sp:
+            image = assemble(source)
+            sp.set(bytes_written=len(image))
+    except OSError as excpt:
+        sys.exit("Failed to read source file '{}': {}".format(parsed.input_path, excpt))
+    except AssemblyError as excpt:
+        sys.exit("Failed to assemble '{}': {}".format(parsed.input_path, excpt))
+
+    try:
+        with open(parsed.output_path, "wb") as fp:
+            fp.write(image)
+    except OSError as excpt:
+        sys.exit("Failed to write output file '{}': {}".format(parsed.output_path, excpt))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+    sys.exit(0)
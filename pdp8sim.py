@@ -0,0 +1,601 @@
+import argparse
+import collections
+import json
+import os
+import struct
+import sys
+import time
+import bin2img as bn
+import imginfo
+import sdsksrv
+import tracing
+from cmn import *
+
+# Headless PDP-12 simulator, for smoke booting generated images without hardware or a full emulator.
+# It covers PDP-8 mode with memory extension, the RK8 disk controller, the second serial line the sdsk handler talks
+# to a Serial Disk over, and just enough of LINC mode for the system bootstrap (BOOTCK, CHECKF and BOOTER) to run.
+# A boot runs the media's bootloader from location 20: it reads the I/O routines into field 1 and jumps to the system
+# bootstrap, which reads DIAL into field 0 through the unit table and the system unit's handler, then enters it at 4021.
+# A rebootstrap then runs the system handler's rebootstrap entry, which reads the I/O routines into field 0 and
+# bootstraps from there; without the patches (-p) CHECKF re-reads the routines with LINCtape instructions instead.
+FIELD_SIZE = 0o10000
+FIELD_COUNT = 8
+SEGMENT_SIZE = 0o2000 # LINC mode addresses 1K segments of memory.
+
+SYS_UNIT = 0o100
+DIAL_BLOCK = 0o300
+DIAL_SIZE = 0o10
+DIAL_CORE = 0o4000
+DIAL_ENTRY = 0o4021
+UNIT_TABLE = 0o7300
+
+# Handlers are assembled at 0230, their rebootstrap entry (a CDF 10) is at 0357.
+REBOOT_OFFSET = 0o157
+REBOOT_INSTRUCTION = 0o6211
+
+MAX_INSTRUCTIONS = 2000000
+
+BOOTLOADERS = {
+    'rk08': "bootloader/rk08-bootloader.rim",
+    'rk01': "bootloader/rk08-bootloader.rim",
+    'rk05': "bootloader/rk08-bootloader.rim",
+    'sdsk': "bootloader/sdsk-bootloader.rim",
+}
+BOOTLOADER_START = 0o20
+
+# The simulation stopped, either by entering DIAL or for the given reason.
+class SimStop(Exception):
+    def __init__(self, reason: str, entered: bool = False):
+        super().__init__(reason)
+        self.entered = entered
+
+def load_rim(path: str):
+    with open_file(path, "rb") as fp:
+        data = fp.read()
+    try:
+        return bn.decode_rim(data)
+    except ValueError as excpt:
+        raise FormatError("RIM tape '{}' is improperly formatted: {}".format(path, excpt))
+
+# Words of a run of blocks of an image, masked to 12 bits.
+def image_words(image, start: int, num: int = 1):
+    data = image[start * BYTES_PER_BLOCK:(start + num) * BYTES_PER_BLOCK]
+    return [word & 0o7777 for word in struct.unpack("<{}H".format(len(data) // BYTES_PER_WORD), data)]
+
+# Record a transfer, extending the last one if it carries on from it.
+def add_transfer(transfers: list, kind: str, start: int, count: int):
+    if(len(transfers) != 0 and transfers[-1][0] == kind and transfers[-1][1] + transfers[-1][2] == start):
+        transfers[-1][2] += count
+    else:
+        transfers.append([kind, start, count])
+
+# RK8 disk controller (IOTs 673x-675x), with drive 0 being the image. Transfers complete as soon as they're started.
+class RK8:
+    STATUS_ERROR = 0o0001
+
+    def __init__(self, image: bytearray):
+        self.image = image
+        self.command = 0
+        self.address = 0
+        self.current = 0
+        self.count = 0
+        self.status = 0
+        self.done = False
+        self.transfers = []
+
+    def _transfer(self, cpu, write: bool):
+        drive = (self.command >> 1) & 0o3
+        field = (self.command >> 3) & 0o7
+        block = drive * FIELD_SIZE + self.address
+        words = -self.count & 0o7777 or FIELD_SIZE
+        blocks = -(-words // WORDS_PER_BLOCK)
+        self.done = False
+        if((block + blocks) * BYTES_PER_BLOCK > len(self.image)):
+            self.status |= self.STATUS_ERROR
+            return
+        add_transfer(self.transfers, "write" if write else "read", block, blocks)
+        mem = cpu.mem
+        base = field * FIELD_SIZE
+        offset = block * BYTES_PER_BLOCK
+        if(write):
+            for _ in range(words):
+                self.current = (self.current + 1) & 0o7777
+                struct.pack_into("<H", self.image, offset, mem[base | self.current])
+                offset += BYTES_PER_WORD
+        else:
+            for word in image_words(self.image, block, blocks)[:words]:
+                self.current = (self.current + 1) & 0o7777
+                mem[base | self.current] = word
+        self.count = 0
+        self.done = True
+
+    # Returns (ac, skip).
+    def iot(self, cpu, ins: int, ac: int):
+        if(ins == 0o6732):   # DLDC
+            self.command = ac
+            self.done = False
+            return 0, False
+        elif(ins == 0o6733): # DLDR
+            self.address = ac
+            self._transfer(cpu, False)
+            return 0, False
+        elif(ins == 0o6735): # DLDW
+            self.address = ac
+            self._transfer(cpu, True)
+            return 0, False
+        elif(ins == 0o6734): # DRDA
+            return ac | self.address, False
+        elif(ins == 0o6736): # DRDC
+            return ac | self.command, False
+        elif(ins == 0o6741): # DRDS
+            return ac | self.status, False
+        elif(ins == 0o6742): # DCLS
+            self.status &= ~ac
+            if(ac == 0o7777):
+                self.done = False
+            return ac, False
+        elif(ins == 0o6745): # DSKC
+            if(not self.done and self.status == 0):
+                raise SimStop("waiting on an RK8 transfer that was never started")
+            return ac, self.done
+        elif(ins == 0o6747): # DSKE
+            return ac, self.status != 0
+        elif(ins == 0o6751): # DCLA
+            self.command = self.status = 0
+            self.done = True
+            return ac, False
+        elif(ins == 0o6752): # DRWC
+            return ac | self.count, False
+        elif(ins == 0o6753): # DLWC
+            self.count = ac
+            return 0, False
+        elif(ins == 0o6755): # DLCA
+            self.current = ac
+            return 0, False
+        elif(ins == 0o6757): # DRCA
+            return ac | self.current, False
+        raise SimStop("unsupported RK8 instruction {:04o}".format(ins))
+
+# A Serial Disk on the second serial line (IOTs 640x and 641x), following the protocol sdsksrv serves,
+# with the image as disk A. Replies are queued as soon as a request is complete.
+class SerialDisk:
+    def __init__(self, image: bytearray):
+        self.disks = {"A": image}
+        self.rx = collections.deque()
+        self.transfers = []
+        self.session = self._session()
+        next(self.session)
+
+    def _recv_words(self, count: int):
+        words = []
+        for _ in range(count):
+            low = yield
+            high = yield
+            words.append((low | (high & 0o77) << 6) & 0o7777)
+        return words
+
+    def _session(self):
+        while True:
+            letter = yield
+            unit, buff, block, count = yield from self._recv_words(4)
+            write = unit & sdsksrv.WRITE_FLAG != 0
+            unit &= ~sdsksrv.WRITE_FLAG & 0o7777
+            self.rx.extend(sdsksrv.word_chars((buff & 0o17) << 8) + sdsksrv.word_chars(0o6201 | (buff >> 1) & 0o70) + sdsksrv.word_chars(-(count * WORDS_PER_BLOCK) & 0o7777))
+            image = self.disks.get(chr(letter & 0o177))
+            start = (unit & 0o7) * sdsksrv.PARTITION_BLOCKS + block
+            if(image == None or block + count > sdsksrv.PARTITION_BLOCKS or (start + count) * BYTES_PER_BLOCK > len(image)):
+                self.rx.extend(sdsksrv.word_chars(sdsksrv.ACK_ERROR))
+                continue
+            add_transfer(self.transfers, "write" if write else "read", start, count)
+            if(not write):
+                self.rx.extend(sdsksrv.word_chars(sdsksrv.ACK_READ) + sdsksrv.encode_words(image[start * BYTES_PER_BLOCK:(start + count) * BYTES_PER_BLOCK]))
+            else:
+                self.rx.extend(sdsksrv.word_chars(sdsksrv.ACK_WRITE))
+                chars = bytearray()
+                for _ in range(count * WORDS_PER_BLOCK * 2):
+                    chars.append((yield))
+                image[start * BYTES_PER_BLOCK:(start + count) * BYTES_PER_BLOCK] = sdsksrv.decode_words(chars)
+            self.rx.extend(sdsksrv.word_chars(sdsksrv.ACK_DONE))
+
+    def iot(self, cpu, ins: int, ac: int):
+        if(ins == 0o6401):   # KSF2
+            if(len(self.rx) == 0):
+                raise SimStop("waiting on a Serial Disk reply that will never come")
+            return ac, True
+        elif(ins == 0o6402): # KCC2
+            return 0, False
+        elif(ins == 0o6404): # KRS2
+            return ac | self.rx[0], False
+        elif(ins == 0o6406): # KRB2
+            return self.rx.popleft(), False
+        elif(ins == 0o6411): # TSF2
+            return ac, True
+        elif(ins == 0o6412): # TCF2
+            return ac, False
+        elif(ins in (0o6414, 0o6416)): # TPC2, TLS2
+            self.session.send(ac & 0o377)
+            return ac, False
+        raise SimStop("unsupported serial instruction {:04o}".format(ins))
+
+# PDP-12 processor. The AC is kept with the link as its thirteenth bit.
+class PDP12:
+    def __init__(self):
+        self.mem = [0] * (FIELD_SIZE * FIELD_COUNT)
+        self.devices = {}
+        self.switches = 0
+        self.entry = None # Physical address that stops the simulation when jumped to in LINC mode.
+        self.reset(0, 0)
+
+    def reset(self, field: int, pc: int):
+        self.pc = pc
+        self.ac = 0
+        self.mq = 0
+        self.ifield = self.dfield = self.ib = field
+        self.linc = False
+        self.lif = self.ldf = 0
+        self.pending_lif = None
+        self.count = 0
+
+    def attach(self, codes, device):
+        for code in codes:
+            self.devices[code] = device
+
+    def load(self, words, field: int = 0):
+        for address, word in words:
+            self.mem[field * FIELD_SIZE | address] = word
+
+    def location(self):
+        if(self.linc):
+            address = self.lif * SEGMENT_SIZE + self.pc
+            return "{:o}.{:04o} (LINC mode)".format(address >> 12, address & 0o7777)
+        return "{:o}.{:04o}".format(self.ifield, self.pc)
+
+    # Run until the simulation stops or limit instructions have run in total.
+    def run(self, limit: int):
+        while(self.count < limit):
+            if(self.linc):
+                self._run_linc(limit)
+            else:
+                self._run_pdp8(limit)
+        raise SimStop("still running after {} instructions, at {}".format(self.count, self.location()))
+
+    def _run_pdp8(self, limit: int):
+        mem = self.mem
+        pc = self.pc
+        ac = self.ac
+        ifb = self.ifield << 12
+        dfb = self.dfield << 12
+        count = self.count
+        while(count < limit):
+            ins = mem[ifb | pc]
+            cur = pc
+            pc = (pc + 1) & 0o7777
+            count += 1
+            op = ins >> 9
+            if(op < 6):
+                addr = ins & 0o177
+                if(ins & 0o200):
+                    addr |= cur & 0o7600
+                fb = ifb
+                if(ins & 0o400):
+                    ptr = ifb | addr
+                    if(addr & 0o7770 == 0o10):
+                        mem[ptr] = (mem[ptr] + 1) & 0o7777
+                    addr = mem[ptr]
+                    fb = dfb
+                if(op == 0):   # AND
+                    ac &= mem[fb | addr] | 0o10000
+                elif(op == 1): # TAD
+                    ac = (ac + mem[fb | addr]) & 0o17777
+                elif(op == 2): # ISZ
+                    word = (mem[fb | addr] + 1) & 0o7777
+                    mem[fb | addr] = word
+                    if(word == 0):
+                        pc = (pc + 1) & 0o7777
+                elif(op == 3): # DCA
+                    mem[fb | addr] = ac & 0o7777
+                    ac &= 0o10000
+                elif(op == 4): # JMS
+                    ifb = self.ib << 12
+                    mem[ifb | addr] = pc
+                    pc = (addr + 1) & 0o7777
+                else:          # JMP
+                    ifb = self.ib << 12
+                    pc = addr
+            elif(op == 7):
+                if(ins & 0o400 == 0): # Group 1
+                    if(ins & 0o200):
+                        ac &= 0o10000
+                    if(ins & 0o100):
+                        ac &= 0o7777
+                    if(ins & 0o40):
+                        ac ^= 0o7777
+                    if(ins & 0o20):
+                        ac ^= 0o10000
+                    if(ins & 0o1):
+                        ac = (ac + 1) & 0o17777
+                    if(ins & 0o10):   # RAR, RTR
+                        for _ in range(2 if ins & 0o2 else 1):
+                            ac = ac >> 1 | (ac & 1) << 12
+                    elif(ins & 0o4):  # RAL, RTL
+                        for _ in range(2 if ins & 0o2 else 1):
+                            ac = (ac << 1 | ac >> 12) & 0o17777
+                    elif(ins & 0o2):  # BSW
+                        ac = (ac & 0o10000) | (ac & 0o77) << 6 | (ac >> 6) & 0o77
+                elif(ins & 0o1 == 0): # Group 2
+                    skip = (ins & 0o100 and ac & 0o4000) or (ins & 0o40 and ac & 0o7777 == 0) or (ins & 0o20 and ac & 0o10000)
+                    if(bool(skip) != bool(ins & 0o10)):
+                        pc = (pc + 1) & 0o7777
+                    if(ins & 0o200):
+                        ac &= 0o10000
+                    if(ins & 0o4):
+                        ac |= self.switches
+                    if(ins & 0o2):
+                        self.pc, self.ac, self.count = pc, ac, count
+                        self.ifield = ifb >> 12
+                        raise SimStop("halted at {:o}.{:04o} with AC {:04o}".format(self.ifield, cur, ac & 0o7777))
+                else:                 # Group 3, only the MQ microinstructions.
+                    if(ins & 0o56):
+                        self.pc, self.count = cur, count
+                        self.ifield = ifb >> 12
+                        raise SimStop("unsupported EAE instruction {:04o} at {}".format(ins, self.location()))
+                    mq = self.mq
+                    if(ins & 0o200):
+                        ac &= 0o10000
+                    if(ins & 0o20):  # MQL
+                        self.mq = ac & 0o7777
+                        ac &= 0o10000
+                    if(ins & 0o100): # MQA
+                        ac |= mq
+            else:
+                self.pc, self.ac, self.count = pc, ac, count
+                self.ifield, self.dfield = ifb >> 12, dfb >> 12
+                try:
+                    self._iot(ins)
+                except SimStop:
+                    self.pc = cur
+                    raise
+                if(self.linc):
+                    return
+                pc, ac = self.pc, self.ac
+                ifb, dfb = self.ifield << 12, self.dfield << 12
+        self.pc, self.ac, self.count = pc, ac, count
+        self.ifield, self.dfield = ifb >> 12, dfb >> 12
+
+    # Run an IOT, from either mode. In LINC mode the fields read back are its 5 bit segment registers.
+    def _iot(self, ins: int):
+        skip = False
+        if(ins & 0o7700 == 0o6200 and ins & 0o7 != 0o4): # CDF, CIF
+            field = (ins >> 3) & 0o7
+            if(ins & 0o1):
+                self.dfield = field
+            if(ins & 0o2):
+                self.ib = field
+        elif(ins == 0o6214): # RDF
+            self.ac |= self.ldf << 1 if self.linc else self.dfield << 3
+        elif(ins == 0o6224): # RIF
+            self.ac |= self.lif << 1 if self.linc else self.ifield << 3
+        elif(ins == 0o6234): # RIB
+            self.ac |= self.ifield << 3 | self.dfield
+        elif(ins in (0o6000, 0o6001, 0o6002)): # Interrupts are never requested.
+            pass
+        elif(ins == 0o6141): # LINC
+            address = self.ifield * FIELD_SIZE + self.pc
+            self.linc = True
+            self.lif = address // SEGMENT_SIZE
+            self.ldf = self.dfield << 2 | self.lif & 0o3
+            self.pc = address % SEGMENT_SIZE
+            self.pending_lif = None
+        else:
+            device = self.devices.get((ins >> 3) & 0o77)
+            if(device == None):
+                return # Nothing answers IOTs for devices that aren't there, e.g. BOOTCK reading the RK8 on a Serial Disk system.
+            ac, skip = device.iot(self, ins, self.ac & 0o7777)
+            self.ac = self.ac & 0o10000 | ac & 0o7777
+        if(skip):
+            self.pc = (self.pc + 1) % (SEGMENT_SIZE if self.linc else FIELD_SIZE)
+
+    def _linc_address(self, address: int):
+        return (self.ldf if address & 0o2000 else self.lif) * SEGMENT_SIZE + (address & 0o1777)
+
+    # The LINC mode instructions the bootstrap uses; anything else stops the simulation.
+    def _run_linc(self, limit: int):
+        mem = self.mem
+        while(self.linc and self.count < limit):
+            cur = self.pc
+            ins = mem[self.lif * SEGMENT_SIZE + cur]
+            self.pc = (cur + 1) & 0o1777
+            self.count += 1
+            if(ins == 0o0000):   # HLT
+                self.pc = cur
+                raise SimStop("halted at {}".format(self.location()))
+            elif(ins == 0o0002): # PDP
+                address = self.lif * SEGMENT_SIZE + self.pc
+                self.linc = False
+                self.ifield = self.ib = address // FIELD_SIZE
+                self.dfield = self.ldf >> 2
+                self.pc = address % FIELD_SIZE
+            elif(ins == 0o0004): # ESF, only sets display and keyboard options.
+                pass
+            elif(ins == 0o0011): # CLR
+                self.ac = 0
+            elif(ins == 0o0500): # IOB
+                iot = mem[self.lif * SEGMENT_SIZE + self.pc]
+                self.pc = (self.pc + 1) & 0o1777
+                self._iot(iot)
+            elif(ins & 0o7740 == 0o0600): # LIF
+                self.pending_lif = ins & 0o37
+            elif(ins & 0o7740 == 0o0640): # LDF
+                self.ldf = ins & 0o37
+            elif(ins & 0o7740 == 0o1000 or ins & 0o7740 == 0o1400): # LDA, SHD with the address or operand following.
+                operand = mem[self.lif * SEGMENT_SIZE + self.pc]
+                self.pc = (self.pc + 1) & 0o1777
+                if(ins & 0o17 != 0):
+                    raise SimStop("unsupported indexed LINC instruction {:04o} at {}".format(ins, self.location()))
+                if(ins & 0o20 == 0):
+                    word = mem[self._linc_address(operand)]
+                    half = word & 0o77 if operand & 0o4000 else word >> 6
+                else:
+                    word = operand
+                    half = word & 0o77
+                if(ins & 0o7740 == 0o1000):
+                    self.ac = self.ac & 0o10000 | word
+                elif(self.ac & 0o77 != half):
+                    self.pc = (self.pc + 1) & 0o1777
+            elif(ins & 0o6000 == 0o4000): # STC
+                mem[self.lif * SEGMENT_SIZE + (ins & 0o1777)] = self.ac & 0o7777
+                self.ac &= 0o10000
+            elif(ins & 0o6000 == 0o6000): # JMP
+                target = ins & 0o1777
+                if(target != 0):
+                    mem[self.lif * SEGMENT_SIZE] = 0o6000 | self.pc
+                if(self.pending_lif != None):
+                    self.lif, self.pending_lif = self.pending_lif, None
+                self.pc = target
+                if(self.lif * SEGMENT_SIZE + target == self.entry):
+                    raise SimStop("entered DIAL", True)
+            elif(ins & 0o7700 == 0o0700):
+                self.pc = cur
+                raise SimStop("LINCtape instruction {:04o} at {}".format(ins, self.location()))
+            else:
+                self.pc = cur
+                raise SimStop("unsupported LINC instruction {:04o} at {}".format(ins, self.location()))
+
+class BootResult:
+    def __init__(self, path: str, reason: str = None):
+        self.path = path
+        self.booted = False
+        self.rebooted = None
+        self.reason = reason
+        self.instructions = 0
+        self.seconds = 0
+        self.transfers = None
+
+    def report(self):
+        return {"path": self.path, "booted": self.booted, "rebooted": self.rebooted, "reason": self.reason,
+                "instructions": self.instructions, "ms": round(self.seconds * 1000, 3), "transfers": self.transfers}
+
+# Check that field 0 holds the DIAL blocks of the system unit once DIAL has been entered.
+def check_dial(cpu: PDP12, image):
+    expected = image_words(image, DIAL_BLOCK, DIAL_SIZE)
+    loaded = cpu.mem[DIAL_CORE:DIAL_CORE + len(expected)]
+    if(loaded != expected):
+        first = next(idx for idx in range(len(expected)) if loaded[idx] != expected[idx])
+        raise SimStop("entered DIAL, but 0.{:04o} doesn't match block {:o} of the image".format(DIAL_CORE + first, DIAL_BLOCK + first // WORDS_PER_BLOCK))
+
+# Find the system unit's handler in the unit table the I/O routines were loaded with.
+def system_handler(cpu: PDP12):
+    base = FIELD_SIZE + UNIT_TABLE
+    for entry in range(base, FIELD_SIZE * 2 - 2, 3):
+        if(cpu.mem[entry] == 0o7777):
+            break
+        if(cpu.mem[entry] == SYS_UNIT):
+            return cpu.mem[entry + 1]
+    raise SimStop("the unit table has no entry for the system unit")
+
+# Run one stage of a boot until DIAL is entered; cpu.count is left as the number of instructions it took.
+def run_stage(cpu: PDP12, image, limit: int):
+    try:
+        cpu.run(limit)
+    except SimStop as stop:
+        if(not stop.entered):
+            raise
+    check_dial(cpu, image)
+
+# Boot an image from its bootloader, and then rebootstrap it if reboot is set.
+def boot_image(path: str, media: str, reboot: bool = False, limit: int = MAX_INSTRUCTIONS, bootloader: str = None):
+    result = BootResult(path)
+    start = time.perf_counter()
+    with tracing.span("boot_image", path=path, media=media) as sp:
+        if(media not in BOOTLOADERS):
+            raise ConfigError("Can't boot {} images, only {}".format(media, ", ".join(BOOTLOADERS)))
+        image = bytearray(imginfo.read_image(path, media))
+        cpu = PDP12()
+        cpu.entry = DIAL_ENTRY
+        cpu.load(load_rim(bootloader or BOOTLOADERS[media]))
+        disk = SerialDisk(image) if media == 'sdsk' else RK8(image)
+        cpu.attach((0o40, 0o41) if media == 'sdsk' else (0o73, 0o74, 0o75), disk)
+
+        try:
+            cpu.reset(0, BOOTLOADER_START)
+            run_stage(cpu, image, limit)
+            result.booted = True
+            if(reboot):
+                result.rebooted = False
+                handler = system_handler(cpu)
+                entry = (handler & 0o7600) + REBOOT_OFFSET
+                if(cpu.mem[FIELD_SIZE + entry] != REBOOT_INSTRUCTION):
+                    raise SimStop("the system handler at {:04o} has no rebootstrap entry".format(handler))
+                cpu.mem[0:FIELD_SIZE] = [0] * FIELD_SIZE
+                result.instructions = cpu.count
+                cpu.reset(1, entry)
+                run_stage(cpu, image, limit)
+                result.rebooted = True
+        except SimStop as stop:
+            result.reason = str(stop)
+        # Counted whether or not the last stage got to DIAL; reset() starts each stage's count over.
+        result.instructions += cpu.count
+        result.transfers = disk.transfers
+        result.seconds = time.perf_counter() - start
+        sp.set(booted=result.booted, rebooted=result.rebooted, instructions=result.instructions)
+    return result
+
+def _boot_worker(path: str, media: str, reboot: bool, limit: int, bootloader: str):
+    try:
+        return boot_image(path, media, reboot, limit, bootloader)
+    except DialError as excpt:
+        return BootResult(path, reason=str(excpt))
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='DIAL-MS Boot Simulator', description='Smoke boot DIAL-MS images on a headless PDP-12 simulator, from their bootloader through to DIAL.')
+    parser.add_argument("inputs", nargs="+", help="Image paths, globs, or directories (searched recursively for images).")
+    parser.add_argument("-m", "--media", choices=sorted(BOOTLOADERS), help="Media type of the images; by default it's taken from each image's extension.")
+    parser.add_argument("--reboot", action="store_const", const=True, help="After booting, rebootstrap through the system handler as DIAL does; this needs the patches (-p) on non-LINCtape systems.")
+    parser.add_argument("--bootloader", help="RIM bootloader to boot with instead of the media's one in bootloader/.")
+    parser.add_argument("--max-instructions", type=int, default=MAX_INSTRUCTIONS, help="Fail a boot (and rebootstrap) that hasn't entered DIAL after this many instructions (default {}).".format(MAX_INSTRUCTIONS))
+    parser.add_argument("--json", action="store_const", const=True, help="Print each result as a line of JSON instead of a summary.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of images booted at once (default is the number of CPUs).")
+    parser.add_argument("-q", "--quiet", action="store_const", const=True, help="Only report failures and the summary.")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+
+    paths = imginfo.find_images(parsed.inputs)
+    jobs = []
+    for path in paths:
+        media = parsed.media or imginfo.media_from_path(path)
+        if(media == None):
+            raise ConfigError("Can't tell the media type of '{}', use --media".format(path))
+        if(media == 'linc' and parsed.media == None and len(paths) > 1):
+            continue # Builds output a LINCtape image alongside every other one.
+        jobs.append((path, media, parsed.reboot != None, parsed.max_instructions, parsed.bootloader))
+
+    start = time.perf_counter()
+    if(parsed.jobs <= 1 or len(jobs) <= 1):
+        results = [_boot_worker(*job) for job in jobs]
+    else:
+        from concurrent.futures import ProcessPoolExecutor # Slow to import, only loaded for parallel boots.
+        with ProcessPoolExecutor(max_workers=parsed.jobs) as pool:
+            results = list(pool.map(_boot_worker, *zip(*jobs)))
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    for result in results:
+        ok = result.booted and result.rebooted != False
+        failed += 0 if ok else 1
+        if(parsed.json != None):
+            print(json.dumps(result.report()))
+        elif(not ok):
+            print("FAIL {}: {}{}".format(result.path, "rebootstrap " if result.booted else "", result.reason), file=sys.stderr)
+        elif(parsed.quiet == None):
+            print("ok   {} ({} instructions, {:.1f} ms)".format(result.path, result.instructions, result.seconds * 1000))
+    if(parsed.json == None):
+        print("Booted {} of {} images in {:.2f} s".format(len(results) - failed, len(results), elapsed))
+    if(failed != 0):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
@@ -0,0 +1,402 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import signal
+import socket
+import time
+import tracing
+from cmn import *
+from mapimg import MappedImage
+
+# Serial Disk server for the sdsk handler (handlers/sdsk-handler.pa, version C), serving images over a pty or TCP.
+# Each request goes:
+#   handler -> server: disk letter, then the unit (with 4000 set for writes), buffer, block, and block count words,
+#                      each word as two characters: its low 8 bits, then its top 6.
+#   server -> handler: buffer address, CDF instruction, negated word count, then acknowledgement words:
+#                      4000 is followed by the data read, 4001 by the handler sending the data to write, 0 ends the
+#                      request, and anything positive is an error (the handler halts).
+#                      Words sent to the handler are two 6 bit characters, top first.
+# The disk letter selects one of the served images, and the low three bits of the unit number select its 01000 block partition.
+DISK_LETTERS = "ABCDEFG"
+PARTITION_BLOCKS = 0o1000
+WRITE_FLAG = 0o4000
+
+ACK_DONE = 0o0000
+ACK_ERROR = 0o0001
+ACK_READ = 0o4000
+ACK_WRITE = 0o4001
+
+# Encoded blocks kept per unit, blocks read ahead of sequential reads, and seconds between write-backs.
+CACHE_BLOCKS = 0o100
+READ_AHEAD_BLOCKS = 0o10
+FLUSH_INTERVAL = 0.5
+
+# Number of recent request latencies kept per unit.
+LATENCY_HISTORY = 1000
+
+# Translation tables for converting whole blocks of words to and from characters at once.
+_TOP_FROM_HIGH = bytes((b & 0x0F) << 2 for b in range(0x100))
+_TOP_FROM_LOW = bytes(b >> 6 for b in range(0x100))
+_LOW_SIX = bytes(b & 0o77 for b in range(0x100))
+_HIGH_FROM_TOP = bytes((b & 0o77) >> 2 for b in range(0x100))
+
+def word_chars(word: int) -> bytes:
+    return bytes([(word >> 6) & 0o77, word & 0o77])
+
+# Encode blocks of 16 bit words as the characters sent to the handler.
+def encode_words(data) -> bytes:
+    data = bytes(data)
+    lo, hi = data[0::2], data[1::2]
+    chars = bytearray(len(data))
+    chars[0::2] = (int.from_bytes(hi.translate(_TOP_FROM_HIGH), "little") | int.from_bytes(lo.translate(_TOP_FROM_LOW), "little")).to_bytes(len(lo), "little")
+    chars[1::2] = lo.translate(_LOW_SIX)
+    return bytes(chars)
+
+# Decode characters sent by the handler (low 8 bits, then top 6) to 16 bit words.
+def decode_words(chars: bytes) -> bytes:
+    data = bytearray(len(chars))
+    data[0::2] = chars[0::2]
+    data[1::2] = chars[1::2].translate(_HIGH_FROM_TOP)
+    return bytes(data)
+
+class UnitStats:
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.blocks_read = 0
+        self.blocks_written = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+
+    def report(self, elapsed: float):
+        latencies = sorted(self.latencies)
+        def percentile(pct: float):
+            return None if len(latencies) == 0 else round(latencies[min(len(latencies) - 1, int(len(latencies) * pct))] * 1000, 3)
+        return {
+            "reads": self.reads,
+            "writes": self.writes,
+            "blocks_read": self.blocks_read,
+            "blocks_written": self.blocks_written,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "iops": round((self.reads + self.writes) / max(elapsed, 1e-9), 1),
+            "latency_ms": {"p50": percentile(0.50), "p99": percentile(0.99), "max": percentile(1.0)},
+        }
+
+# A served image, mapped into memory.
+# Reads are served from a per-unit cache of encoded blocks, which sequential reads fill ahead of time.
+# Writes go straight to the mapping and are written back to the file in coalesced runs every flush interval.
+class ServedDisk:
+    def __init__(self, letter: str, path: str, read_only: bool, cache_blocks: int, read_ahead: int):
+        self.letter = letter
+        self.path = path
+        self.read_only = read_only
+        self.cache_blocks = cache_blocks
+        self.read_ahead = read_ahead
+        try:
+            self.image = MappedImage.open(path, not read_only)
+        except (OSError, ValueError) as excpt:
+            raise ArtifactError("Failed to map image '{}': {}".format(path, excpt))
+        self.caches = collections.defaultdict(collections.OrderedDict)
+        self.next_block = {}
+        self.dirty = set()
+        self.stats = collections.defaultdict(UnitStats)
+
+    # Image block for a block of a unit's partition, raising ConfigError if it's out of range.
+    def image_block(self, unit: int, block: int, count: int):
+        start = (unit & 0o7) * PARTITION_BLOCKS + block
+        if(count < 0 or block + count > PARTITION_BLOCKS or start + count > self.image.block_count()):
+            raise ConfigError("Blocks {:o}-{:o} of unit {:o} are outside of disk {}".format(block, block + count - 1, unit, self.letter))
+        return start
+
+    def _encoded(self, unit: int, start: int):
+        cache = self.caches[unit & 0o7]
+        chars = cache.get(start)
+        if(chars != None):
+            cache.move_to_end(start)
+            return chars, True
+        chars = encode_words(self.image.block(start))
+        cache[start] = chars
+        if(len(cache) > self.cache_blocks):
+            cache.popitem(last=False)
+        return chars, False
+
+    def read(self, unit: int, start: int, count: int):
+        stats = self.stats[unit & 0o7]
+        chunks = []
+        for blk in range(start, start + count):
+            chars, hit = self._encoded(unit, blk)
+            chunks.append(chars)
+            if(hit):
+                stats.cache_hits += 1
+            else:
+                stats.cache_misses += 1
+        sequential = self.next_block.get(unit & 0o7) == start
+        self.next_block[unit & 0o7] = start + count
+        return b"".join(chunks), sequential
+
+    # Encode the blocks following a sequential read before they're asked for.
+    def fill_ahead(self, unit: int, start: int):
+        end = min(start + self.read_ahead, ((unit & 0o7) + 1) * PARTITION_BLOCKS, self.image.block_count())
+        if(start >= end):
+            return
+        self.image.prefetch(start, end - start)
+        for blk in range(start, end):
+            self._encoded(unit, blk)
+
+    def write(self, unit: int, start: int, chars: bytes):
+        data = decode_words(chars)
+        count = len(data) // BYTES_PER_BLOCK
+        self.image.block(start, count)[:] = data
+        cache = self.caches[unit & 0o7]
+        for blk in range(start, start + count):
+            cache.pop(blk, None)
+            self.dirty.add(blk)
+
+    # Write changed blocks back to the file, a run of contiguous blocks at a time.
+    def flush(self):
+        runs = 0
+        blocks = sorted(self.dirty)
+        self.dirty.clear()
+        run_start = None
+        for idx, blk in enumerate(blocks):
+            if(run_start == None):
+                run_start = blk
+            if(idx + 1 == len(blocks) or blocks[idx + 1] != blk + 1):
+                self.image.flush(run_start, blk + 1 - run_start)
+                runs += 1
+                run_start = None
+        return runs
+
+    def close(self):
+        self.image.close()
+
+class DiskServer:
+    def __init__(self, disks: dict):
+        self.disks = disks
+        self.start = time.perf_counter()
+
+    async def _recv_word(self, reader):
+        chars = await reader.readexactly(2)
+        return (chars[0] | (chars[1] & 0o77) << 6) & 0o7777
+
+    # Handle one request, whose disk letter has already been read.
+    async def _request(self, reader, writer, letter: int):
+        started = time.perf_counter()
+        unit, buff, block, count = [await self._recv_word(reader) for _ in range(4)]
+        write = unit & WRITE_FLAG != 0
+        unit &= ~WRITE_FLAG & 0o7777
+
+        # The buffer is given as a memory block number: field in the top bits, 0400 word block in the bottom four.
+        header = word_chars((buff & 0o17) << 8) + word_chars(0o6201 | (buff >> 1) & 0o70) + word_chars(-(count * WORDS_PER_BLOCK) & 0o7777)
+        disk = self.disks.get(chr(letter & 0o177))
+        stats = disk.stats[unit & 0o7] if disk != None else None
+        try:
+            if(disk == None):
+                raise ConfigError("No disk {}".format(chr(letter & 0o177)))
+            if(count * WORDS_PER_BLOCK > 0o10000):
+                raise ConfigError("Can't transfer {:o} blocks at once".format(count))
+            start = disk.image_block(unit, block, count)
+            if(write and disk.read_only):
+                raise ConfigError("Disk {} is read only".format(disk.letter))
+        except ConfigError as excpt:
+            tracing.event("sdsk_error", "sdsk", error=str(excpt))
+            if(stats != None):
+                stats.errors += 1
+            writer.write(header + word_chars(ACK_ERROR))
+            await writer.drain()
+            return
+
+        if(count == 0):
+            writer.write(header + word_chars(ACK_DONE))
+        elif(write):
+            writer.write(header + word_chars(ACK_WRITE))
+            await writer.drain()
+            disk.write(unit, start, await reader.readexactly(count * WORDS_PER_BLOCK * 2))
+            writer.write(word_chars(ACK_DONE))
+            stats.writes += 1
+            stats.blocks_written += count
+        else:
+            chars, sequential = disk.read(unit, start, count)
+            writer.write(header + word_chars(ACK_READ) + chars + word_chars(ACK_DONE))
+            stats.reads += 1
+            stats.blocks_read += count
+            if(sequential):
+                disk.fill_ahead(unit, start + count)
+        await writer.drain()
+        stats.latencies.append(time.perf_counter() - started)
+
+    async def handle(self, reader, writer):
+        sock = writer.get_extra_info("socket")
+        if(sock != None and sock.family in (socket.AF_INET, socket.AF_INET6)):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while(True):
+                letter = await reader.read(1)
+                if(letter == b""):
+                    break
+                await self._request(reader, writer, letter[0])
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def flush(self):
+        return sum(disk.flush() for disk in self.disks.values())
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        units = {}
+        for letter, disk in sorted(self.disks.items()):
+            for unit, stats in sorted(disk.stats.items()):
+                units["{}{:o}".format(letter, unit)] = stats.report(elapsed)
+        return {"uptime": round(elapsed, 3), "units": units}
+
+    def close(self):
+        for disk in self.disks.values():
+            disk.close()
+
+# Open a pty for a client (an emulator or a serial bridge) to connect to, returning its reader, writer, and name.
+# Our end of the terminal side is kept open so the pty stays usable while clients come and go.
+async def open_pty():
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(master, "rb", buffering=0))
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(os.dup(master), "wb", buffering=0))
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop), os.ttyname(slave)
+
+def _print_report(report: dict):
+    for name, unit in report["units"].items():
+        latency = unit["latency_ms"]
+        print("{}: {} reads ({} blocks), {} writes ({} blocks), {} errors, {:.1f} IOPS, cache {}/{}, latency p50 {} ms p99 {} ms max {} ms".format(
+            name, unit["reads"], unit["blocks_read"], unit["writes"], unit["blocks_written"], unit["errors"], unit["iops"],
+            unit["cache_hits"], unit["cache_hits"] + unit["cache_misses"], latency["p50"], latency["p99"], latency["max"]), file=sys.stderr)
+
+async def serve(server: DiskServer, host: str, port: int, ptys: list, report_interval: float, stats_path: str, flush_interval: float):
+    tasks = []
+    links = []
+    if(port != None):
+        listener = await asyncio.start_server(server.handle, host, port)
+        print("Serving on {}:{}".format(host, port))
+        tasks.append(asyncio.ensure_future(listener.serve_forever()))
+    for link in ptys:
+        reader, writer, name = await open_pty()
+        if(link != ""):
+            if(os.path.lexists(link)):
+                os.unlink(link)
+            os.symlink(name, link)
+            links.append(link)
+        print("Serving on {}{}".format(name, " ({})".format(link) if link != "" else ""))
+        tasks.append(asyncio.ensure_future(server.handle(reader, writer)))
+
+    async def write_back():
+        while(True):
+            await asyncio.sleep(flush_interval)
+            runs = server.flush()
+            if(runs != 0):
+                tracing.event("sdsk_flush", "sdsk", runs=runs)
+    tasks.append(asyncio.ensure_future(write_back()))
+
+    async def reporter():
+        while(True):
+            await asyncio.sleep(report_interval)
+            report = server.report()
+            for name, unit in report["units"].items():
+                tracing.counter("sdsk_" + name, reads=unit["reads"], writes=unit["writes"], iops=unit["iops"])
+            if(stats_path != None):
+                tmp_path = "{}.{}.tmp".format(stats_path, os.getpid())
+                with open(tmp_path, "w") as fp:
+                    json.dump(report, fp)
+                os.replace(tmp_path, stats_path)
+            else:
+                _print_report(report)
+    if(report_interval > 0):
+        tasks.append(asyncio.ensure_future(reporter()))
+
+    # Run until interrupted or terminated, writing everything back on the way out.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    tasks.append(asyncio.ensure_future(stop.wait()))
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        for link in links:
+            os.unlink(link)
+
+# Parse "PATH" or "LETTER=PATH" image arguments, giving images without a letter the next unused one.
+def assign_letters(images: list):
+    assigned = {}
+    unlettered = []
+    for entry in images:
+        letter, sep, path = entry.partition("=")
+        if(sep != "" and len(letter) == 1 and letter.upper() in DISK_LETTERS):
+            if(letter.upper() in assigned):
+                raise ConfigError("Disk {} given more than once".format(letter.upper()))
+            assigned[letter.upper()] = path
+        else:
+            unlettered.append(entry)
+    free = [letter for letter in DISK_LETTERS if letter not in assigned]
+    if(len(unlettered) > len(free)):
+        raise ConfigError("At most {} disks can be served".format(len(DISK_LETTERS)))
+    assigned.update(zip(free, unlettered))
+    return assigned
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='DIAL-MS Serial Disk Server', description='Serve Serial Disk images to the sdsk handler over a pty or TCP.')
+    parser.add_argument("images", nargs="+", help="Images to serve, as PATH or LETTER=PATH; images without a letter are given A, B, ... in order.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default 127.0.0.1).")
+    parser.add_argument("--port", type=int, help="TCP port to listen on.")
+    parser.add_argument("--pty", action="append", nargs="?", const="", metavar="LINK", help="Serve on a new pty, optionally symlinked at LINK; may be given more than once.")
+    parser.add_argument("--read-only", action="store_const", const=True, help="Never write to the images, writes are answered with an error.")
+    parser.add_argument("--cache-blocks", type=int, default=CACHE_BLOCKS, help="Encoded blocks cached per unit (default {}).".format(CACHE_BLOCKS))
+    parser.add_argument("--read-ahead", type=int, default=READ_AHEAD_BLOCKS, help="Blocks read ahead of sequential reads (default {}).".format(READ_AHEAD_BLOCKS))
+    parser.add_argument("--flush-interval", type=float, default=FLUSH_INTERVAL, help="Seconds between writing changed blocks back to the images (default {}).".format(FLUSH_INTERVAL))
+    parser.add_argument("--report", type=float, default=0, metavar="SECONDS", help="Report per-unit counters, IOPS and latencies every SECONDS.")
+    parser.add_argument("--stats-json", help="Write the reports to this file as JSON instead of printing them.")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+    if(parsed.port == None and parsed.pty == None):
+        parser.error("give --port, --pty, or both")
+
+    disks = {}
+    try:
+        for letter, path in sorted(assign_letters(parsed.images).items()):
+            disks[letter] = ServedDisk(letter, path, parsed.read_only != None, max(1, parsed.cache_blocks), max(0, parsed.read_ahead))
+            print("Disk {}: {}{}".format(letter, path, " (read only)" if parsed.read_only != None else ""))
+    except DialError:
+        for disk in disks.values():
+            disk.close()
+        raise
+
+    server = DiskServer(disks)
+    try:
+        asyncio.run(serve(server, parsed.host, parsed.port, parsed.pty or [], parsed.report, parsed.stats_json, parsed.flush_interval))
+    except KeyboardInterrupt:
+        pass
+    except OSError as excpt:
+        sys.exit("Failed to start server: {}".format(excpt))
+    finally:
+        server.flush()
+        server.close()
+        _print_report(server.report())
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
@@ -0,0 +1,33 @@
+import struct
+import pytest
+import bin2img as bn
+
+def image_of(words: dict):
+    return bn.CoreImage.from_runs([(address, struct.pack("<H", word)) for address, word in words.items()])
+
+def test_bin_round_trip():
+    words = {address: address * 5 & 0o7777 for address in range(0o200, 0o600)}
+    words.update({0o7776: 0o1234, 0o7777: 0o4321, 0o10000: 0o7777})
+    words.update({address: 0o5252 for address in range(0o30000, 0o30020)})
+    image = bn.decode_bin(bn.encode_bin(image_of(words), 0o20, 0o20))
+    assert(image.loaded_words() == len(words))
+    assert(all(image.word(address) == word for address, word in words.items()))
+
+def test_bin_segment_across_fields():
+    words = {address: address & 0o7777 for address in range(0o7770, 0o10010)}
+    image = bn.decode_bin(bn.encode_bin(image_of(words)))
+    assert(image.words(0o7770, 0o10010) == image_of(words).words(0o7770, 0o10010))
+
+def test_bin_checksum_mismatch():
+    tape = bytearray(bn.encode_bin(image_of({0o200: 0o7001})))
+    tape[3] ^= 0o01
+    with pytest.raises(ValueError):
+        bn.decode_bin(tape)
+
+def test_bin_missing_trailer():
+    with pytest.raises(ValueError):
+        bn.decode_bin(bn.encode_bin(image_of({0o200: 0o7001})).rstrip(b"\x80"))
+
+def test_decode_rim():
+    tape = b"\x80\x80" + bytes([0x40 | 0o02, 0o00, 0o72, 0o01, 0o00, 0o12]) + b"\x80"
+    assert(bn.decode_rim(tape) == [(0o200, 0o7201), (0o201, 0o0012)])
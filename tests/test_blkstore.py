@@ -0,0 +1,64 @@
+import os
+import pytest
+import blkstore
+from cmn import *
+
+def block(value: int):
+    return bytes([value]) * BYTES_PER_BLOCK
+
+def round_trip(tmp_path, name: str, data: bytes):
+    with blkstore.BlockStore(str(tmp_path / "store"), create=True) as store:
+        manifest, _ = store.add_image(name, data)
+        out_path = str(tmp_path / (name + ".out"))
+        store.extract_image(name, out_path)
+    with open(out_path, "rb") as fp:
+        assert(fp.read() == data)
+    return manifest
+
+def test_zero_block_then_new_block(tmp_path):
+    # A zero run [-1, 2] ends where block 1 would start, it mustn't take it.
+    manifest = round_trip(tmp_path, "a", bytes(BYTES_PER_BLOCK) + block(1))
+    assert(manifest["runs"] == [[blkstore.ZERO_ID, 1], [0, 1]])
+
+def test_zero_runs_between_new_blocks(tmp_path):
+    data = block(1) + bytes(BYTES_PER_BLOCK) * 3 + block(2) + block(3) + bytes(BYTES_PER_BLOCK) + block(4)
+    manifest = round_trip(tmp_path, "a", data)
+    assert(manifest["runs"] == [[0, 1], [blkstore.ZERO_ID, 3], [1, 2], [blkstore.ZERO_ID, 1], [3, 1]])
+
+def test_shared_blocks_and_tail(tmp_path):
+    first = block(1) + block(2) + block(3) + b"\x01\x02\x03\x04\x05\x06"
+    second = block(3) + block(1) + block(2) + bytes(BYTES_PER_BLOCK)
+    round_trip(tmp_path, "first", first)
+    round_trip(tmp_path, "second", second)
+    with blkstore.BlockStore(str(tmp_path / "store")) as store:
+        assert(store.block_count() == 3)
+        assert(store.names() == ["first", "second"])
+
+def test_interrupted_add_is_trimmed(tmp_path):
+    store_dir = str(tmp_path / "store")
+    round_trip(tmp_path, "a", block(1))
+    # A block written without its digest.
+    with open(os.path.join(store_dir, blkstore.PACK_NAME), "ab") as fp:
+        fp.write(block(9)[:100])
+    round_trip(tmp_path, "b", block(2) + block(1))
+    with blkstore.BlockStore(store_dir) as store:
+        assert(store.block_count() == 2)
+
+def test_add_and_read_blocks(tmp_path):
+    with blkstore.BlockStore(str(tmp_path / "store"), create=True) as store:
+        runs, added = store.add_blocks(memoryview(block(1) + block(2) + block(1) + b"\x01"))
+        assert(runs == [[0, 2], [0, 1]] and added == 2)
+        assert(store.read_blocks(0, 2) == block(1) + block(2))
+        assert(store.read_blocks(blkstore.ZERO_ID, 2) == bytes(BYTES_PER_BLOCK * 2))
+    with blkstore.BlockStore(str(tmp_path / "store")) as store:
+        assert(store.add_blocks(memoryview(block(2) + block(3))) == ([[1, 2]], 1))
+
+def test_iter_image_in_chunks(tmp_path):
+    data = block(1) + block(2) + block(3) + bytes(BYTES_PER_BLOCK) * 3 + b"\x07\x00"
+    round_trip(tmp_path, "a", data)
+    with blkstore.BlockStore(str(tmp_path / "store")) as store:
+        assert(b"".join(store.iter_image("a", 2)) == data)
+        store.remove_image("a")
+        assert(store.names() == [])
+        with pytest.raises(ConfigError):
+            store.remove_image("a")
@@ -0,0 +1,35 @@
+import os
+import shutil
+import struct
+import pytest
+import builder as bld
+from cmn import *
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A tree with just the handler, patch and unit specification sources, so handlers are assembled from them.
+@pytest.fixture
+def build_dir(tmp_path, monkeypatch):
+    shutil.copytree(os.path.join(REPO_DIR, "unit-specs"), str(tmp_path / "unit-specs"))
+    shutil.copytree(os.path.join(REPO_DIR, "handlers"), str(tmp_path / "handlers"), ignore=shutil.ignore_patterns("*.bin"))
+    shutil.copy(os.path.join(REPO_DIR, "build-patched.tx"), str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    with open("in.linc", "wb") as fp:
+        fp.write(bytes(TAPE_SIZE_BLOCKS * BYTES_PER_BLOCK) + struct.pack("<Hhh", WORDS_PER_BLOCK, 0, 0))
+    return tmp_path
+
+def test_expand_matrix_leaves_out_unbuildable_variants():
+    names = [variant.output_path for variant in bld.expand_matrix("m", ["linc", "rk05"], [], False)]
+    assert(names == ["m-linc", "m-linc-p", "m-rk05", "m-rk05-s", "m-rk05-p", "m-rk05-p-s"])
+
+def test_matrix_builds_every_media_type(build_dir):
+    args = ["-i", "in.linc", "-o", "out/m", "--matrix", "--sparse", "-m"] + VALID_MEDIA_TYPES + ["--replace-first"] + VALID_MEDIA_TYPES
+    os.mkdir("out")
+    with pytest.raises(SystemExit) as excpt:
+        bld.main(args)
+    assert(excpt.value.code == 0)
+    variants = bld.expand_matrix("out/m", VALID_MEDIA_TYPES, VALID_MEDIA_TYPES, False)
+    assert(len(variants) == len(VALID_MEDIA_TYPES) * (len(VALID_MEDIA_TYPES) + 1) * 4 - 4)
+    for variant in variants:
+        for path in bld.variant_outputs(variant).values():
+            assert(os.path.getsize(path) != 0)
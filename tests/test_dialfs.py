@@ -0,0 +1,90 @@
+import struct
+import pytest
+import dialfs
+from cmn import *
+
+INDEX_OFFSET = dialfs.INDEX_BLOCK * BYTES_PER_BLOCK
+
+def blank_image():
+    return memoryview(bytearray(TAPE_SIZE_BLOCKS * BYTES_PER_BLOCK))
+
+def parse(view):
+    return dialfs.FileIndex.parse(view, len(view) // BYTES_PER_BLOCK)
+
+def test_name_codes():
+    assert(dialfs.encode_name("Ed1") == [0o30 << 6 | 0o27, 0o01 << 6 | 0o14, 0o1414, 0o1414])
+    assert(dialfs.decode_name(dialfs.encode_name("EDIT2")) == "EDIT2")
+    assert(dialfs.decode_name([0o7777, 0o1414, 0o1414, 0o1414]) == "??")
+    with pytest.raises(ConfigError):
+        dialfs.encode_name("TOOLONGNAME")
+
+def test_blank_index_round_trip():
+    view = blank_image()
+    index = parse(view)
+    assert(index.entries == [None] * dialfs.ENTRY_COUNT)
+    assert(index.encode() == bytes(view[INDEX_OFFSET:INDEX_OFFSET + dialfs.INDEX_BYTES]))
+    assert(index.free_extents() == dialfs.FILE_AREAS)
+
+def test_add_and_remove():
+    view = blank_image()
+    dialfs.update_files(view, [("EDIT", "S", b"\x01\x00" * 0o600), ("EDIT", "B", b"\x02\x00" * 0o1200), ("ASM", "S", b"\x03\x00")])
+    index = parse(view)
+    index.check_round_trip(view)
+    assert([(entry.name, entry.kind, entry.start, entry.length) for entry in index.files()] == [("EDIT", "S", 0, 2), ("EDIT", "B", 2, 3), ("ASM", "S", 5, 1)])
+    assert(dialfs.read_file(view, index.get("edit", "B")) == b"\x02\x00" * 0o1200 + bytes(0o400))
+
+    dialfs.update_files(view, [], ["EDIT"])
+    index = parse(view)
+    assert(index.get("EDIT", "S") == None and index.entries[0] == None)
+    assert(index.get("ASM", "S").start == 5)
+
+def test_entries_keep_their_places():
+    view = blank_image()
+    dialfs.update_files(view, [("B", "S", b"\x01\x00"), ("A", "S", b"\x01\x00"), ("C", "S", b"\x01\x00")])
+    dialfs.update_files(view, [("D", "B", b"\x01\x00")], ["B"])
+    dialfs.update_files(view, [("A", "B", b"\x01\x00")])
+    index = parse(view)
+    assert([entry and entry.name for entry in index.entries[:4]] == ["D", "A", "C", None])
+    assert(sorted(index.entries[1].files) == ["B", "S"])
+
+def test_entry_without_files_is_kept():
+    view = blank_image()
+    struct.pack_into("<4H", view, INDEX_OFFSET + dialfs.ENTRY_WORDS * BYTES_PER_WORD, *dialfs.encode_name("EMPTY"))
+    dialfs.update_files(view, [("NEW", "S", b"\x01\x00")])
+    index = parse(view)
+    assert(index.entries[1].name == "EMPTY" and index.entries[1].files == {})
+    assert(index.entries[0].name == "NEW")
+
+@pytest.mark.parametrize("junk", [
+    struct.pack("<8H", 0o7777, 0o7777, 0o7777, 0o7777, 1, 2, 3, 4), # A name dialfs can't write back.
+    struct.pack("<8H", *dialfs.encode_name("A"), 0o10000, 1, 0, 0),  # Bits above the 12 bit word.
+])
+def test_unknown_index_is_refused(junk):
+    view = blank_image()
+    view[INDEX_OFFSET:INDEX_OFFSET + len(junk)] = junk
+    before = bytes(view)
+    with pytest.raises(FormatError):
+        dialfs.update_files(view, [("NEW", "S", b"\x01\x00")])
+    assert(bytes(view) == before)
+
+def test_repeated_name_is_refused():
+    view = blank_image()
+    for number in (0, 3):
+        struct.pack_into("<6H", view, INDEX_OFFSET + number * dialfs.ENTRY_WORDS * BYTES_PER_WORD, *dialfs.encode_name("TWICE"), 0o10, 1)
+    with pytest.raises(FormatError):
+        dialfs.update_files(view, [], ["TWICE"])
+
+def test_file_past_end_is_refused():
+    view = blank_image()
+    struct.pack_into("<6H", view, INDEX_OFFSET, *dialfs.encode_name("LONG"), 0o700, 0o200)
+    with pytest.raises(FormatError):
+        parse(view)
+    with pytest.raises(FormatError):
+        dialfs.read_file(view[:0o400 * BYTES_PER_BLOCK], dialfs.DialFile("LONG", "S", 0o370, 0o20))
+
+def test_unknown_index_is_not_read():
+    view = blank_image()
+    struct.pack_into("<6H", view, INDEX_OFFSET, 0o7777, 0o7777, 0o7777, 0o7777, 0o10, 1)
+    parse(view)
+    with pytest.raises(FormatError):
+        dialfs.read_index(view)
@@ -0,0 +1,38 @@
+import pytest
+import imgdelta
+from cmn import *
+
+def block(value: int):
+    return bytes([value, 0]) * WORDS_PER_BLOCK
+
+def write(path, data: bytes):
+    path.write_bytes(data)
+    return str(path)
+
+def test_diff_blocks():
+    old = block(1) + block(2) + block(3) + block(4)
+    new = block(1) + block(5) + block(6) + block(4) + block(7) + bytes(BYTES_PER_BLOCK)
+    assert(imgdelta.diff_blocks(memoryview(old), memoryview(new)) == [(1, 3), (4, 5)])
+
+@pytest.mark.parametrize("new", [
+    block(1) + block(9) + block(3),
+    block(1) + block(2) + block(3) + block(4) + b"\x01\x02",
+    block(8),
+])
+def test_apply_delta(tmp_path, new):
+    old = block(1) + block(2) + block(3)
+    old_path = write(tmp_path / "old.img", old)
+    new_path = write(tmp_path / "new.img", new)
+    delta_path = str(tmp_path / "img.delta")
+    imgdelta.make_delta(delta_path, old_path, new_path)
+    imgdelta.apply_delta(old_path, delta_path)
+    assert((tmp_path / "old.img").read_bytes() == new)
+
+def test_apply_delta_to_other_image(tmp_path):
+    old_path = write(tmp_path / "old.img", block(1))
+    delta_path = str(tmp_path / "img.delta")
+    imgdelta.make_delta(delta_path, old_path, write(tmp_path / "new.img", block(2)))
+    other_path = write(tmp_path / "other.img", block(3))
+    with pytest.raises(FormatError):
+        imgdelta.apply_delta(other_path, delta_path)
+    assert((tmp_path / "other.img").read_bytes() == block(3))
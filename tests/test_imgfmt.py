@@ -0,0 +1,49 @@
+import random
+import struct
+import pytest
+import imgfmt
+from cmn import *
+
+def raw_blocks(count: int, seed: int = 1):
+    rand = random.Random(seed)
+    return struct.pack("<{}H".format(count * WORDS_PER_BLOCK), *(rand.getrandbits(12) for _ in range(count * WORDS_PER_BLOCK)))
+
+@pytest.mark.parametrize("name", ["packed12", "blocked"])
+def test_round_trip(name):
+    fmt = imgfmt.get_format(name)
+    data = raw_blocks(5)
+    encoded = imgfmt.encode_blocks(fmt, data, 0o12)
+    assert(len(encoded) == fmt.stored_size(len(data)))
+    assert(bytes(imgfmt.decode_blocks(fmt, encoded, 0o12)) == data)
+
+@pytest.mark.parametrize("name", ["packed12", "blocked"])
+def test_partial_block_is_padded(name):
+    fmt = imgfmt.get_format(name)
+    data = raw_blocks(2)[:BYTES_PER_BLOCK + 0o10]
+    decoded = bytes(imgfmt.decode_blocks(fmt, imgfmt.encode_blocks(fmt, data)))
+    assert(decoded == data + bytes(BYTES_PER_BLOCK - 0o10))
+
+def test_packed12_layout():
+    assert(imgfmt.pack12(struct.pack("<HH", 0o1234, 0o5670)) == bytes([0x9C, 0x82, 0xBB]))
+    assert(imgfmt.unpack12(bytes([0x9C, 0x82, 0xBB])) == struct.pack("<HH", 0o1234, 0o5670))
+
+def test_packed12_rejects_wide_words():
+    with pytest.raises(FormatError):
+        imgfmt.pack12(struct.pack("<HH", 0o10000, 0))
+
+def test_blocked_checks_block_numbers():
+    fmt = imgfmt.get_format("blocked")
+    encoded = imgfmt.encode_blocks(fmt, raw_blocks(2), 4)
+    with pytest.raises(FormatError):
+        imgfmt.decode_blocks(fmt, encoded, 5)
+
+def test_unknown_format():
+    with pytest.raises(ConfigError):
+        imgfmt.get_format("packed16")
+
+def test_packed12_without_numpy(monkeypatch):
+    data = raw_blocks(3)
+    packed = imgfmt.pack12(data)
+    monkeypatch.setattr(imgfmt, "_numpy_module", None)
+    assert(imgfmt.pack12(data) == packed)
+    assert(imgfmt.unpack12(packed) == data)
@@ -0,0 +1,77 @@
+import struct
+import pytest
+import bin2img as bn
+import mktape
+from cmn import *
+
+def image_of(words: dict):
+    return bn.CoreImage.from_runs([(address, struct.pack("<H", word)) for address, word in words.items()])
+
+# Unpack frames written by pack_words, as the stub's GETW reads them.
+def unpack_words(frames: bytes):
+    words = []
+    for idx in range(0, len(frames), 3):
+        words.append(frames[idx] << 4 | frames[idx + 1] >> 4)
+        if(idx + 2 < len(frames)):
+            words.append((frames[idx + 1] & 0o17) << 8 | frames[idx + 2])
+    return words
+
+# Load payload records the way the stub does, returning (address -> word, start address).
+def load_payload(payload: list):
+    core = {}
+    address = 0
+    idx = 0
+    while(True):
+        control = payload[idx]
+        idx += 1
+        if(control == mktape.PAYLOAD_END):
+            return core, payload[idx]
+        if(control == mktape.PAYLOAD_ORIGIN):
+            address = payload[idx]
+            idx += 1
+        elif(control & mktape.PAYLOAD_ORIGIN):
+            for _ in range(control & mktape.MAX_RUN):
+                core[address] = payload[idx]
+                address += 1
+            idx += 1
+        else:
+            for word in payload[idx:idx + control]:
+                core[address] = word
+                address += 1
+            idx += control
+
+@pytest.mark.parametrize("count", [0, 1, 2, 3, 0o10])
+def test_pack_words_round_trip(count):
+    words = [(idx * 0o1357 + 0o7000) & 0o7777 for idx in range(count)]
+    frames = mktape.pack_words(words)
+    assert(len(frames) == (count * 3 + 1) // 2)
+    assert(unpack_words(frames) == words)
+
+def test_payload_round_trip():
+    words = {address: address & 0o77 for address in range(0o200, 0o240)}
+    words.update({address: 0o7402 for address in range(0o240, 0o240 + mktape.MAX_RUN + 0o10)})
+    words.update({address: address & 0o7 for address in range(0o10000 - 0o20, 0o10000)})
+    words.update({0o20: 1, 0o21: 1, 0o30: 2})
+    payload = mktape.payload_words(image_of(words), 0o200)
+    assert(unpack_words(mktape.pack_words(payload)) == payload)
+    assert(load_payload(payload) == (words, 0o200))
+    # The long run of HLTs goes as two repeats rather than literally.
+    assert(len(payload) < 0o200)
+
+def test_payload_only_loads_field_0():
+    with pytest.raises(ConfigError):
+        mktape.payload_words(image_of({0o10200: 1}))
+
+def test_rim_tape_round_trip():
+    words = {0o200: 0o7300, 0o201: 0o1205, 0o7000: 0o5200}
+    assert(bn.decode_rim(mktape.rim_tape(image_of(words), 4, 4)) == sorted(words.items()))
+
+def test_stub_tape_rim_records():
+    image = image_of({address: 0o7000 for address in range(0o200, 0o7000)})
+    tape = mktape.stub_tape(image, 0o200)
+    origin = mktape.stub_origin(image)
+    stub_words = mktape.assemble_stub(origin).loaded_words()
+    records = bn.decode_rim(tape[:1 + (stub_words + 3) * 4])
+    assert(records[-3:] == [(mktape.TRAMPOLINE, mktape.TRAMPOLINE_WORD), (mktape.TRAMPOLINE + 1, origin), (mktape.RIM_LOADER_JUMP, mktape.RIM_LOADER_JUMP_WORD)])
+    assert(all(origin <= address < origin + mktape.PAGE_SIZE for address, word in records[:-3]))
+    assert(tape.endswith(mktape.pack_words(mktape.payload_words(image, 0o200))))
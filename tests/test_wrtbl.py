@@ -0,0 +1,52 @@
+import csv
+import os
+import struct
+import pytest
+import wrtbl as wt
+from cmn import *
+
+SPEC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "unit-specs")
+
+def spec_rows(paths: list):
+    rows = []
+    for path in paths:
+        with open(path, newline='') as fp:
+            rows += [tuple(int(value, 8) for value in row[:3]) for row in csv.reader(fp)]
+    return rows
+
+def write_spec(tmp_path, name: str, text: str):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+@pytest.mark.parametrize("names", [
+    ["sys-units.pri-std.csv"],
+    ["sys-units.pri-std.csv", "linctape-units.pri-std.csv"],
+    ["sys-units.sec-std.csv", "rk08-units.sec-std.csv"],
+])
+def test_compile_unit_table(names):
+    paths = [os.path.join(SPEC_DIR, name) for name in names]
+    rows = spec_rows(paths)
+    table, length = wt.compile_unit_table(paths)
+    assert(len(table) == wt.UNIT_TABLE_SIZE and length == len(rows) * wt.ENTRY_SIZE)
+    assert([struct.unpack_from("<HHH", table, idx * wt.ENTRY_SIZE) for idx in range(len(rows))] == rows)
+    assert(struct.unpack_from("<H", table, length)[0] == wt.TABLE_TERMINATOR)
+    assert(struct.unpack_from("<H", table, wt.LOADER_CONSTANT_OFFSET)[0] == wt.LOADER_CONSTANT)
+    assert(wt.table_length(table) == length)
+
+def test_compiled_table_disk_cache(tmp_path):
+    path = write_spec(tmp_path, "units.csv", "1,7430,20\n2,7630,21\n")
+    cache_dir = str(tmp_path / "cache")
+    compiled = wt.compile_unit_table([path], cache_dir)
+    cached = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+    assert(len(cached) == 1 and wt.load_compiled_table(cached[0]) == compiled)
+
+@pytest.mark.parametrize("text", [
+    "1,7430,20\n1,7630,21\n", # Unit defined twice.
+    "1,7000,20\n",           # Not a handler slot.
+    "1,7430\n",              # Missing its block.
+    "1,7430,9\n",            # Not octal.
+])
+def test_invalid_specs(tmp_path, text):
+    with pytest.raises(FormatError):
+        wt.compile_unit_table([write_spec(tmp_path, "bad.csv", text)])
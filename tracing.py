@@ -0,0 +1,168 @@
+import atexit
+import os
+import time
+from cmn import *
+
+# Structured trace events for finding where build time goes.
+# Events are written as they happen, one per line, so processes forked after tracing starts (batch and bulk
+# workers) append to the same file. "chrome" output is the Chrome/Perfetto JSON array format, which allows
+# the closing bracket to be left off; "jsonl" output is the same events as line-delimited JSON.
+# Everything only needed once tracing or profiling is turned on is imported then, keeping tool startup fast.
+TRACE_FORMATS = ["chrome", "jsonl"]
+
+_tracer = None
+
+class _Tracer:
+    def __init__(self, path: str, fmt: str, malloc: bool):
+        import json
+        import threading
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        self.suffix = b",\n" if fmt == "chrome" else b"\n"
+        self.encode = json.JSONEncoder(default=str).encode
+        self.native_id = threading.get_native_id
+        self.tracemalloc = None
+        if(malloc):
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+        self.start_ns = time.perf_counter_ns()
+        if(fmt == "chrome"):
+            os.write(self.fd, b"[\n")
+
+    def emit(self, event: dict):
+        event["pid"] = os.getpid()
+        event["tid"] = self.native_id()
+        os.write(self.fd, self.encode(event).encode() + self.suffix)
+
+    def ts(self, ns: int = None):
+        return ((time.perf_counter_ns() if ns == None else ns) - self.start_ns) / 1000
+
+    def close(self):
+        os.close(self.fd)
+
+class _Span:
+    __slots__ = ("name", "cat", "args", "start")
+
+    def __init__(self, name: str, cat: str, args: dict):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def add(self, name: str, value: int):
+        self.args[name] = self.args.get(name, 0) + value
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        tracer = _tracer
+        if(tracer == None):
+            return
+        end = time.perf_counter_ns()
+        if(exc_type != None):
+            self.args["error"] = "{}: {}".format(exc_type.__name__, exc)
+        if(tracer.tracemalloc != None and tracer.tracemalloc.is_tracing()):
+            self.args["traced_current"], self.args["traced_peak"] = tracer.tracemalloc.get_traced_memory()
+        tracer.emit({"name": self.name, "cat": self.cat, "ph": "X", "ts": tracer.ts(self.start), "dur": (end - self.start) / 1000, "args": self.args})
+
+# Does nothing, returned whenever tracing is disabled so instrumented code costs next to nothing.
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def add(self, name: str, value: int):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+def enabled():
+    return _tracer != None
+
+# Time a stage: "with span("name", key=value) as sp: ... sp.set(bytes_written=n)".
+def span(name: str, cat: str = "stage", **args):
+    if(_tracer == None):
+        return _NULL_SPAN
+    return _Span(name, cat, args)
+
+# Record something that happened at a single point in time, e.g. a cache hit.
+def event(name: str, cat: str = "event", **args):
+    tracer = _tracer
+    if(tracer != None):
+        tracer.emit({"name": name, "cat": cat, "ph": "i", "s": "t", "ts": tracer.ts(), "args": args})
+
+# Record the values of one or more counters, e.g. bytes written so far.
+def counter(name: str, **values):
+    tracer = _tracer
+    if(tracer != None):
+        tracer.emit({"name": name, "cat": "counter", "ph": "C", "ts": tracer.ts(), "args": values})
+
+def start(path: str, fmt: str = "chrome", malloc: bool = False):
+    global _tracer
+    assert(fmt in TRACE_FORMATS)
+    stop()
+    try:
+        _tracer = _Tracer(path, fmt, malloc)
+    except OSError as excpt:
+        raise ArtifactError("Failed to open trace file '{}': {}".format(path, excpt))
+    event("trace_start", "meta", argv=sys.argv)
+
+def stop():
+    global _tracer
+    if(_tracer != None):
+        tracer = _tracer
+        _tracer = None
+        tracer.close()
+
+# Add the common tracing and profiling options to a tool's argument parser.
+def add_arguments(parser):
+    parser.add_argument("--trace-json", help="Write trace events (stage timings, bytes read/written, cache hits) to this file.")
+    parser.add_argument("--trace-format", choices=TRACE_FORMATS, default="chrome", help="Trace file format: Chrome trace JSON (default) or line-delimited JSON.")
+    parser.add_argument("--profile", help="Profile with cProfile and write the stats (readable with pstats) to this file.")
+    parser.add_argument("--tracemalloc", action="store_const", const=True, help="Track memory allocations; trace events record traced memory and the top allocation sites are written when done.")
+
+# Start whatever the options added by add_arguments asked for, finishing up when the process exits.
+def start_from_args(parsed):
+    main_pid = os.getpid()
+    tracemalloc = None
+    if(parsed.tracemalloc != None):
+        import tracemalloc
+        tracemalloc.start()
+    if(parsed.trace_json != None):
+        start(parsed.trace_json, parsed.trace_format, parsed.tracemalloc != None)
+
+    profiler = None
+    if(parsed.profile != None):
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if(tracemalloc == None and profiler == None and not enabled()):
+        return
+
+    def finish():
+        # Workers forked from us inherit this, only the main process finishes up.
+        if(os.getpid() != main_pid):
+            return
+        if(profiler != None):
+            profiler.disable()
+            try:
+                profiler.dump_stats(parsed.profile)
+            except OSError as excpt:
+                print("WARN: Failed to write profile '{}': {}".format(parsed.profile, excpt), file=sys.stderr)
+        if(tracemalloc != None and tracemalloc.is_tracing()):
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics("lineno")[:20]
+            event("tracemalloc", "memory", current=current, peak=peak, top=[{"site": str(stat.traceback), "size": stat.size, "count": stat.count} for stat in top])
+            tracemalloc.stop()
+        stop()
+    atexit.register(finish)
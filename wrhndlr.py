@@ -1,10 +1,9 @@
 import argparse
 import struct
 import sys
-from dataclasses import dataclass
 
 from cmn import *
-import bin2img as bn
+import tracing
 
 # Notes:
 # Each word is two bytes in a DSK
@@ -42,15 +41,24 @@ import bin2img as bn
 #       - Valuable for non-LINCtape devices, where the whole rimloader etc sequence would otherwise need to be run after every program load.
 #   - NOTE: This program does not automatically update the unit table, for this wrtbl is provided.
 
-def write_handler(handler_block: memoryview, new_hndlr_path: str, addr: int):
-    # Open handler binary and parse BIN data to a core image.
-    with open_file(new_hndlr_path, "rb") as fp:
-        hndlr_data = bn.bin_to_core_image(fp)[0o230 * BYTES_PER_WORD:0o370 * BYTES_PER_WORD]
+def load_handler_image(hndlr_path: str, cache_dir: str = None):
+    # Open handler binary (or assemble its source) and parse BIN data to a core image, decoded images are shared between calls.
+    import pal8 # Only loaded once a handler is, as plain BIN files are decoded by bin2img.
+    try:
+        return pal8.load_core_image(hndlr_path, cache_dir).words(0o230, 0o370)
+    except OSError as excpt:
+        raise ArtifactError("Failed to open file '{}': {}".format(hndlr_path, excpt))
+    except ValueError as excpt:
+        raise FormatError("Handler '{}' is improperly formatted: {}".format(hndlr_path, excpt))
 
+def write_handler_image(handler_block: memoryview, hndlr_data: bytes, addr: int):
     # Insert the new handler.
     start = addr*BYTES_PER_WORD
     handler_block[start:start + len(hndlr_data)] = hndlr_data
 
+def write_handler(handler_block: memoryview, new_hndlr_path: str, addr: int):
+    write_handler_image(handler_block, load_handler_image(new_hndlr_path), addr)
+
 def write_handlers(handler_block: memoryview, primary_path: str, secondary_path: str):
     assert(len(handler_block) >= BYTES_PER_WORD)
 
@@ -64,13 +72,15 @@ def write_handlers(handler_block: memoryview, primary_path: str, secondary_path:
 
 
 # TODO: Support BIN images
-if __name__ == "__main__":
+def main(argv):
     parser = argparse.ArgumentParser(prog='DIAL-MS Device Handler Writer', description="Setup/Assign/Replace DIAL-MS device handler slots from handler BIN files.")
     parser.add_argument("-o", "--output-path", required=True, help="Output image path.")
     parser.add_argument("-i", "--input-path", required=True, help="Input image path.")
     parser.add_argument("-p", "--primary-handler", required=True, help="Primary handler BIN file path.")
     parser.add_argument("-s", "--secondary-handler", required=True, help="Secondary handler BIN file path.")
-    parsed = parser.parse_args(sys.argv[1:])
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
 
     # Open and copy input file.
     image_file = copy_open_file(parsed.output_path, parsed.input_path, "rb+")
@@ -94,5 +104,9 @@ if __name__ == "__main__":
     if(written != BYTES_PER_BLOCK):
         sys.exit("Only wrote partial handler block back to {}".format(parsed.output_path))
 
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
     sys.exit(0)
-
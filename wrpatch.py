@@ -1,35 +1,48 @@
 import argparse
 import sys
 from cmn import *
-import bin2img as bn
+import tracing
 
-_PATCHED_IMAGE_PATH = "build-patched.bin"
+PATCHED_IMAGE_PATH = "build-patched.bin"
 
-# Copy patched BOOTER routine from bundled build image to provided control block.
-def apply_patches(handler_blocks: memoryview):
-    assert(len(handler_blocks) >= BYTES_PER_BLOCK * 2)
-
-    # Attempt to open the patched build image.
-    patched_build = bn.bin_to_core_image(open_file(_PATCHED_IMAGE_PATH, "rb"))
+# Load the bundled patched build image, decoded images are shared between calls.
+def load_patch_image(cache_dir: str = None):
+    import pal8 # Only loaded once the patch image is needed.
+    try:
+        return pal8.load_core_image(PATCHED_IMAGE_PATH, cache_dir)
+    except OSError as excpt:
+        raise ArtifactError("Failed to open file '{}': {}".format(PATCHED_IMAGE_PATH, excpt))
+    except ValueError as excpt:
+        raise FormatError("Patched build image '{}' is improperly formatted: {}".format(PATCHED_IMAGE_PATH, excpt))
 
-    # Patch things before unit table.
-    handler_blocks[0:0o300*BYTES_PER_WORD] = patched_build[0o7000*BYTES_PER_WORD:0o7300*BYTES_PER_WORD]
+# Word ranges (start, end) of the I/O routine blocks taken from the patched build image, which holds them from PATCH_ORIGIN on.
+PATCH_ORIGIN = 0o7000
+PATCH_RANGES = [
+    (0, 0o300),       # Patch things before unit table.
+    (0o400, 0o430),   # After but before the handlers...
+    (0o600, 0o630),   # Mini loader between the handlers...
+    (0o570, 0o600),   # And lastly, the syscom areas.
+    (0o770, 0o1000),
+]
 
-    # After but before the handlers...
-    handler_blocks[0o400*BYTES_PER_WORD:0o430*BYTES_PER_WORD] = patched_build[0o7400*BYTES_PER_WORD:0o7430*BYTES_PER_WORD]
+# Copy patched BOOTER routine from bundled build image to provided control block.
+def apply_patches(handler_blocks: memoryview, patched_build = None):
+    assert(len(handler_blocks) >= BYTES_PER_BLOCK * 2)
 
-    # Mini loader between the handlers...
-    handler_blocks[0o600*BYTES_PER_WORD:0o630*BYTES_PER_WORD] = patched_build[0o7600*BYTES_PER_WORD:0o7630*BYTES_PER_WORD]
+    # Attempt to open the patched build image if the caller didn't provide one.
+    if(patched_build == None):
+        patched_build = load_patch_image()
 
-    # And lastly, the syscom areas.
-    handler_blocks[0o570*BYTES_PER_WORD:0o600*BYTES_PER_WORD] = patched_build[0o7570*BYTES_PER_WORD:0o7600*BYTES_PER_WORD]
-    handler_blocks[0o770*BYTES_PER_WORD:0o1000*BYTES_PER_WORD] = patched_build[0o7770*BYTES_PER_WORD:0o10000*BYTES_PER_WORD]
+    for start, end in PATCH_RANGES:
+        handler_blocks[start*BYTES_PER_WORD:end*BYTES_PER_WORD] = patched_build.words(PATCH_ORIGIN + start, PATCH_ORIGIN + end)
 
-if __name__ == "__main__":
+def main(argv):
     parser = argparse.ArgumentParser(prog='DIAL-MS Rebootstrap Patch Writer', description='Apply a patch to the DIAL-MS BOOTER routine to make it use the system device handler (instead of the LINCtape instructions) when reading in the boot blocks')
     parser.add_argument("-o", "--output-path", required=True, help="Output path.")
     parser.add_argument("-i", "--input-path", required=True, help="Input path.")
-    parsed = parser.parse_args(sys.argv[1:])
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
 
     # Open and copy input file.
     image_file = copy_open_file(parsed.output_path, parsed.input_path, "rb+")
@@ -53,4 +66,9 @@ if __name__ == "__main__":
     if(written != BYTES_PER_BLOCK):
         sys.exit("Only read partial I/O routine block from '{}': {}".format(parsed.output_path, excpt))
 
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
     sys.exit(0)
@@ -1,18 +1,38 @@
 import argparse
-import csv
+import io
+import os
 import struct
 import sys
 from cmn import *
+import tracing
 
 UNIT_TABLE_OFFSET = 0o300 * BYTES_PER_WORD
 UNIT_TABLE_SIZE = 0o100 * BYTES_PER_WORD
 UNIT_TABLE_END = UNIT_TABLE_OFFSET + UNIT_TABLE_SIZE
 
+ENTRY_SIZE = 3 * BYTES_PER_WORD
+TABLE_TERMINATOR = 0o7777
+LOADER_CONSTANT = 0o7774
+LOADER_CONSTANT_OFFSET = 0o77 * BYTES_PER_WORD
+
+# Entries must leave room for the terminator before the loader constant.
+MAX_ENTRIES = (LOADER_CONSTANT_OFFSET - BYTES_PER_WORD) // ENTRY_SIZE
+
+# Entry points of the two handler slots.
+HANDLER_ADDRESSES = [0o7430, 0o7630]
+
+# Bumped whenever compiled tables change, so stale .utbl files are never used.
+UTBL_VERSION = 1
+
+# Compiled tables keyed by the contents of their spec files; (table, length of entries).
+_compiled_tables = {}
+
 # Packs unit table entries provided within specfile csv to a memory buffer.
 # Returns numbers of bytes written.
 def parse_spec_file_by_file(buff: memoryview, specfile: str):
     assert(specfile != None and buff != None)
 
+    import csv # Only needed when a table isn't already compiled.
     reader = csv.reader(specfile)
     offset = 0
     for row in reader:
@@ -20,14 +40,14 @@ def parse_spec_file_by_file(buff: memoryview, specfile: str):
         if(len(row) < 3):
             raise ValueError("Row {} contains fewer than 3 values ({})".format(offset / (3*2), len(row)))
 
+        # Check if we're going out of bounds.
+        if(offset + 3*2 > len(buff)):
+            raise IndexError("Unit entries extend past end of buffer")
+
         # Pack the new entry into the table
         struct.pack_into("<HHH", buff, offset, int(row[0], 8), int(row[1], 8), int(row[2], 8))
         offset += 3*2
 
-        # Check if we're going out of bounds.
-        if(offset > len(buff)):
-            raise IndexError("Unit entries extend past end of buffer")
-
     return offset
 
 def parse_spec_file_by_path(buff: memoryview, specfile_path: str):
@@ -35,12 +55,33 @@ def parse_spec_file_by_path(buff: memoryview, specfile_path: str):
 
     # Try to parse file at provided path.
     try:
-        with open(specfile_path, "r", newline='') as fp:
-            return parse_spec_file_by_file(buff, fp)
+        with tracing.span("read_spec", path=specfile_path) as sp, open(specfile_path, "r", newline='') as fp:
+            length = parse_spec_file_by_file(buff, fp)
+            sp.set(entries=length // (3*2))
+            return length
     except OSError as excpt:
-        sys.exit("Failed to open spec file {}: {}".format(arg, excpt))
-    except ValueError as excpt:
-        sys.exit("Failed to parse spec file text {}: {}".format(arg, excpt))
+        raise ArtifactError("Failed to open spec file {}: {}".format(specfile_path, excpt))
+    except (ValueError, IndexError, struct.error) as excpt:
+        raise FormatError("Failed to parse spec file text {}: {}".format(specfile_path, excpt))
+
+# Check that entries packed in a table will work once DIAL-MS boots, raising FormatError if they won't.
+# names maps entry indices to where they came from for error messages.
+def validate_entries(buff: memoryview, length: int, names: list = None):
+    if(length // ENTRY_SIZE > MAX_ENTRIES):
+        raise FormatError("Too many unit table entries ({}, at most {} fit)".format(length // ENTRY_SIZE, MAX_ENTRIES))
+    seen = {}
+    for idx in range(length // ENTRY_SIZE):
+        unit, handler, block = struct.unpack_from("<HHH", buff, idx * ENTRY_SIZE)
+        where = names[idx] if names != None else "entry {}".format(idx)
+        if(unit >= TABLE_TERMINATOR):
+            raise FormatError("Unit number {:o} is out of range ({})".format(unit, where))
+        if(handler not in HANDLER_ADDRESSES):
+            raise FormatError("Unit {:o} has handler address {:o}, which is not a handler slot ({})".format(unit, handler, where))
+        if(block > 0o7777):
+            raise FormatError("Unit {:o} has out of range value {:o} ({})".format(unit, block, where))
+        if(unit in seen):
+            raise FormatError("Unit {:o} is defined more than once ({} and {})".format(unit, seen[unit], where))
+        seen[unit] = where
 
 def parse_spec_file_list_by_path(buff: memoryview, specfile_paths: list):
     assert(buff != None and specfile_paths != None)
@@ -52,26 +93,139 @@ def parse_spec_file_list_by_path(buff: memoryview, specfile_paths: list):
 
     # Parse all provided specfiles into buffer.
     offset = 0
+    names = []
     for path in specfile_paths:
-        stride = parse_spec_file_by_path(buff[offset:], path)
+        stride = parse_spec_file_by_path(buff[offset:LOADER_CONSTANT_OFFSET], path)
         if(stride == 0):
             print("WARN: Specfile '{}' contains no unit table entries.".format(path))
+        names += ["{} row {}".format(path, row) for row in range(stride // ENTRY_SIZE)]
         offset += stride
-
-        # Check if we're going out of bounds.
-        if(offset > UNIT_TABLE_SIZE):
-            sys.exit("Attempting to write too many unit table entries!")
+    validate_entries(buff, offset, names)
 
     # Add a terminator + patched loader constant.
-    struct.pack_into("<H", buff, offset, 0o7777)
-    struct.pack_into("<H", buff, 0o77*BYTES_PER_WORD, 0o7774)
+    struct.pack_into("<H", buff, offset, TABLE_TERMINATOR)
+    struct.pack_into("<H", buff, LOADER_CONSTANT_OFFSET, LOADER_CONSTANT)
 
-if __name__ == "__main__":
+    return offset
+
+# Length in bytes of the entries in a packed table, not including the terminator.
+def table_length(table: memoryview):
+    for offset in range(0, LOADER_CONSTANT_OFFSET, ENTRY_SIZE):
+        if(struct.unpack_from("<H", table, offset)[0] == TABLE_TERMINATOR):
+            return offset
+    raise FormatError("Unit table has no terminator")
+
+def _spec_key(sources: list):
+    import hashlib # Only needed for cached unit tables.
+    digest = hashlib.sha256("v{}\n".format(UTBL_VERSION).encode())
+    for source in sources:
+        digest.update(hashlib.sha256(source).digest())
+    return digest.hexdigest()
+
+# Read a compiled .utbl table, checking it's still valid.
+def load_compiled_table(path: str):
+    try:
+        with open(path, "rb") as fp:
+            table = fp.read()
+    except OSError as excpt:
+        raise ArtifactError("Failed to read compiled unit table {}: {}".format(path, excpt))
+    if(len(table) != UNIT_TABLE_SIZE):
+        raise FormatError("Compiled unit table {} is {} bytes, not {}".format(path, len(table), UNIT_TABLE_SIZE))
+    length = table_length(table)
+    validate_entries(table, length)
+    if(struct.unpack_from("<H", table, LOADER_CONSTANT_OFFSET)[0] != LOADER_CONSTANT):
+        raise FormatError("Compiled unit table {} is missing the loader constant".format(path))
+    return table, length
+
+def save_compiled_table(path: str, table: bytes):
+    try:
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as fp:
+            fp.write(table)
+        os.replace(tmp_path, path)
+    except OSError as excpt:
+        raise ArtifactError("Failed to write compiled unit table {}: {}".format(path, excpt))
+
+# Compile a list of spec files into a packed, validated table with its terminator and loader constant in place.
+# Tables are reused for spec files with identical contents, and also stored in cache_dir as .utbl files if provided.
+# Returns (table, length of entries).
+def compile_unit_table(specfile_paths: list, cache_dir: str = None):
+    sources = []
+    for path in specfile_paths:
+        try:
+            with open(path, "rb") as fp:
+                sources.append(fp.read())
+        except OSError as excpt:
+            raise ArtifactError("Failed to open spec file {}: {}".format(path, excpt))
+    key = _spec_key(sources)
+    if(key in _compiled_tables):
+        tracing.event("unit_table_hit", "cache", specs=specfile_paths)
+        return _compiled_tables[key]
+
+    compiled = None
+    cache_path = os.path.join(cache_dir, "{}.utbl".format(key)) if cache_dir != None else None
+    if(cache_path != None and os.path.exists(cache_path)):
+        try:
+            compiled = load_compiled_table(cache_path)
+            tracing.event("unit_table_disk_hit", "cache", specs=specfile_paths)
+        except DialError:
+            pass # Rebuilt below.
+
+    if(compiled == None):
+        table = bytearray(UNIT_TABLE_SIZE)
+        offset = 0
+        names = []
+        for path, source in zip(specfile_paths, sources):
+            try:
+                stride = parse_spec_file_by_file(memoryview(table)[offset:LOADER_CONSTANT_OFFSET], io.StringIO(source.decode("ascii"), newline=''))
+            except (ValueError, IndexError, struct.error) as excpt:
+                raise FormatError("Failed to parse spec file text {}: {}".format(path, excpt))
+            names += ["{} row {}".format(path, row) for row in range(stride // ENTRY_SIZE)]
+            offset += stride
+        validate_entries(table, offset, names)
+        struct.pack_into("<H", table, offset, TABLE_TERMINATOR)
+        struct.pack_into("<H", table, LOADER_CONSTANT_OFFSET, LOADER_CONSTANT)
+        compiled = (bytes(table), offset)
+        if(cache_path != None):
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                save_compiled_table(cache_path, compiled[0])
+            except (OSError, DialError):
+                pass # Disk cache is only an optimization.
+
+    _compiled_tables[key] = compiled
+    return compiled
+
+# Copy a compiled table's entries, terminator and loader constant into the unit table area of an I/O routine block.
+# Words between the terminator and the loader constant are left as they are.
+def apply_unit_table(buff: memoryview, compiled: tuple):
+    table, length = compiled
+    buff[0:length + BYTES_PER_WORD] = table[0:length + BYTES_PER_WORD]
+    buff[LOADER_CONSTANT_OFFSET:LOADER_CONSTANT_OFFSET + BYTES_PER_WORD] = table[LOADER_CONSTANT_OFFSET:LOADER_CONSTANT_OFFSET + BYTES_PER_WORD]
+
+def main(argv):
     parser = argparse.ArgumentParser(prog='DIAL-MS Unit Table Writer', description='Setup the unit table in a DIAL-MS image using CSV config files.')
-    parser.add_argument("spec", nargs="*", help="Unit table CSV specification file path(s).")
-    parser.add_argument("-o", "--output-path", required=True, help="Output image path.")
-    parser.add_argument("-i", "--input-path", required=True, help="Input image path.")
-    parsed = parser.parse_args(sys.argv[1:])
+    parser.add_argument("spec", nargs="*", help="Unit table CSV specification file path(s), or a single compiled .utbl table.")
+    parser.add_argument("-o", "--output-path", help="Output image path.")
+    parser.add_argument("-i", "--input-path", help="Input image path.")
+    parser.add_argument("-c", "--compile", help="Compile the spec files into a .utbl table at this path instead of writing an image.")
+    tracing.add_arguments(parser)
+    parsed = parser.parse_args(argv)
+    tracing.start_from_args(parsed)
+
+    # Compile the table up front so bad specs fail before anything is written.
+    if(len(parsed.spec) == 1 and parsed.spec[0].endswith(".utbl")):
+        compiled = load_compiled_table(parsed.spec[0])
+    else:
+        if(len(parsed.spec) == 0):
+            print("WARN: No specfile paths provided.")
+        compiled = compile_unit_table(parsed.spec)
+
+    if(parsed.compile != None):
+        save_compiled_table(parsed.compile, compiled[0])
+        return
+    if(parsed.input_path == None or parsed.output_path == None):
+        parser.error("the following arguments are required: -i/--input-path, -o/--output-path")
 
     # Create a copy of our input and open it for reading & writing.
     image_file = copy_open_file(parsed.output_path, parsed.input_path, "rb+")
@@ -81,11 +235,11 @@ if __name__ == "__main__":
         controller_block = memoryview(read_tape_block(image_file, IO_ROUTINES_BLOCK))
     except OSError as excpt:
         sys.exit("Failed to read controller block from {}: {}".format(parsed.output_path, excpt))
-    if(len(controller_block != BYTES_PER_BLOCK)):
+    if(len(controller_block) != BYTES_PER_BLOCK):
         sys.exit("Failed to read full controller block from {}".format(parsed.output_path))
 
-    # Generate and write new table.
-    parse_spec_file_list_by_path(controller_block[UNIT_TABLE_OFFSET:UNIT_TABLE_END], parsed.spec)
+    # Write the new table.
+    apply_unit_table(controller_block[UNIT_TABLE_OFFSET:UNIT_TABLE_END], compiled)
 
     # Write it back.
     try:
@@ -93,6 +247,11 @@ if __name__ == "__main__":
     except OSError as excpt:
         sys.exit("Failed to write controller block back to {}: {}".format(parsed.output_path, excpt))
     if(written != BYTES_PER_BLOCK):
-        sys.exit("Failed to write full controller block back to {}: {}".format(parsed.output_path, excpt))
+        sys.exit("Failed to write full controller block back to {}".format(parsed.output_path))
 
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except DialError as excpt:
+        sys.exit(str(excpt))
     sys.exit(0)